@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+from collections.abc import Sequence
+
+from impuls import DBConnection
+from impuls.tools.types import SQLNativeType
+
+DEFAULT_BATCH_SIZE = 4096
+
+
+class BatchWriter:
+    """Collects parameters of a single SQL statement, executing them in fixed-size batches
+    with `DBConnection.raw_execute_many`. Remember to call `flush` after adding the last row.
+
+    If rows depend on rows of another writer (e.g. through a foreign key),
+    pass that writer as `before_flush` - it will always be flushed first.
+    """
+
+    def __init__(
+        self,
+        sql: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        before_flush: "BatchWriter | None" = None,
+    ) -> None:
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+        self.sql = sql
+        self.batch_size = batch_size
+        self.before_flush = before_flush
+        self.rows = list[Sequence[SQLNativeType]]()
+        self.written = 0
+
+    def clear(self) -> None:
+        self.rows.clear()
+        self.written = 0
+
+    def add(self, db: DBConnection, row: Sequence[SQLNativeType]) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush(db)
+
+    def flush(self, db: DBConnection) -> None:
+        if self.before_flush:
+            self.before_flush.flush(db)
+        if self.rows:
+            db.raw_execute_many(self.sql, self.rows)
+            self.written += len(self.rows)
+            self.rows.clear()
@@ -1,35 +1,168 @@
 # SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
 # SPDX-License-Identifier: MIT
 
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
 from datetime import date
 
 from impuls import DBConnection
 
+DateSet = tuple[int, int]
+"""DateSet is a compact, hashable representation of a set of dates: a (first, mask) tuple,
+where first is the ordinal of the earliest date and the i-th bit of mask is set
+if the date `first + i` is included. Bit 0 is thus always set, unless the set is empty,
+in which case it is represented by (0, 0).
+"""
+
+EMPTY_DATE_SET: DateSet = (0, 0)
+
+
+def to_date_set(days: Iterable[date]) -> DateSet:
+    """Converts dates into a :py:obj:`DateSet`.
+
+    >>> to_date_set([date(2026, 3, 2), date(2026, 3, 1), date(2026, 3, 4), date(2026, 3, 2)])
+    (739676, 11)
+    >>> to_date_set([])
+    (0, 0)
+    """
+    ordinals = [d.toordinal() for d in days]
+    if not ordinals:
+        return EMPTY_DATE_SET
+
+    first = min(ordinals)
+    mask = 0
+    for ordinal in ordinals:
+        mask |= 1 << (ordinal - first)
+    return first, mask
+
+
+def iter_date_set(s: DateSet) -> Iterator[date]:
+    """Iterates over dates of a :py:obj:`DateSet`, in ascending order.
+
+    >>> [str(d) for d in iter_date_set((739676, 11))]
+    ['2026-03-01', '2026-03-02', '2026-03-04']
+    """
+    first, mask = s
+    offset = 0
+    while mask:
+        if mask & 1:
+            yield date.fromordinal(first + offset)
+        mask >>= 1
+        offset += 1
+
+
+@dataclass
+class CalendarFit:
+    """CalendarFit represents a set of dates as a calendar.txt entry with exceptions.
+    If `weekdays` is zero, the set of dates is represented only by `added` dates.
+    """
+
+    weekdays: int = 0
+    """Bitmask of active weekdays, with bit 0 representing Monday."""
+
+    start: date | None = None
+    end: date | None = None
+    added: list[date] = field(default_factory=list[date])
+    removed: list[date] = field(default_factory=list[date])
+
+    def has_weekday(self, weekday: int) -> bool:
+        return bool(self.weekdays & (1 << weekday))
+
+    @property
+    def row_count(self) -> int:
+        """Number of rows necessary to save this calendar in calendar.txt and calendar_dates.txt."""
+        return (1 if self.weekdays else 0) + len(self.added) + len(self.removed)
+
+
+def fit_calendar(s: DateSet) -> CalendarFit:
+    """Finds the smallest representation of a set of dates as a weekday pattern
+    (active between the first and last date) with added and removed dates.
+
+    A weekday is included in the pattern if the service is active on more than half of
+    its occurrences. If the pattern doesn't save any rows, only added dates are used.
+
+    >>> fit = fit_calendar(to_date_set(date(2026, 3, d) for d in range(2, 30) if d != 18))
+    >>> bin(fit.weekdays), str(fit.start), str(fit.end), fit.added, [str(d) for d in fit.removed]
+    ('0b1111111', '2026-03-02', '2026-03-29', [], ['2026-03-18'])
+    >>> fit = fit_calendar(to_date_set([date(2026, 3, 2), date(2026, 3, 17)]))
+    >>> fit.weekdays, [str(d) for d in fit.added]
+    (0, ['2026-03-02', '2026-03-17'])
+    """
+    first, mask = s
+    total = [0] * 7
+    active = [0] * 7
+    for offset in range(mask.bit_length()):
+        weekday = (first + offset - 1) % 7  # date.fromordinal(1) is a Monday
+        total[weekday] += 1
+        if mask & (1 << offset):
+            active[weekday] += 1
+
+    weekdays = 0
+    for weekday in range(7):
+        if 2 * active[weekday] > total[weekday]:
+            weekdays |= 1 << weekday
+
+    only_added = CalendarFit(added=list(iter_date_set(s)))
+    if not weekdays:
+        return only_added
+
+    fit = CalendarFit(
+        weekdays=weekdays,
+        start=date.fromordinal(first),
+        end=date.fromordinal(first + mask.bit_length() - 1),
+    )
+    for offset in range(mask.bit_length()):
+        is_active = bool(mask & (1 << offset))
+        in_pattern = bool(weekdays & (1 << ((first + offset - 1) % 7)))
+        if is_active and not in_pattern:
+            fit.added.append(date.fromordinal(first + offset))
+        elif in_pattern and not is_active:
+            fit.removed.append(date.fromordinal(first + offset))
+
+    return fit if fit.row_count < only_added.row_count else only_added
+
+
+def insert_calendar(db: DBConnection, id: str, fit: CalendarFit) -> None:
+    if fit.weekdays:
+        db.raw_execute(
+            "INSERT INTO calendars (calendar_id, monday, tuesday, wednesday, thursday, friday, "
+            "saturday, sunday, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                id,
+                *(int(fit.has_weekday(i)) for i in range(7)),
+                str(fit.start),
+                str(fit.end),
+            ),
+        )
+    else:
+        db.raw_execute("INSERT INTO calendars (calendar_id) VALUES (?)", (id,))
+
+    db.raw_execute_many(
+        "INSERT INTO calendar_exceptions (calendar_id, date, exception_type) VALUES (?, ?, ?)",
+        [(id, str(d), 1) for d in fit.added] + [(id, str(d), 2) for d in fit.removed],
+    )
+
 
 class CalendarGenerator:
     def __init__(self, prefix: str = "") -> None:
         self.prefix = prefix
         self.counter = 0
-        self.assigned = dict[frozenset[date], str]()
+        self.assigned = dict[DateSet, str]()
 
     def clear(self) -> None:
         self.counter = 0
         self.assigned.clear()
 
     def upsert(self, db: DBConnection, days: Iterable[date]) -> str:
-        key = frozenset(days)
+        return self.upsert_set(db, to_date_set(days))
+
+    def upsert_set(self, db: DBConnection, key: DateSet) -> str:
         if cached := self.assigned.get(key):
             return cached
 
         id = f"{self.prefix}{self.counter}"
         self.counter += 1
 
-        db.raw_execute("INSERT INTO calendars (calendar_id) VALUES (?)", (id,))
-        db.raw_execute_many(
-            "INSERT INTO calendar_exceptions (calendar_id, date, exception_type) VALUES (?, ?, 1)",
-            ((id, str(date)) for date in key),
-        )
-
+        insert_calendar(db, id, fit_calendar(key))
         self.assigned[key] = id
         return id
@@ -0,0 +1,15 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """Creates a Session whose connection pool can keep `pool_size` connections
+    to the same host open, so that concurrent requests don't have to reconnect."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: MIT
 
 import json
-from collections.abc import Iterable, Mapping
+from collections.abc import Iterable, Iterator, Mapping
 from typing import IO, Any
 
 import ijson  # type: ignore
@@ -36,5 +36,73 @@ def object_iter(
     return ijson.kvitems(f, path, use_float=True)
 
 
+def stream(
+    f: IO[str] | IO[bytes],
+    paths: Iterable[str],
+    /,
+    seek: bool = True,
+) -> Iterator[tuple[str, str | None, Any]]:
+    """Parses the whole document in a single pass, yielding every value matching
+    any of the provided `paths`, in the order those values appear in the file.
+
+    Paths follow the ijson prefix syntax, with one addition - a trailing ".*" selects every
+    member of an object (like `object_iter`). The yielded tuples are (path, key, value),
+    where path is the requested path the value matched, and key is the object member name
+    for ".*" paths, or None otherwise.
+
+    >>> from io import BytesIO
+    >>> doc = BytesIO(b'{"rt": [{"a": 1}, {"a": 2}], "ts": "now", "dc": {"x": "y"}}')
+    >>> for match in stream(doc, ["ts", "dc.*", "rt.item"]):
+    ...     print(match)
+    ('rt.item', None, {'a': 1})
+    ('rt.item', None, {'a': 2})
+    ('ts', None, 'now')
+    ('dc.*', 'x', 'y')
+    """
+
+    value_paths = set[str]()
+    member_paths = set[str]()
+    for path in paths:
+        if path.endswith(".*"):
+            member_paths.add(path[:-2])
+        else:
+            value_paths.add(path)
+
+    if seek:
+        f.seek(0)
+
+    builder: Any = None
+    end_event = ""
+    current_prefix = ""
+    current_path = ""
+    current_key: str | None = None
+    pending_member: tuple[str, str, str] | None = None  # (path, key, prefix)
+
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event == end_event and prefix == current_prefix:
+                yield current_path, current_key, builder.value
+                builder = None
+            continue
+
+        if pending_member is not None and prefix == pending_member[2]:
+            current_path, current_key, current_prefix = pending_member
+            pending_member = None
+        elif prefix in value_paths and event not in ("map_key", "end_map", "end_array"):
+            current_path, current_key, current_prefix = prefix, None, prefix
+        else:
+            if event == "map_key" and prefix in member_paths:
+                pending_member = (f"{prefix}.*", value, f"{prefix}.{value}" if prefix else value)
+            continue
+
+        if event == "start_map" or event == "start_array":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            end_event = "end_map" if event == "start_map" else "end_array"
+        else:
+            yield current_path, current_key, value
+
+
 def dumps(obj: Any, readable: bool = False) -> str:
     return json.dumps(obj, indent=2 if readable else None, separators=(",", ":"))
@@ -27,6 +27,17 @@ var (
 	trainNumberRegex     = regexp.MustCompile(`^[0-9]{3,6}(?:/[0-9])?`)
 )
 
+// gtfsWeekdayColumns maps [time.Weekday] to calendar.txt columns
+var gtfsWeekdayColumns = [7]string{
+	"sunday",
+	"monday",
+	"tuesday",
+	"wednesday",
+	"thursday",
+	"friday",
+	"saturday",
+}
+
 type DatePair struct {
 	GTFSDate time2.Date
 	PLKDate  time2.Date
@@ -106,17 +117,26 @@ func LoadGTFS(gtfs fs.FS) (p *Package, err error) {
 		}
 	}
 
-	// 3. Load calendar_dates.txt
-	slog.Debug("Loading GTFS calendar_dates.txt")
+	// 3. Load calendar.txt and calendar_dates.txt
+	slog.Debug("Loading GTFS calendar.txt and calendar_dates.txt")
 	var services map[string][]DatePair
 	{
+		var calendar io.Reader
 		var f fs.File
+		f, err = gtfs.Open("calendar.txt")
+		if err == nil {
+			defer f.Close()
+			calendar = f
+		} else if !errors.Is(err, fs.ErrNotExist) {
+			return nil, err
+		}
+
 		f, err = gtfs.Open("calendar_dates.txt")
 		if err != nil {
 			return nil, err
 		}
 		defer f.Close()
-		services, err = LoadGTFSServices(f, p.Dates)
+		services, err = LoadGTFSServices(calendar, f, p.Dates)
 		if err != nil {
 			return nil, err
 		}
@@ -249,15 +269,62 @@ func rankStopID(id string) int {
 	return 0
 }
 
-func LoadGTFSServices(calendarDates io.Reader, period FeedDates) (map[string][]DatePair, error) {
-	d := make(map[string][]DatePair)
+// LoadGTFSServices loads active dates (within the provided period) of all services.
+// calendar is optional and may be nil.
+func LoadGTFSServices(calendar, calendarDates io.Reader, period FeedDates) (map[string][]DatePair, error) {
+	active := make(map[string]map[time2.Date]struct{})
+	getActive := func(id string) map[time2.Date]struct{} {
+		dates, ok := active[id]
+		if !ok {
+			dates = make(map[time2.Date]struct{})
+			active[id] = dates
+		}
+		return dates
+	}
 
-	r := mcsv.NewReader(calendarDates)
-	for row := range r.Iter() {
-		if row["exception_type"] != "1" {
-			panic("GTFS calendar_dates.txt removes dates. This indicates usage of calendar.txt, which is unsupported.")
+	if calendar != nil {
+		r := mcsv.NewReader(calendar)
+		for row := range r.Iter() {
+			id := row["service_id"]
+			if id == "" {
+				return nil, ErrGTFSInvalidValue{"calendar.txt", "service_id", r.Line(), nil}
+			}
+
+			var start, end time2.Date
+			if err := start.UnmarshalText([]byte(row["start_date"])); err != nil {
+				return nil, ErrGTFSInvalidValue{"calendar.txt", "start_date", r.Line(), err}
+			}
+			if err := end.UnmarshalText([]byte(row["end_date"])); err != nil {
+				return nil, ErrGTFSInvalidValue{"calendar.txt", "end_date", r.Line(), err}
+			}
+
+			var weekdays [7]bool
+			for weekday, column := range gtfsWeekdayColumns {
+				weekdays[weekday] = row[column] == "1"
+			}
+
+			if start.Before(period.Start) {
+				start = period.Start
+			}
+			if end.After(period.End) {
+				end = period.End
+			}
+
+			dates := getActive(id)
+			for d := start; !d.After(end); d = d.Next() {
+				if weekdays[d.Weekday()] {
+					dates[d] = struct{}{}
+				}
+			}
 		}
 
+		if err := r.Err(); err != nil {
+			return nil, fmt.Errorf("calendar.txt: %w", err)
+		}
+	}
+
+	r := mcsv.NewReader(calendarDates)
+	for row := range r.Iter() {
 		id := row["service_id"]
 		if id == "" {
 			return nil, ErrGTFSInvalidValue{"calendar_dates.txt", "service_id", r.Line(), nil}
@@ -269,19 +336,43 @@ func LoadGTFSServices(calendarDates io.Reader, period FeedDates) (map[string][]D
 			return nil, ErrGTFSInvalidValue{"calendar_dates.txt", "date", r.Line(), err}
 		}
 
-		if period.Contains(gtfsDate) {
-			gtfsOffset := extractStartDateOffset(id)
-			plkDate := gtfsDate.Shifted(-gtfsOffset)
-			d[id] = append(d[id], DatePair{gtfsDate, plkDate})
+		switch row["exception_type"] {
+		case "1":
+			if period.Contains(gtfsDate) {
+				getActive(id)[gtfsDate] = struct{}{}
+			}
+		case "2":
+			delete(getActive(id), gtfsDate)
+		default:
+			return nil, ErrGTFSInvalidValue{"calendar_dates.txt", "exception_type", r.Line(), nil}
 		}
 	}
 
 	if err := r.Err(); err != nil {
 		return nil, fmt.Errorf("calendar_dates.txt: %w", err)
 	}
+
+	d := make(map[string][]DatePair, len(active))
+	for id, dates := range active {
+		if len(dates) == 0 {
+			continue
+		}
+
+		gtfsOffset := extractStartDateOffset(id)
+		pairs := make([]DatePair, 0, len(dates))
+		for gtfsDate := range dates {
+			pairs = append(pairs, DatePair{gtfsDate, gtfsDate.Shifted(-gtfsOffset)})
+		}
+		slices.SortFunc(pairs, func(a, b DatePair) int { return compareDates(a.GTFSDate, b.GTFSDate) })
+		d[id] = pairs
+	}
 	return d, nil
 }
 
+func compareDates(a, b time2.Date) int {
+	return cmp.Or(cmp.Compare(a.Y, b.Y), cmp.Compare(a.M, b.M), cmp.Compare(a.D, b.D))
+}
+
 func extractStartDateOffset(id string) int {
 	m := startDateOffsetRegex.FindStringSubmatch(id)
 	if m == nil {
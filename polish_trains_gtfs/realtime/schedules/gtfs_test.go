@@ -0,0 +1,89 @@
+// SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+// SPDX-License-Identifier: MIT
+
+package schedules
+
+import (
+	"errors"
+	"reflect"
+	"strings"
+	"testing"
+
+	"github.com/MKuranowski/PolishTrainsGTFS/polish_trains_gtfs/realtime/util/time2"
+)
+
+func TestLoadGTFSServices(t *testing.T) {
+	calendar := strings.NewReader(
+		"service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n" +
+			"C1,1,1,1,1,1,0,0,20260302,20260315\n" +
+			"C2,0,0,0,0,0,0,1,20260301,20260331\n",
+	)
+	calendarDates := strings.NewReader(
+		"date,service_id,exception_type\n" +
+			"20260307,C1,1\n" +
+			"20260304,C1,2\n" +
+			"20260301,C2,2\n" +
+			"20260308,C2,2\n" +
+			"20260310,C3+1D,1\n" +
+			"20260401,C3+1D,1\n",
+	)
+	period := FeedDates{Start: time2.Date{Y: 2026, M: 3, D: 1}, End: time2.Date{Y: 2026, M: 3, D: 12}}
+
+	got, err := LoadGTFSServices(calendar, calendarDates, period)
+	if err != nil {
+		t.Fatalf("LoadGTFSServices: %v", err)
+	}
+
+	march := func(days ...uint8) []DatePair {
+		pairs := make([]DatePair, len(days))
+		for i, day := range days {
+			d := time2.Date{Y: 2026, M: 3, D: day}
+			pairs[i] = DatePair{GTFSDate: d, PLKDate: d}
+		}
+		return pairs
+	}
+	want := map[string][]DatePair{
+		// Weekdays from calendar.txt, clipped to the period, with 7th added and 4th removed
+		"C1": march(2, 3, 5, 6, 7, 9, 10, 11, 12),
+		// C2 has all of its dates within the period removed
+		"C3+1D": {{GTFSDate: time2.Date{Y: 2026, M: 3, D: 10}, PLKDate: time2.Date{Y: 2026, M: 3, D: 9}}},
+	}
+	if !reflect.DeepEqual(got, want) {
+		t.Errorf("LoadGTFSServices() = %v, want %v", got, want)
+	}
+}
+
+func TestLoadGTFSServicesWithoutCalendar(t *testing.T) {
+	calendarDates := strings.NewReader(
+		"date,service_id,exception_type\n" +
+			"20260303,C1,1\n" +
+			"20260302,C1,1\n",
+	)
+	period := FeedDates{Start: time2.Date{Y: 2026, M: 3, D: 1}, End: time2.Date{Y: 2026, M: 3, D: 12}}
+
+	got, err := LoadGTFSServices(nil, calendarDates, period)
+	if err != nil {
+		t.Fatalf("LoadGTFSServices: %v", err)
+	}
+
+	want := map[string][]DatePair{
+		"C1": {
+			{GTFSDate: time2.Date{Y: 2026, M: 3, D: 2}, PLKDate: time2.Date{Y: 2026, M: 3, D: 2}},
+			{GTFSDate: time2.Date{Y: 2026, M: 3, D: 3}, PLKDate: time2.Date{Y: 2026, M: 3, D: 3}},
+		},
+	}
+	if !reflect.DeepEqual(got, want) {
+		t.Errorf("LoadGTFSServices() = %v, want %v", got, want)
+	}
+}
+
+func TestLoadGTFSServicesInvalidExceptionType(t *testing.T) {
+	calendarDates := strings.NewReader("date,service_id,exception_type\n20260302,C1,3\n")
+	period := FeedDates{Start: time2.Date{Y: 2026, M: 3, D: 1}, End: time2.Date{Y: 2026, M: 3, D: 12}}
+
+	_, err := LoadGTFSServices(nil, calendarDates, period)
+	var invalid ErrGTFSInvalidValue
+	if !errors.As(err, &invalid) || invalid.Column != "exception_type" {
+		t.Errorf("LoadGTFSServices() error = %v, want invalid exception_type", err)
+	}
+}
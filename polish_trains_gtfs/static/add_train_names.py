@@ -3,8 +3,9 @@
 
 import re
 from collections.abc import Iterable, Mapping, Sequence
-from dataclasses import dataclass
+from functools import lru_cache
 from itertools import chain
+from time import perf_counter
 from typing import cast
 
 from impuls import DBConnection, Task, TaskRuntime
@@ -45,40 +46,60 @@ INVALID_NAMES: Mapping[str, Sequence[re.Pattern[str]]] = {
 }
 
 
-@dataclass
-class TrainWithName:
-    trip_id: str
-    agency_id: str
-    name: str
-
-
 class AddTrainNames(Task):
     def execute(self, r: TaskRuntime) -> None:
-        to_update = [
-            (name, train.trip_id)
-            for train in self.get_all_trains_with_names(r.db)
-            if (name := get_normalized_name(train.name, train.agency_id))
+        start = perf_counter()
+        names = [
+            (name, agency_id, normalized_name)
+            for name, agency_id in self.get_distinct_train_names(r.db)
+            if (normalized_name := get_normalized_name(name, agency_id))
         ]
         with r.db.transaction():
-            r.db.raw_execute_many(
-                "UPDATE trips SET short_name = short_name || ' ' || ? WHERE trip_id = ?",
-                to_update,
-            )
-
-    def get_all_trains_with_names(self, db: DBConnection) -> Iterable[TrainWithName]:
-        q = db.raw_execute(
-            "SELECT trip_id, agency_id, json_extract(trips.extra_fields_json, '$.plk_train_name') "
-            "FROM trips LEFT JOIN routes USING (route_id) "
-            "WHERE COALESCE(json_extract(trips.extra_fields_json, '$.plk_train_name'), '') != ''",
+            updated = self.apply_train_names(r.db, names)
+        self.logger.info(
+            "Added %d distinct names to %d trips in %.2f s",
+            len(names),
+            updated,
+            perf_counter() - start,
         )
-        for row in q:
-            yield TrainWithName(
-                trip_id=cast(str, row[0]),
-                agency_id=cast(str, row[1]),
-                name=cast(str, row[2]),
-            )
 
+    def get_distinct_train_names(self, db: DBConnection) -> Iterable[tuple[str, str]]:
+        return cast(
+            Iterable[tuple[str, str]],
+            db.raw_execute(
+                "SELECT DISTINCT json_extract(trips.extra_fields_json, '$.plk_train_name'), "
+                "  routes.agency_id "
+                "FROM trips JOIN routes USING (route_id) "
+                "WHERE COALESCE(json_extract(trips.extra_fields_json, '$.plk_train_name'), '') "
+                "  != ''",
+            ),
+        )
 
+    def apply_train_names(self, db: DBConnection, names: Iterable[tuple[str, str, str]]) -> int:
+        db.raw_execute(
+            "CREATE TEMPORARY TABLE train_names ("
+            "  name TEXT NOT NULL,"
+            "  agency_id TEXT NOT NULL,"
+            "  normalized_name TEXT NOT NULL,"
+            "  PRIMARY KEY (name, agency_id)"
+            ") STRICT, WITHOUT ROWID"
+        )
+        db.raw_execute_many(
+            "INSERT INTO temp.train_names (name, agency_id, normalized_name) VALUES (?, ?, ?)",
+            names,
+        )
+        updated = db.raw_execute(
+            "UPDATE trips SET short_name = trips.short_name || ' ' || n.normalized_name "
+            "FROM routes, temp.train_names AS n "
+            "WHERE routes.route_id = trips.route_id "
+            "  AND n.name = json_extract(trips.extra_fields_json, '$.plk_train_name') "
+            "  AND n.agency_id = routes.agency_id"
+        ).rowcount
+        db.raw_execute("DROP TABLE temp.train_names")
+        return updated
+
+
+@lru_cache(maxsize=4096)
 def get_normalized_name(name: str, agency_id: str = "") -> str:
     if agency_id in AGENCIES_WITHOUT_NAMES:
         return ""
@@ -86,21 +107,40 @@ def get_normalized_name(name: str, agency_id: str = "") -> str:
 
 
 def strip_invalid_name_parts(name: str, agency_id: str = "") -> str:
+    if pattern := get_invalid_name_pattern(agency_id):
+        return pattern.sub("", name)
+    return name
+
+
+@lru_cache(maxsize=None)
+def get_invalid_name_pattern(agency_id: str = "") -> re.Pattern[str] | None:
     if agency_id:
         patterns = chain(INVALID_NAMES.get("", []), INVALID_NAMES.get(agency_id, []))
     else:
         patterns = INVALID_NAMES.get("", [])
-
-    for pattern in patterns:
-        name = pattern.sub("", name)
-
-    return name
+    return combine_patterns(patterns)
 
 
 def normalize_case(name: str) -> str:
     name = name.title()
-    for pattern in UPPER_CASE_WORDS:
-        name = pattern.sub(lambda m: m[0].upper(), name)
-    for pattern in LOWER_CASE_WORDS:
-        name = pattern.sub(lambda m: m[0].lower(), name)
+    name = UPPER_CASE_WORDS_PATTERN.sub(lambda m: m[0].upper(), name)
+    name = LOWER_CASE_WORDS_PATTERN.sub(lambda m: m[0].lower(), name)
     return name
+
+
+def combine_patterns(patterns: Iterable[re.Pattern[str]]) -> re.Pattern[str] | None:
+    """Combines patterns into a single alternation, keeping their case-insensitivity.
+    As the combined pattern is applied in a single pass, text exposed by substituting a match
+    of one pattern won't be matched by another pattern.
+
+    >>> combine_patterns([re.compile(r"^a$"), re.compile(r"b", re.I)])
+    re.compile('(?:^a$)|(?i:b)')
+    >>> combine_patterns([]) is None
+    True
+    """
+    parts = [f"(?i:{p.pattern})" if p.flags & re.I else f"(?:{p.pattern})" for p in patterns]
+    return re.compile("|".join(parts)) if parts else None
+
+
+UPPER_CASE_WORDS_PATTERN = cast(re.Pattern[str], combine_patterns(UPPER_CASE_WORDS))
+LOWER_CASE_WORDS_PATTERN = cast(re.Pattern[str], combine_patterns(LOWER_CASE_WORDS))
@@ -2,6 +2,8 @@
 # SPDX-License-Identifier: MIT
 
 from argparse import ArgumentParser, Namespace
+from datetime import timedelta
+from pathlib import Path
 from typing import cast
 
 from impuls import App, HTTPResource, LocalResource, Pipeline, PipelineOptions
@@ -9,17 +11,36 @@ from impuls.model import Date, Stop
 from impuls.tasks import AddEntity, ExecuteSQL, GenerateTripHeadsign, RemoveUnusedEntities, SaveGTFS
 
 from ..apikey import get_apikey
+from ..batch import DEFAULT_BATCH_SIZE
 from . import external
 from .add_train_names import AddTrainNames
 from .curate_routes import CurateRoutes
+from .db_profile import DB_PROFILES, ApplyDBProfile, SnapshotDB, in_memory_db_path
 from .extract_routes import ExtractRoutes
+from .fetch_schedules import (
+    DEFAULT_CACHED_CHUNK_DAYS,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_MAX_AGE,
+    DEFAULT_MAX_REVALIDATIONS,
+    DEFAULT_REFRESH_DAYS,
+    SchedulesResource,
+)
 from .load_bus_stops import LoadBusStops
 from .load_schedules import LoadSchedules
 from .load_stops import LoadStops
+from .profiling import ProfileReport
+from .shape_distances import AddShapeDistances
 from .shift_negative_times import ShiftNegativeTimes
 from .split_bus_legs import SplitBusLegs
+from .sql_trace import SQLTracer
+from .stop_time_extras import FoldStopTimeExtras
 from .load_platforms import FixTransferPlatforms, LoadPlatformData
-from .shapes import AddShapes
+from .shapes import (
+    DEFAULT_OPENRAILROUTING_CONCURRENCY,
+    DEFAULT_OSRM_CONCURRENCY,
+    DEFAULT_RAIL_ROUTER_CONCURRENCY,
+    AddShapes,
+)
 from .extended_route_types import ApplyExtendedRouteTypes
 
 GTFS_HEADERS = {
@@ -40,6 +61,18 @@ GTFS_HEADERS = {
         "is_authority",
         "is_data_source",
     ),
+    "calendar.txt": (
+        "service_id",
+        "monday",
+        "tuesday",
+        "wednesday",
+        "thursday",
+        "friday",
+        "saturday",
+        "sunday",
+        "start_date",
+        "end_date",
+    ),
     "calendar_dates.txt": ("date", "service_id", "exception_type"),
     "feed_info.txt": (
         "feed_publisher_name",
@@ -80,6 +113,7 @@ GTFS_HEADERS = {
         "track",
         "plk_category_code",
         "plk_sequence",
+        "shape_dist_traveled",
     ),
     "transfers.txt": (
         "from_stop_id",
@@ -104,11 +138,15 @@ GTFS_HEADERS = {
         "shape_pt_lat",
         "shape_pt_lon",
         "shape_pt_sequence",
+        "shape_dist_traveled",
     ),
 }
 
 
 class PolishTrainsGTFS(App):
+    in_memory_db: Path | None = None
+    sql_tracer: SQLTracer | None = None
+
     def add_arguments(self, parser: ArgumentParser) -> None:
         parser.add_argument("-o", "--output", default="polish_trains.zip", help="output file path")
         parser.add_argument(
@@ -124,6 +162,151 @@ class PolishTrainsGTFS(App):
             action="store_true",
             help="load extra data from external, non-plk sources",
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            metavar="N",
+            help="number of processes used to convert schedules (default: 1)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            metavar="N",
+            help=(
+                "number of rows inserted at once when loading schedules "
+                f"(default: {DEFAULT_BATCH_SIZE})"
+            ),
+        )
+        parser.add_argument(
+            "--schedules-cache",
+            type=Path,
+            metavar="DIR",
+            help="re-use schedules responses for unchanged days cached in DIR",
+        )
+        parser.add_argument(
+            "--schedules-refresh-days",
+            type=int,
+            default=DEFAULT_REFRESH_DAYS,
+            metavar="N",
+            help=(
+                "with --schedules-cache, always refetch days before N days from today "
+                f"(default: {DEFAULT_REFRESH_DAYS})"
+            ),
+        )
+        parser.add_argument(
+            "--schedules-max-age",
+            type=float,
+            default=DEFAULT_MAX_AGE / timedelta(hours=1),
+            metavar="HOURS",
+            help=(
+                "with --schedules-cache, revalidate days cached more than HOURS ago "
+                f"(default: {DEFAULT_MAX_AGE / timedelta(hours=1):.0f})"
+            ),
+        )
+        parser.add_argument(
+            "--schedules-max-revalidations",
+            type=int,
+            default=DEFAULT_MAX_REVALIDATIONS,
+            metavar="N",
+            help=(
+                "with --schedules-cache, revalidate at most N of the oldest expired days per run "
+                f"(default: {DEFAULT_MAX_REVALIDATIONS})"
+            ),
+        )
+        parser.add_argument(
+            "--schedules-concurrency",
+            type=int,
+            default=DEFAULT_CONCURRENCY,
+            metavar="N",
+            help=f"number of concurrent schedules requests (default: {DEFAULT_CONCURRENCY})",
+        )
+        parser.add_argument(
+            "--schedules-chunk-days",
+            type=int,
+            metavar="N",
+            help=(
+                "number of days per schedules request (default: all days in a single request, "
+                f"or {DEFAULT_CACHED_CHUNK_DAYS} with --schedules-cache)"
+            ),
+        )
+        parser.add_argument(
+            "--shapes-concurrency",
+            type=int,
+            metavar="N",
+            help=(
+                "number of concurrent shape routing requests "
+                f"(default: {DEFAULT_OSRM_CONCURRENCY} with OSRM, "
+                f"{DEFAULT_RAIL_ROUTER_CONCURRENCY} with the offline router, "
+                f"{DEFAULT_OPENRAILROUTING_CONCURRENCY} with OpenRailRouting)"
+            ),
+        )
+        parser.add_argument(
+            "--no-shapes-cache",
+            action="store_false",
+            dest="shapes_cache",
+            help="route all shapes, without re-using shapes cached in the workspace",
+        )
+        parser.add_argument(
+            "--route-shape-segments",
+            action="store_true",
+            help=(
+                "route every unique pair of consecutive stops and assemble shapes from them, "
+                "instead of routing every unique sequence of stops"
+            ),
+        )
+        parser.add_argument(
+            "--simplify-shapes",
+            type=float,
+            default=0.0,
+            metavar="METERS",
+            help="simplify shapes, removing points closer than METERS to the simplified line",
+        )
+        parser.add_argument(
+            "--clear-shapes-cache",
+            action="store_true",
+            help="drop all shapes cached in the workspace before routing",
+        )
+        parser.add_argument(
+            "--db-profile",
+            choices=sorted(DB_PROFILES),
+            default="default",
+            help=(
+                "SQLite settings of the workspace database; "
+                '"fast" trades durability for speed (default: "default")'
+            ),
+        )
+        parser.add_argument(
+            "--in-memory-db",
+            action="store_true",
+            help=(
+                "keep the database in memory (on /dev/shm), instead of the workspace; "
+                "use --db-snapshot to save it"
+            ),
+        )
+        parser.add_argument(
+            "--db-snapshot",
+            type=Path,
+            metavar="PATH",
+            help="save the database to PATH after all tasks",
+        )
+        parser.add_argument(
+            "--profile-report",
+            type=Path,
+            metavar="PATH",
+            help=(
+                "write wall and CPU time, memory usage, I/O and table row counts "
+                "of every task to a JSON file at PATH"
+            ),
+        )
+        parser.add_argument(
+            "--trace-sql",
+            type=int,
+            metavar="N",
+            help="trace all SQL statements and log the N statements with the longest total time",
+        )
 
     def prepare(self, args: Namespace, options: PipelineOptions) -> Pipeline:
         apikey = get_apikey("PKP_PLK_APIKEY")
@@ -139,14 +322,23 @@ class PolishTrainsGTFS(App):
             external_resources = {}
             external_tasks = []
 
-        return Pipeline(
+        if args.in_memory_db:
+            self.in_memory_db = in_memory_db_path()
+
+        pipeline = Pipeline(
             options=options,
             resources={
                 **external_resources,
-                "schedules.json": HTTPResource.get(
-                    "https://pdp-api.plk-sa.pl/api/v1/schedules/shortened",
-                    headers={"X-Api-Key": apikey},
-                    params={"dateFrom": start_date.isoformat(), "dateTo": end_date.isoformat()},
+                "schedules.json": SchedulesResource(
+                    apikey,
+                    start_date,
+                    end_date,
+                    cache_dir=args.schedules_cache,
+                    max_age=timedelta(hours=args.schedules_max_age),
+                    refresh_days=args.schedules_refresh_days,
+                    max_revalidations=args.schedules_max_revalidations,
+                    chunk_days=args.schedules_chunk_days,
+                    concurrency=args.schedules_concurrency,
                 ),
                 "pl_rail_map.osm": HTTPResource.get(
                     "https://raw.githubusercontent.com/MKuranowski/PLRailMap/master/plrailmap.osm"
@@ -159,7 +351,7 @@ class PolishTrainsGTFS(App):
                 ),
             },
             tasks=[
-                LoadSchedules(),
+                LoadSchedules(batch_size=args.batch_size, jobs=args.jobs),
                 *external_tasks,
                 ExecuteSQL(
                     statement="DELETE FROM agencies WHERE agency_id = 'WKD'",
@@ -193,7 +385,10 @@ class PolishTrainsGTFS(App):
                 ExecuteSQL(
                     statement=(
                         "UPDATE stop_times SET platform = 'BUS' "
-                        "WHERE platform = '' AND json_extract(extra_fields_json, '$.plk_category_code') = 'BUS'"
+                        "WHERE platform = '' AND (trip_id, stop_sequence) IN ("
+                        "  SELECT trip_id, stop_sequence FROM stop_time_extras "
+                        "  WHERE plk_category_code = 'BUS'"
+                        ")"
                     ),
                     task_name="FixMissingBusPlatforms",
                 ),
@@ -217,8 +412,39 @@ class PolishTrainsGTFS(App):
                 ),
                 LoadPlatformData(),
                 FixTransferPlatforms(),
-                AddShapes(),
+                AddShapes(
+                    concurrency=args.shapes_concurrency,
+                    use_cache=args.shapes_cache,
+                    clear_cache=args.clear_shapes_cache,
+                    route_segments=args.route_shape_segments,
+                    simplify_tolerance=args.simplify_shapes,
+                ),
+                AddShapeDistances(),
                 ApplyExtendedRouteTypes(),
+                FoldStopTimeExtras(),
                 SaveGTFS(GTFS_HEADERS, args.output, ensure_order=True),
             ],
+            db_path=self.in_memory_db,
+            remove_db_on_failure=self.in_memory_db is not None,
         )
+
+        if args.db_profile != "default":
+            pipeline.tasks.insert(0, ApplyDBProfile(args.db_profile))
+
+        if args.db_snapshot:
+            pipeline.tasks.append(SnapshotDB(args.db_snapshot))
+
+        if args.trace_sql:
+            self.sql_tracer = SQLTracer(args.trace_sql)
+            pipeline.tasks = self.sql_tracer.wrap(pipeline.tasks)
+
+        if args.profile_report:
+            pipeline.tasks = ProfileReport(args.profile_report).wrap(pipeline.tasks)
+
+        return pipeline
+
+    def after_run(self) -> None:
+        if self.in_memory_db:
+            self.in_memory_db.unlink(missing_ok=True)
+        if self.sql_tracer:
+            self.sql_tracer.log_report()
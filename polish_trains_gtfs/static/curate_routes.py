@@ -3,7 +3,7 @@
 
 import fnmatch
 import re
-from collections.abc import MutableMapping
+from collections.abc import Iterable
 from typing import NotRequired, TypedDict, cast
 
 from impuls import DBConnection, Task, TaskRuntime
@@ -11,6 +11,11 @@ from impuls.errors import DataError, MultipleDataErrors
 from impuls.model import Agency, Route
 from impuls.tools.color import text_color_for
 
+FIELD_SEPARATOR = "\0"
+"""Separates route_id from short_name in strings matched by :py:class:`CombinedRouteMatcher`."""
+
+END_ANCHOR = re.compile(r"\\[Zz]$")
+
 
 class CuratedRouteMatcher(TypedDict):
     id: NotRequired[str]
@@ -59,6 +64,23 @@ class RouteMatcher:
             return False
         return True
 
+    def as_regex(self) -> str:
+        """Returns a regular expression fully matching `{route_id}\\0{short_name}`
+        of matched routes."""
+        return (
+            self._as_regex_part(self.id)
+            + re.escape(FIELD_SEPARATOR)
+            + self._as_regex_part(self.short_name)
+        )
+
+    @staticmethod
+    def _as_regex_part(pat: re.Pattern[str] | None) -> str:
+        if not pat:
+            return "(?s:.*)"
+        # fnmatch.translate anchors patterns at the end, which only works for the last part
+        source = END_ANCHOR.sub("", pat.pattern)
+        return f"(?i:{source})" if pat.flags & re.I else f"(?:{source})"
+
     @staticmethod
     def _compile(
         pat: str,
@@ -72,6 +94,35 @@ class RouteMatcher:
         return re.compile(pat, flags=(re.I if case_sensitive else 0))
 
 
+class CombinedRouteMatcher:
+    """CombinedRouteMatcher compiles all matchers of curated routes of an agency into
+    a single regular expression, which finds the first curated route matching a route
+    in one pass.
+
+    A route is matched by a curated route with the same id, or by any of its matchers.
+    Regular expressions of matchers must not use anchors, backreferences
+    or global inline flags.
+    """
+
+    def __init__(self, routes: Iterable[CuratedRoute]) -> None:
+        self.route_ids = list[str]()
+        alternatives = list[str]()
+        for idx, data in enumerate(routes):
+            self.route_ids.append(data["id"])
+            exact_id = re.escape(data["id"] + FIELD_SEPARATOR) + "(?s:.*)"
+            matchers = [RouteMatcher(**m).as_regex() for m in data.get("match", [])]
+            # Empty marker group tells which curated route was matched
+            alternatives.append(f"(?:{'|'.join([exact_id, *matchers])})(?P<r{idx}>)")
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+    def resolve(self, r: Route) -> str | None:
+        """Returns the id of the first curated route matching the provided route, if any."""
+        subject = f"{r.id}{FIELD_SEPARATOR}{r.short_name}"
+        if self.pattern and (m := self.pattern.fullmatch(subject)):
+            return self.route_ids[int(cast(str, m.lastgroup)[1:])]
+        return None
+
+
 class CurateRoutes(Task):
     def __init__(self, r: str = "routes.yaml") -> None:
         super().__init__()
@@ -79,6 +130,7 @@ class CurateRoutes(Task):
 
         self.to_curate = dict[str, tuple[Agency, dict[str, Route]]]()
         self.leftover = list[Agency | Route]()
+        self.route_id_changes = list[tuple[str, str]]()
 
     def execute(self, r: TaskRuntime) -> None:
         curated_data = cast(CuratedData, r.resources[self.r].yaml())
@@ -87,6 +139,7 @@ class CurateRoutes(Task):
         with r.db.transaction():
             for agency_data in curated_data["agencies"]:
                 self.curate_agency(r.db, agency_data)
+            self.apply_route_id_changes(r.db)
             self.clean_unused(r.db)
 
         self.collect_leftover_agencies()
@@ -95,6 +148,7 @@ class CurateRoutes(Task):
     def load_to_curate(self, db: DBConnection) -> None:
         self.to_curate.clear()
         self.leftover.clear()
+        self.route_id_changes.clear()
         for agency in db.retrieve_all(Agency):
             self.to_curate[agency.id] = (agency, {})
         for route in db.retrieve_all(Route):
@@ -104,8 +158,15 @@ class CurateRoutes(Task):
         self.upsert_agency(db, agency_data)
         routes = self.get_all_routes_to_curate(agency_data)
         for route_data in agency_data["routes"]:
-            self.curate_route(db, route_data, agency_data["id"], routes)
-        self.leftover.extend(routes.values())
+            self.upsert_route(db, route_data, agency_data["id"], exists=route_data["id"] in routes)
+
+        matcher = CombinedRouteMatcher(agency_data["routes"])
+        for route_id, route in routes.items():
+            curated_id = matcher.resolve(route)
+            if curated_id is None:
+                self.leftover.append(route)
+            elif curated_id != route_id:
+                self.route_id_changes.append((route_id, curated_id))
 
     def upsert_agency(self, db: DBConnection, data: CuratedAgency) -> None:
         if data["id"] in self.to_curate:
@@ -124,29 +185,6 @@ class CurateRoutes(Task):
         _, routes = self.to_curate.pop(data["id"], (None, dict[str, Route]()))
         return routes
 
-    def curate_route(
-        self,
-        db: DBConnection,
-        data: CuratedRoute,
-        agency_id: str,
-        to_curate: MutableMapping[str, Route],
-    ) -> None:
-        self.upsert_route(db, data, agency_id, exists=data["id"] in to_curate)
-        to_curate.pop(data["id"], None)  # Remove implicit match on exact route_id
-
-        curated = set[str]()
-        matchers = [RouteMatcher(**m) for m in data.get("match", [])]
-        for route_id, route in to_curate.items():
-            if any(m.matches(route) for m in matchers):
-                curated.add(route_id)
-                db.raw_execute(
-                    "UPDATE trips SET route_id = ? WHERE route_id = ?",
-                    (data["id"], route_id),
-                )
-
-        for route_id in curated:
-            del to_curate[route_id]
-
     def upsert_route(
         self,
         db: DBConnection,
@@ -188,6 +226,23 @@ class CurateRoutes(Task):
             ),
         )
 
+    def apply_route_id_changes(self, db: DBConnection) -> None:
+        db.raw_execute(
+            "CREATE TEMPORARY TABLE route_id_changes ("
+            "  route_id TEXT PRIMARY KEY,"
+            "  new_route_id TEXT NOT NULL"
+            ") STRICT, WITHOUT ROWID"
+        )
+        db.raw_execute_many(
+            "INSERT INTO temp.route_id_changes (route_id, new_route_id) VALUES (?, ?)",
+            self.route_id_changes,
+        )
+        db.raw_execute(
+            "UPDATE trips SET route_id = c.new_route_id FROM temp.route_id_changes AS c "
+            "WHERE trips.route_id = c.route_id"
+        )
+        db.raw_execute("DROP TABLE temp.route_id_changes")
+
     def clean_unused(self, db: DBConnection) -> None:
         db.raw_execute(
             "DELETE FROM routes WHERE NOT EXISTS "
@@ -0,0 +1,69 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import os
+import sqlite3
+from pathlib import Path
+from time import perf_counter
+
+from impuls import Task, TaskRuntime
+
+DB_PROFILES: dict[str, list[str]] = {
+    "default": [],
+    "fast": [
+        # The workspace database is a throwaway intermediate, so durability is not needed.
+        # The rollback journal is kept in memory (instead of being turned off), as tasks
+        # still depend on rolling back failed transactions.
+        "PRAGMA journal_mode = MEMORY",
+        "PRAGMA synchronous = OFF",
+        "PRAGMA cache_size = -262144",  # 256 MiB
+        "PRAGMA mmap_size = 1073741824",  # 1 GiB
+        "PRAGMA temp_store = MEMORY",
+    ],
+}
+
+
+class ApplyDBProfile(Task):
+    """ApplyDBProfile sets the PRAGMAs of a profile from :py:const:`DB_PROFILES`
+    on the workspace database. Must run before any other task, as journal_mode
+    can't be changed inside of a transaction."""
+
+    def __init__(self, profile: str) -> None:
+        super().__init__()
+        self.profile = profile
+
+    def execute(self, r: TaskRuntime) -> None:
+        for pragma in DB_PROFILES[self.profile]:
+            r.db.raw_execute(pragma)
+        self.logger.info("Applied the %s database profile", self.profile)
+
+
+class SnapshotDB(Task):
+    """SnapshotDB copies the whole database to a file, replacing it if it exists."""
+
+    def __init__(self, path: Path) -> None:
+        super().__init__()
+        self.path = path
+
+    def execute(self, r: TaskRuntime) -> None:
+        start = perf_counter()
+        self.path.unlink(missing_ok=True)
+        target = sqlite3.connect(self.path)
+        try:
+            # NOTE: DBConnection doesn't expose the underlying sqlite3.Connection
+            r.db._con.backup(target)  # type: ignore
+        finally:
+            target.close()
+        self.logger.info("Saved the database to %s in %.2f s", self.path, perf_counter() - start)
+
+
+def in_memory_db_path() -> Path:
+    """Returns a path for the database in a RAM-backed file system (/dev/shm).
+
+    A proper ":memory:" database can't be used, as some tasks (like SaveGTFS)
+    pass the database by its path to other programs.
+    """
+    directory = Path("/dev/shm")
+    if not directory.is_dir():
+        raise RuntimeError("in-memory database requires a RAM-backed /dev/shm")
+    return directory / f"polish_trains_gtfs_{os.getpid()}.db"
@@ -4,6 +4,8 @@
 import re
 from abc import ABC, abstractmethod
 from collections.abc import Iterable, Mapping, Sequence
+from itertools import groupby
+from operator import itemgetter
 from typing import Any, NamedTuple, NotRequired, TypedDict, cast
 
 from impuls import DBConnection, Task, TaskRuntime
@@ -25,6 +27,10 @@ class AgencyConfig(TypedDict):
 
 Config = Mapping[str, AgencyConfig]
 
+Pattern = tuple[str, str, tuple[str, ...]]
+"""Pattern contains all attributes of a trip used by selectors: route_id, plk_train_name
+and the stop_ids (only if any selector requires stops, otherwise empty)."""
+
 
 class Assignment(NamedTuple):
     trip_id: str
@@ -48,6 +54,10 @@ class Selector(ABC):
     @abstractmethod
     def requires_stops(self) -> bool: ...
 
+    @abstractmethod
+    def required_stop_ids(self) -> frozenset[str]:
+        """Returns the stops which must all be visited by a trip for the selector to match."""
+
     @abstractmethod
     def matches(self, t: Trip, stops: Iterable[str]) -> str | None: ...
 
@@ -66,6 +76,9 @@ class CombinedSelector(Selector):
     def requires_stops(self) -> bool:
         return any(i.requires_stops() for i in self.selectors)
 
+    def required_stop_ids(self) -> frozenset[str]:
+        return frozenset[str]().union(*(i.required_stop_ids() for i in self.selectors))
+
     def matches(self, t: Trip, stops: Iterable[str]) -> str | None:
         code: str | None = None
         for s in self.selectors:
@@ -83,6 +96,9 @@ class AnySelector(Selector):
     def requires_stops(self) -> bool:
         return False
 
+    def required_stop_ids(self) -> frozenset[str]:
+        return frozenset()
+
     def matches(self, t: Trip, stops: Iterable[str]) -> str | None:
         return self.route_code
 
@@ -94,6 +110,9 @@ class RetainSelector(Selector):
     def requires_stops(self) -> bool:
         return False
 
+    def required_stop_ids(self) -> frozenset[str]:
+        return frozenset()
+
     def matches(self, t: Trip, stops: Iterable[str]) -> str | None:
         return t.route_id.partition("_")[2]
 
@@ -106,6 +125,9 @@ class NameSelector(Selector):
     def requires_stops(self) -> bool:
         return False
 
+    def required_stop_ids(self) -> frozenset[str]:
+        return frozenset()
+
     def matches(self, t: Trip, stops: Iterable[str]) -> str | None:
         name = t.get_extra_field("plk_train_name") or ""
         if m := self.name_pattern.search(name):
@@ -121,12 +143,61 @@ class PassesThroughSelector(Selector):
     def requires_stops(self) -> bool:
         return True
 
+    def required_stop_ids(self) -> frozenset[str]:
+        return frozenset(self.required_stops)
+
     def matches(self, t: Trip, stops: Iterable[str]) -> str | None:
         if self.required_stops.issubset(stops):
             return self.route_code
         return None
 
 
+class SelectorMatcher:
+    """SelectorMatcher finds the first selector matching a trip, like trying every selector
+    in order would, but only evaluates selectors whose required stops are all visited by the trip.
+
+    Selectors are indexed by their required stops, and the candidates are found by walking
+    the stops of a trip once.
+    """
+
+    def __init__(self, selectors: Iterable[Selector]) -> None:
+        self.selectors = list(selectors)
+        self.required_counts = list[int]()
+        self.selectors_by_stop = dict[str, list[int]]()
+        self.without_required_stops = list[int]()
+
+        for idx, selector in enumerate(self.selectors):
+            required_stops = selector.required_stop_ids()
+            self.required_counts.append(len(required_stops))
+            if required_stops:
+                for stop_id in required_stops:
+                    self.selectors_by_stop.setdefault(stop_id, []).append(idx)
+            else:
+                self.without_required_stops.append(idx)
+
+    def match(self, t: Trip, stops: Sequence[str]) -> str | None:
+        for idx in self.candidates(stops):
+            if (route_code := self.selectors[idx].matches(t, stops)) is not None:
+                return route_code
+        return None
+
+    def candidates(self, stops: Sequence[str]) -> list[int]:
+        """Returns indices of selectors which may match a trip with the provided stops,
+        in ascending order."""
+        if not self.selectors_by_stop:
+            return self.without_required_stops
+
+        candidates = self.without_required_stops.copy()
+        visited_counts = dict[int, int]()
+        for stop_id in set(stops):
+            for idx in self.selectors_by_stop.get(stop_id, ()):
+                visited_counts[idx] = visited_counts.get(idx, 0) + 1
+                if visited_counts[idx] == self.required_counts[idx]:
+                    candidates.append(idx)
+        candidates.sort()
+        return candidates
+
+
 def create_selector_from_config(code: str, cfg: SelectorConfig) -> Selector:
     s: Selector = AnySelector(code)
     unused_keys = set(cfg.keys())
@@ -174,17 +245,35 @@ class ExtractRoutes(Task):
     ) -> Iterable[Assignment]:
         selectors = self.create_selectors(cfg["routes"])
         requires_stops = any(i.requires_stops() for i in selectors)
+        matcher = SelectorMatcher(selectors)
         disregard_stops_up_to = str(cfg.get("disregard_stops_up_to", ""))
         to_curate = self.get_trips_to_curate(db, agency_id, requires_stops, disregard_stops_up_to)
 
+        # Most trips share their patterns, run selectors only once per pattern
+        route_code_by_pattern = dict[Pattern, str | None]()
+        trip_count = 0
+
         for trip, stops in to_curate:
-            for selector in selectors:
-                if (route_code := selector.matches(trip, stops)) is not None:
-                    yield Assignment(trip.id, agency_id, route_code)
-                    break
+            trip_count += 1
+            pattern = (trip.route_id, trip.get_extra_field("plk_train_name") or "", stops)
+            if pattern in route_code_by_pattern:
+                route_code = route_code_by_pattern[pattern]
+            else:
+                route_code = matcher.match(trip, stops)
+                route_code_by_pattern[pattern] = route_code
+
+            if route_code is not None:
+                yield Assignment(trip.id, agency_id, route_code)
             else:
                 self.leftover.append(trip)
 
+        self.logger.info(
+            "Evaluated %d patterns for %d trips of %s",
+            len(route_code_by_pattern),
+            trip_count,
+            agency_id,
+        )
+
     def create_selectors(self, configs: Iterable[RouteConfig]) -> list[Selector]:
         return [
             create_selector_from_config(r["route_code"], s) for r in configs for s in r["select"]
@@ -196,38 +285,38 @@ class ExtractRoutes(Task):
         agency_id: str,
         requires_stops: bool = True,
         disregard_stops_up_to: str = "",
-    ) -> Iterable[tuple[Trip, list[str]]]:
+    ) -> Iterable[tuple[Trip, tuple[str, ...]]]:
+        stops_by_trip = (
+            self.get_stops_by_trip(db, agency_id, disregard_stops_up_to) if requires_stops else {}
+        )
         q = db.typed_out_execute(
-            "SELECT * FROM trips WHERE "
-            "(SELECT agency_id FROM routes WHERE trips.route_id = routes.route_id) = ?",
+            "SELECT trips.* FROM trips JOIN routes USING (route_id) WHERE routes.agency_id = ?",
             Trip,
             (agency_id,),
         )
         for trip in q:
-            stops = (
-                self.get_stops_of_trip(db, trip.id, disregard_stops_up_to) if requires_stops else []
-            )
-            yield trip, stops
+            yield trip, stops_by_trip.get(trip.id, ())
 
-    def get_stops_of_trip(
+    def get_stops_by_trip(
         self,
         db: DBConnection,
-        trip_id: str,
+        agency_id: str,
         disregard_up_to: str = "",
-    ) -> list[str]:
-        stops = [
-            cast(str, i[0])
-            for i in db.raw_execute(
-                "SELECT stop_id FROM stop_times WHERE trip_id = ? ORDER BY stop_sequence ASC",
-                (trip_id,),
-            )
-        ]
-        if disregard_up_to:
-            disregard_idx = index_of(stops, disregard_up_to)
-            disregard_is_last = disregard_idx == len(stops) - 1
-            if disregard_idx is not None and not disregard_is_last:
-                return stops[disregard_idx:]
-        return stops
+    ) -> dict[str, tuple[str, ...]]:
+        q = cast(
+            Iterable[tuple[str, str]],
+            db.raw_execute(
+                "SELECT trip_id, stop_id FROM stop_times WHERE trip_id IN ("
+                "  SELECT trip_id FROM trips JOIN routes USING (route_id) "
+                "  WHERE routes.agency_id = ?"
+                ") ORDER BY trip_id, stop_sequence ASC",
+                (agency_id,),
+            ),
+        )
+        return {
+            trip_id: disregard_stops(tuple(i[1] for i in rows), disregard_up_to)
+            for trip_id, rows in groupby(q, itemgetter(0))
+        }
 
     def run_assignments(self, db: DBConnection, assignments: Sequence[Assignment]) -> None:
         db.raw_execute_many(
@@ -252,6 +341,15 @@ class ExtractRoutes(Task):
             )
 
 
+def disregard_stops(stops: tuple[str, ...], up_to: str = "") -> tuple[str, ...]:
+    if up_to:
+        up_to_idx = index_of(stops, up_to)
+        up_to_is_last = up_to_idx == len(stops) - 1
+        if up_to_idx is not None and not up_to_is_last:
+            return stops[up_to_idx:]
+    return stops
+
+
 def index_of[T](s: Sequence[T], elem: T) -> int | None:
     try:
         return s.index(elem)
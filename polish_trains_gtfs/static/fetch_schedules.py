@@ -0,0 +1,604 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, cast
+
+import requests
+from impuls.errors import InputNotModified
+from impuls.model import Date
+from impuls.resource import FETCH_CHUNK_SIZE, ConcreteResource
+from impuls.tools.temporal import date_range
+
+from .. import json
+from ..http_session import pooled_session
+
+SCHEDULES_URL = "https://pdp-api.plk-sa.pl/api/v1/schedules/shortened"
+
+DEFAULT_MAX_AGE = timedelta(days=7)
+DEFAULT_REFRESH_DAYS = 1
+DEFAULT_MAX_REVALIDATIONS = 4
+DEFAULT_CACHED_CHUNK_DAYS = 1
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_SECOND = 2.0
+
+MAX_RETRIES = 8
+MAX_RETRY_DELAY = 120.0
+RETRY_STATUS_CODES = (429, 503)
+REQUEST_TIMEOUT = (10.0, 300.0)  # (connect, read) in seconds
+
+STREAMED_PATHS = ("ts", "pr", "dc.cr.*", "dc.cc.*", "dc.st.*", "rt.item")
+
+RouteKey = bytes
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedChunk:
+    days: int
+    digest: str
+    fetch_time: datetime
+    etag: str = ""
+    last_modified: str = ""
+
+
+@dataclass
+class FetchedChunk:
+    content: bytes | None  # None if the cached response was not modified
+    etag: str
+    last_modified: str
+    retries: int
+
+
+class ChunkCache:
+    """ChunkCache keeps responses for chunks of consecutive days in a content-addressed store:
+    bodies are saved as `objects/<sha256>.json`, and `index.json` maps the first days of chunks
+    to their lengths, the digests of their bodies and their validators
+    (ETag and Last-Modified headers), used to revalidate cached responses.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.objects = directory / "objects"
+        self.index_path = directory / "index.json"
+        self.index = dict[Date, CachedChunk]()
+
+    def load(self) -> None:
+        self.objects.mkdir(parents=True, exist_ok=True)
+        try:
+            with self.index_path.open("rb") as f:
+                raw = cast(dict[str, dict[str, Any]], json.first(f, "") or {})
+        except FileNotFoundError:
+            raw = {}
+
+        self.index = {
+            Date.from_ymd_str(day): CachedChunk(
+                entry.get("days", 1),
+                entry["digest"],
+                datetime.fromtimestamp(entry["fetch_time"], timezone.utc),
+                entry.get("etag", ""),
+                entry.get("last_modified", ""),
+            )
+            for day, entry in raw.items()
+            if self.path_of(entry["digest"]).exists()
+        }
+
+    def save(self) -> None:
+        raw = {
+            day.isoformat(): {
+                "days": entry.days,
+                "digest": entry.digest,
+                "fetch_time": entry.fetch_time.timestamp(),
+                "etag": entry.etag,
+                "last_modified": entry.last_modified,
+            }
+            for day, entry in sorted(self.index.items())
+        }
+        tmp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            f.write(json.dumps(raw, readable=True))
+        os.replace(tmp_path, self.index_path)
+
+    def path_of(self, digest: str) -> Path:
+        return self.objects / f"{digest}.json"
+
+    def to_fetch(
+        self,
+        chunks: Iterable["Chunk"],
+        now: datetime,
+        max_age: timedelta,
+        refresh_until: Date,
+        max_revalidations: int,
+    ) -> list["Chunk"]:
+        """Returns the chunks which need to be (re)fetched:
+        * chunks missing from the cache,
+        * chunks starting before `refresh_until` (the near-term days,
+          where timetables change most often),
+        * up to `max_revalidations` of the oldest chunks fetched more than `max_age` ago.
+
+        Limiting revalidations spreads them over multiple runs, instead of
+        refetching all days cached on the same run at once.
+
+        >>> cache = ChunkCache(Path("cache"))
+        >>> now = datetime(2026, 3, 10, tzinfo=timezone.utc)
+        >>> for day in range(1, 8):
+        ...     cache.index[Date(2026, 3, day)] = CachedChunk(1, "", now - timedelta(days=day))
+        >>> chunks = Chunk.split(Date(2026, 3, 1), Date(2026, 3, 9), 1)
+        >>> to_fetch = cache.to_fetch(chunks, now, timedelta(days=3), Date(2026, 3, 2), 2)
+        >>> [chunk.start.day for chunk in to_fetch]
+        [1, 6, 7, 8, 9]
+        """
+        near_or_missing = list["Chunk"]()
+        stale = list[tuple[datetime, "Chunk"]]()
+        for chunk in chunks:
+            entry = self.index.get(chunk.start)
+            if entry is None or entry.days != chunk.days or chunk.start < refresh_until:
+                near_or_missing.append(chunk)
+            elif now - entry.fetch_time > max_age:
+                stale.append((entry.fetch_time, chunk))
+
+        stale.sort(key=lambda i: i[0])
+        revalidated = [chunk for _, chunk in stale[:max_revalidations]]
+        return sorted(near_or_missing + revalidated, key=lambda c: c.start)
+
+    def validators(self, chunk: "Chunk") -> dict[str, str]:
+        """Returns the headers for a conditional request for a cached chunk."""
+        entry = self.index.get(chunk.start)
+        headers = dict[str, str]()
+        if entry is not None and entry.days == chunk.days:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def put(self, chunk: "Chunk", fetched: FetchedChunk, fetch_time: datetime) -> None:
+        """Saves a fetched response, or marks the cached one as fresh if it wasn't modified."""
+        if fetched.content is None:
+            entry = self.index[chunk.start]
+            entry.fetch_time = fetch_time
+            entry.etag = fetched.etag or entry.etag
+            entry.last_modified = fetched.last_modified or entry.last_modified
+            return
+
+        digest = hashlib.sha256(fetched.content).hexdigest()
+        path = self.path_of(digest)
+        if not path.exists():
+            tmp_path = path.with_name(path.name + ".tmp")
+            tmp_path.write_bytes(fetched.content)
+            os.replace(tmp_path, path)
+        self.index[chunk.start] = CachedChunk(
+            chunk.days,
+            digest,
+            fetch_time,
+            fetched.etag,
+            fetched.last_modified,
+        )
+
+    def retain_only(self, chunks: Iterable["Chunk"]) -> None:
+        """Forgets all chunks not in `chunks` and removes unreferenced objects."""
+        keep = {(chunk.start, chunk.days) for chunk in chunks}
+        self.index = {
+            start: entry for start, entry in self.index.items() if (start, entry.days) in keep
+        }
+
+        used = {entry.digest for entry in self.index.values()}
+        for path in self.objects.glob("*.json"):
+            if path.stem not in used:
+                path.unlink(missing_ok=True)
+
+
+@dataclass(frozen=True)
+class Chunk:
+    start: Date
+    end: Date
+
+    @property
+    def days(self) -> int:
+        return (self.end - self.start).days + 1
+
+    @staticmethod
+    def split(start: Date, end: Date, days: int) -> list["Chunk"]:
+        if days < 1:
+            raise ValueError(f"chunk length must be positive, got {days}")
+        all_days = list(date_range(start, end))
+        return [
+            Chunk(all_days[i], all_days[min(i + days, len(all_days)) - 1])
+            for i in range(0, len(all_days), days)
+        ]
+
+
+class TokenBucket:
+    """TokenBucket limits the rate of requests made by multiple threads. Up to `capacity`
+    requests may be made in a burst, after which tokens are refilled at `rate` per second.
+
+    `pause` stops handing out tokens for the given number of seconds, which is used
+    to back off after the server responds with 429 Too Many Requests.
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now > self.updated:
+                    self.tokens = min(
+                        self.capacity,
+                        self.tokens + (now - self.updated) * self.rate,
+                    )
+                    self.updated = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                else:
+                    wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            # Start refilling from an empty bucket only once the pause is over,
+            # so that all waiting threads don't hit the server at the same time.
+            self.tokens = 0.0
+            self.updated = max(self.updated, self.paused_until)
+
+
+class SchedulesResource(ConcreteResource):
+    """SchedulesResource fetches PKP PLK schedules for a window of dates, split into chunks
+    of `chunk_days` days. Chunks are downloaded concurrently by up to `concurrency` threads
+    sharing a single connection pool, with the request rate limited by a :py:class:`TokenBucket`.
+
+    By default, the whole window is fetched with a single request, unless `cache_dir`
+    is provided - then chunks of DEFAULT_CACHED_CHUNK_DAYS are used, so that unchanged
+    days can be re-used.
+
+    If `cache_dir` is provided, responses are kept in a :py:class:`ChunkCache`, and only
+    chunks missing from the cache, chunks before `refresh_days` days from today, and up to
+    `max_revalidations` chunks older than `max_age` are downloaded (see
+    :py:meth:`ChunkCache.to_fetch`). Cached chunks are requested conditionally,
+    so that unmodified responses don't need to be downloaded again.
+    Otherwise, all chunks are downloaded to a temporary directory.
+
+    If the window is split into multiple chunks, they are then merged into a single document
+    with the same layout as the response for the whole window. A single chunk is passed
+    through unchanged.
+    """
+
+    def __init__(
+        self,
+        apikey: str,
+        start: Date,
+        end: Date,
+        cache_dir: Path | None = None,
+        max_age: timedelta = DEFAULT_MAX_AGE,
+        refresh_days: int = DEFAULT_REFRESH_DAYS,
+        max_revalidations: int = DEFAULT_MAX_REVALIDATIONS,
+        chunk_days: int | None = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+        session: requests.Session | None = None,
+    ) -> None:
+        super().__init__()
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be positive, got {concurrency}")
+
+        self.apikey = apikey
+        if chunk_days is None:
+            chunk_days = DEFAULT_CACHED_CHUNK_DAYS if cache_dir else (end - start).days + 1
+        self.chunks = Chunk.split(start, end, chunk_days)
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.refresh_days = refresh_days
+        self.max_revalidations = max_revalidations
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(requests_per_second, concurrency)
+        self.session = session or pooled_session(concurrency)
+        self.window_digest = ""
+
+    def save_extra_metadata(self) -> dict[str, Any] | None:
+        return {"window_digest": self.window_digest} if self.window_digest else None
+
+    def load_extra_metadata(self, metadata: dict[str, Any]) -> None:
+        self.window_digest = metadata.get("window_digest", "")
+
+    def fetch(self, conditional: bool) -> Iterator[bytes]:
+        if self.cache_dir is not None:
+            yield from self.fetch_with_cache(ChunkCache(self.cache_dir), conditional)
+        elif len(self.chunks) == 1:
+            yield from self.fetch_window(conditional)
+        else:
+            with TemporaryDirectory(prefix="schedules-") as temp_dir:
+                yield from self.fetch_with_cache(ChunkCache(Path(temp_dir)), conditional)
+
+    def fetch_with_cache(self, cache: ChunkCache, conditional: bool) -> Iterator[bytes]:
+        cache.load()
+        now = datetime.now(timezone.utc)
+        refresh_until = Date.today().add_days(self.refresh_days)
+        to_fetch = cache.to_fetch(
+            self.chunks,
+            now,
+            self.max_age,
+            refresh_until,
+            self.max_revalidations,
+        )
+        logger.info(
+            "Fetching %d of %d chunks of schedules (others are cached)",
+            len(to_fetch),
+            len(self.chunks),
+        )
+
+        elapsed = time.perf_counter()
+        total_retries = 0
+        not_modified = 0
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="fetch-schedules") as pool:
+            futures = {
+                pool.submit(self.fetch_chunk, chunk, cache.validators(chunk)): chunk
+                for chunk in to_fetch
+            }
+            try:
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    fetched = future.result()
+                    cache.put(chunk, fetched, datetime.now(timezone.utc))
+                    total_retries += fetched.retries
+                    not_modified += fetched.content is None
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        elapsed = time.perf_counter() - elapsed
+
+        if to_fetch:
+            logger.info(
+                "Fetched %d chunks of schedules in %.2f s (%d not modified, %d retries)",
+                len(to_fetch),
+                elapsed,
+                not_modified,
+                total_retries,
+            )
+
+        cache.retain_only(self.chunks)
+        cache.save()
+
+        paths = [cache.path_of(cache.index[chunk.start].digest) for chunk in self.chunks]
+        window_digest = hashlib.sha256("\n".join(i.stem for i in paths).encode()).hexdigest()
+        if conditional and window_digest == self.window_digest:
+            raise InputNotModified
+
+        self.window_digest = window_digest
+        self.fetch_time = now
+        self.last_modified = now
+        if len(paths) == 1:
+            yield from read_chunks(paths[0])
+        else:
+            yield from merge_days(paths)
+
+    def fetch_window(self, conditional: bool) -> Iterator[bytes]:
+        """Downloads the whole window with a single request, without a cache."""
+        now = datetime.now(timezone.utc)
+        content = self.fetch_chunk(self.chunks[0]).content
+        assert content is not None
+
+        # NOTE: Same as the window digest of a cached single chunk
+        digest = hashlib.sha256(content).hexdigest()
+        window_digest = hashlib.sha256(digest.encode()).hexdigest()
+        if conditional and window_digest == self.window_digest:
+            raise InputNotModified
+
+        self.window_digest = window_digest
+        self.fetch_time = now
+        self.last_modified = now
+        yield content
+
+    def fetch_chunk(self, chunk: Chunk, validators: dict[str, str] | None = None) -> FetchedChunk:
+        """Downloads schedules for a single chunk. If `validators` (headers for a conditional
+        request) are provided and the server responds with 304 Not Modified,
+        the returned content is None."""
+        elapsed = time.perf_counter()
+        for attempt in range(MAX_RETRIES + 1):
+            self.bucket.acquire()
+            try:
+                resp = self.session.get(
+                    SCHEDULES_URL,
+                    params={"dateFrom": chunk.start.isoformat(), "dateTo": chunk.end.isoformat()},
+                    headers={"X-Api-Key": self.apikey, **(validators or {})},
+                    timeout=REQUEST_TIMEOUT,
+                )
+            except (requests.Timeout, requests.ConnectionError) as e:
+                # NOTE: Timeouts while reading the body are raised as ConnectionError
+                if attempt >= MAX_RETRIES:
+                    raise
+                delay = min(2.0**attempt, MAX_RETRY_DELAY)
+                logger.warning(
+                    "Request for schedules %s..%s failed (%s), retrying in %.1f s",
+                    chunk.start,
+                    chunk.end,
+                    e,
+                    delay,
+                )
+                time.sleep(delay)
+                continue
+
+            with resp:
+                if resp.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                    delay = parse_retry_after(resp.headers.get("Retry-After"))
+                    if delay is None:
+                        delay = min(2.0**attempt, MAX_RETRY_DELAY)
+                    logger.warning(
+                        "Got HTTP %d for schedules %s..%s, retrying in %.1f s",
+                        resp.status_code,
+                        chunk.start,
+                        chunk.end,
+                        delay,
+                    )
+                    self.bucket.pause(delay)
+                    continue
+
+                resp.raise_for_status()
+                modified = resp.status_code != 304
+                logger.info(
+                    "Fetched schedules %s..%s in %.2f s (%s, %d retries)",
+                    chunk.start,
+                    chunk.end,
+                    time.perf_counter() - elapsed,
+                    "modified" if modified else "not modified",
+                    attempt,
+                )
+                return FetchedChunk(
+                    resp.content if modified else None,
+                    resp.headers.get("ETag", ""),
+                    resp.headers.get("Last-Modified", ""),
+                    attempt,
+                )
+        raise AssertionError("unreachable")
+
+
+def read_chunks(path: Path) -> Iterator[bytes]:
+    with path.open("rb") as f:
+        while chunk := f.read(FETCH_CHUNK_SIZE):
+            yield chunk
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parses the value of a Retry-After header, which is either
+    a number of seconds or an HTTP date, into a number of seconds to wait.
+
+    >>> parse_retry_after("5")
+    5.0
+    >>> parse_retry_after("Thu, 01 Jan 1970 00:00:00 GMT")
+    0.0
+    >>> parse_retry_after("soon") is None
+    True
+    """
+    if not value:
+        return None
+
+    try:
+        return min(max(float(value), 0.0), MAX_RETRY_DELAY)
+    except ValueError:
+        pass
+
+    try:
+        at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    delay = (at - datetime.now(timezone.utc)).total_seconds()
+    return min(max(delay, 0.0), MAX_RETRY_DELAY)
+
+
+@dataclass
+class MergedHeader:
+    ts: str = ""
+    period_from: str = ""
+    period_to: str = ""
+    carriers: dict[str, Any] = field(default_factory=dict[str, Any])
+    categories: dict[str, Any] = field(default_factory=dict[str, Any])
+    stations: dict[str, Any] = field(default_factory=dict[str, Any])
+    operating_days: dict[RouteKey, set[str]] = field(default_factory=dict[RouteKey, set[str]])
+
+
+def merge_days(paths: Iterable[Path]) -> Iterator[bytes]:
+    """Merges multiple responses of the schedules endpoint into a single document.
+
+    The same train is reported in the response of every day it runs on - such trains
+    (identified by their content, apart from the operating days) are emitted only once,
+    with operating days of all responses combined. This is done in two passes over the files,
+    so that only the operating days (and not whole trains) need to be kept in memory.
+    """
+    return _chunked(_merged_parts(list(paths)))
+
+
+def _merged_parts(paths: list[Path]) -> Iterator[str]:
+    header = _merge_headers(paths)
+    period = {"f": header.period_from, "t": header.period_to} if header.period_from else None
+    dictionaries = {"cr": header.carriers, "cc": header.categories, "st": header.stations}
+
+    yield f'{{"ts":{json.dumps(header.ts or None)},"pr":{json.dumps(period)},'
+    yield f'"dc":{json.dumps(dictionaries)},"rt":['
+
+    emitted = set[RouteKey]()
+    for path in paths:
+        with path.open("rb") as f:
+            for route in json.list_iter(f, "rt.item"):
+                key = _route_key(route)
+                if key in emitted:
+                    continue
+                route["od"] = sorted(header.operating_days[key])
+                yield ("," if emitted else "") + json.dumps(route)
+                emitted.add(key)
+
+    yield "]}"
+
+
+def _chunked(parts: Iterable[str]) -> Iterator[bytes]:
+    buffer = list[str]()
+    buffer_len = 0
+    for part in parts:
+        buffer.append(part)
+        buffer_len += len(part)
+        if buffer_len >= FETCH_CHUNK_SIZE:
+            yield "".join(buffer).encode("utf-8")
+            buffer.clear()
+            buffer_len = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def _merge_headers(paths: Iterable[Path]) -> MergedHeader:
+    h = MergedHeader()
+    interned = dict[str, str]()
+    for path in paths:
+        with path.open("rb") as f:
+            for p, key, value in json.stream(f, STREAMED_PATHS):
+                match p:
+                    case "rt.item":
+                        days = h.operating_days.setdefault(_route_key(value), set())
+                        days.update(interned.setdefault(i, i) for i in value["od"])
+                    case "dc.cr.*":
+                        h.carriers[cast(str, key)] = value
+                    case "dc.cc.*":
+                        h.categories[cast(str, key)] = value
+                    case "dc.st.*":
+                        h.stations[cast(str, key)] = value
+                    case "ts":
+                        h.ts = max(h.ts, value or "")
+                    case "pr":
+                        if value:
+                            h.period_from = min(h.period_from or value["f"], value["f"])
+                            h.period_to = max(h.period_to, value["t"])
+                    case _:
+                        raise RuntimeError(f"unexpected json path: {p}")
+    return h
+
+
+def _route_key(route: json.Object) -> RouteKey:
+    # NOTE: Keying on (cc, sid, oid) alone is not enough, as the API sometimes
+    #       returns different trains with the same identifiers.
+    content = {k: v for k, v in route.items() if k != "od"}
+    return hashlib.sha1(json.dumps(content).encode("utf-8")).digest()
@@ -1,23 +1,21 @@
 # SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
 # SPDX-License-Identifier: MIT
 
-from collections import defaultdict
 from collections.abc import Iterable, Mapping, Sequence
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from itertools import groupby
 from operator import itemgetter
 from statistics import mean
+from time import perf_counter
 from typing import Self, cast
-from xml.sax import ContentHandler as XmlSaxContentHandler
-from xml.sax import parse as xml_sax_parse
-from xml.sax.xmlreader import AttributesImpl as XmlSaxAttributes
 
 from impuls import DBConnection, Task, TaskRuntime
 from impuls.model import Stop
 from impuls.tools.geo import initial_bearing
-from impuls.tools.types import StrPath
 
 from .. import json
+from .plrailmap import BusStop, load_plrailmap
+from .stop_remapper import StopRemapper
 
 BEARING_CODE_TO_DEGREES = {
     "N": 0,
@@ -31,54 +29,6 @@ BEARING_CODE_TO_DEGREES = {
 }
 
 
-@dataclass
-class BusStop:
-    station_id: str = ""
-    lat: float = 0.0
-    lon: float = 0.0
-    direction_hints: list[str] = field(default_factory=list[str])
-
-    @property
-    def gtfs_id(self) -> str:
-        if self.direction_hints == [] or self.direction_hints == ["*"]:
-            return f"{self.station_id}_BUS"
-        return f"{self.station_id}_BUS_{self.direction_hints[0]}"
-
-    def __bool__(self) -> bool:
-        return self.station_id != "" and self.lat != 0.0 and self.lon != 0.0
-
-
-class PLRailMapBusStopLoader(XmlSaxContentHandler):
-    def __init__(self) -> None:
-        super().__init__()
-        self.stops = defaultdict[str, list[BusStop]](list)
-        self.current_stop = BusStop()
-        self.is_stop = False
-
-    def startElement(self, name: str, attrs: XmlSaxAttributes) -> None:
-        if name == "node":
-            self.current_stop = BusStop(lat=float(attrs["lat"]), lon=float(attrs["lon"]))
-        elif name == "tag":
-            if attrs["k"] == "highway" and attrs["v"] == "bus_stop":
-                self.is_stop = True
-            if attrs["k"] == "ref:station":
-                self.current_stop.station_id = attrs["v"]
-            elif attrs["k"] == "direction" and attrs["v"]:
-                self.current_stop.direction_hints = attrs["v"].split(";")
-
-    def endElement(self, name: str) -> None:
-        if name == "node":
-            if self.is_stop and self.current_stop:
-                self.stops[self.current_stop.station_id].append(self.current_stop)
-            self.is_stop = False
-
-    @classmethod
-    def load_from_file(cls, path: StrPath) -> defaultdict[str, list[BusStop]]:
-        handler = cls()
-        xml_sax_parse(path, handler)
-        return handler.stops
-
-
 @dataclass
 class StopTime:
     seq: int
@@ -117,21 +67,28 @@ class LoadBusStops(Task):
     def __init__(self) -> None:
         super().__init__()
         self.stop_locations = dict[str, tuple[float, float]]()
+        self.remapper = StopRemapper()
 
     def execute(self, r: TaskRuntime) -> None:
         self.stop_locations = self.load_stop_locations(r.db)
-        curated_bus_stops = PLRailMapBusStopLoader.load_from_file(
-            r.resources["pl_rail_map.osm"].stored_at,
-        )
+        curated_bus_stops = load_plrailmap(r.resources["pl_rail_map.osm"].stored_at).bus_stops
         bus_trips_by_stops = self.group_bus_trips(self.load_bus_trips(r.db))
         uncurated_stations = list[str]()
 
-        for station_id, trips in bus_trips_by_stops.items():
-            if stops := curated_bus_stops.get(station_id):
-                with r.db.transaction():
+        start = perf_counter()
+        with r.db.transaction():
+            self.remapper.begin(r.db)
+            for station_id, trips in bus_trips_by_stops.items():
+                if stops := curated_bus_stops.get(station_id):
                     self.curate_bus_stops(r.db, station_id, stops, trips)
-            else:
-                uncurated_stations.append(station_id)
+                else:
+                    uncurated_stations.append(station_id)
+            remapped = self.remapper.apply(r.db)
+        self.logger.info(
+            "Moved %d stop_times to bus stops in %.2f s",
+            remapped,
+            perf_counter() - start,
+        )
 
         self.warn_about_uncurated_stations(r.db, uncurated_stations)
 
@@ -203,18 +160,8 @@ class LoadBusStops(Task):
         stop_updates: Sequence[StopUpdate],
     ) -> None:
         self.apply_stops(db, station_id, new_stops)
-        db.raw_execute_many(
-            "UPDATE stop_times SET stop_id = ? WHERE trip_id = ? AND stop_sequence = ?",
-            ((i.new_stop_id, i.trip_id, i.stop_sequence) for i in stop_updates),
-        )
-        db.raw_execute_many(
-            "UPDATE transfers SET to_stop_id = ? WHERE to_trip_id = ? AND to_stop_id = ?",
-            ((i.new_stop_id, i.trip_id, i.old_stop_id) for i in stop_updates),
-        )
-        db.raw_execute_many(
-            "UPDATE transfers SET from_stop_id = ? WHERE from_trip_id = ? AND from_stop_id = ?",
-            ((i.new_stop_id, i.trip_id, i.old_stop_id) for i in stop_updates),
-        )
+        for i in stop_updates:
+            self.remapper.remap_stop_time(db, i.trip_id, i.stop_sequence, i.new_stop_id)
 
     def apply_stops(self, db: DBConnection, station_id: str, new_stops: Sequence[BusStop]) -> None:
         preserve_train = has_train_departures(db, station_id)
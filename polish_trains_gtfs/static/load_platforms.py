@@ -1,12 +1,43 @@
-from typing import Any, Dict, List
+from time import perf_counter
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
 import impuls
 import json
 
+from .stop_remapper import StopRemapper
+
+
+class PlatformIndex:
+    """PlatformIndex groups platforms from platforms.json by (station slug, platform)
+    and by (station slug, platform, track), so that finding platforms of a stop doesn't
+    require filtering all platforms of its station."""
+
+    def __init__(self, platforms: Dict[str, List[Dict[str, Any]]]) -> None:
+        self.stations = {station for station, in_station in platforms.items() if in_station}
+        self.by_platform: Dict[Tuple[str, Any], List[Dict[str, Any]]] = {}
+        self.by_track: Dict[Tuple[str, Any, Any], List[Dict[str, Any]]] = {}
+        for station, station_platforms in platforms.items():
+            for p in station_platforms:
+                platform, track = p.get("platform"), p.get("track")
+                self.by_platform.setdefault((station, platform), []).append(p)
+                self.by_track.setdefault((station, platform, track), []).append(p)
+
+    def has_station(self, station: str) -> bool:
+        return station in self.stations
+
+    def find(self, station: str, platform: str) -> List[Dict[str, Any]]:
+        return self.by_platform.get((station, platform), [])
+
+    def find_with_track(self, station: str, platform: str, track: str) -> List[Dict[str, Any]]:
+        return self.by_track.get((station, platform, track), [])
+
 
 class LoadPlatformData(impuls.Task):
     def __init__(self) -> None:
         super().__init__()
-        self.parents_created: Dict[str, impuls.model.Stop] = {}
+        self.parents_to_create: Dict[str, None] = {}
+        self.platforms_to_create: Dict[str, Tuple[Any, ...]] = {}
+        self.remapper = StopRemapper()
 
     @staticmethod
     def load_platforms(
@@ -19,39 +50,42 @@ class LoadPlatformData(impuls.Task):
     def execute(self, r: impuls.TaskRuntime) -> None:
         platforms_in_db = r.db.raw_execute(
             """
-        SELECT DISTINCT name, stop_id, platform, json_extract(stop_times.extra_fields_json, '$.track') AS track
+        SELECT DISTINCT name, stop_id, platform, stop_time_extras.track AS track
         FROM stop_times JOIN stops USING (stop_id)
+        LEFT JOIN stop_time_extras USING (trip_id, stop_sequence)
         """
         ).all()
         self.logger.info(f"Found {len(platforms_in_db)} platforms in DB")
-        platforms = self.load_platforms(r.resources["platforms.json"].stored_at)
+        platforms = PlatformIndex(self.load_platforms(r.resources["platforms.json"].stored_at))
+        start = perf_counter()
+        self.parents_to_create.clear()
+        self.platforms_to_create.clear()
+        with r.db.transaction():
+            self.remapper.begin(r.db)
+            self.create_platforms(r, platforms_in_db, platforms)
+            self.insert_stops(r.db)
+            remapped = self.remapper.apply(r.db)
+        self.logger.info(
+            f"Created {len(self.platforms_to_create)} platforms in "
+            f"{len(self.parents_to_create)} stations and moved {remapped} stop_times "
+            f"to them in {perf_counter() - start:.2f} s"
+        )
+
+    def create_platforms(
+        self,
+        r: impuls.TaskRuntime,
+        platforms_in_db: List[Any],
+        platforms: PlatformIndex,
+    ) -> None:
         for name, stop_id, platform_number, track in platforms_in_db:
             if platform_number == "BUS":
+                # Bus stop_times at a stop are moved to a single platform, regardless of track
                 stop_with_platform_id = f"{stop_id}_BUS"
-                parent_stop = self._ensure_parent_station(r, str(stop_id))
-                try:
-                    r.db.create(
-                        impuls.model.Stop(
-                            id=stop_with_platform_id,
-                            name=str(name),
-                            parent_station=parent_stop.id,
-                            location_type=impuls.model.Stop.LocationType.STOP,
-                            platform_code="BUS",
-                            lat=parent_stop.lat,
-                            lon=parent_stop.lon,
-                        )
-                    )
-                    r.db.raw_execute(
-                        """
-                        UPDATE stop_times
-                        SET stop_id = ?
-                        WHERE stop_id = ? AND platform = ?
-                        """,
-                        (stop_with_platform_id, stop_id, platform_number),
-                    )
-                except Exception as e:
-                    self.logger.warning(
-                        f"Error creating Bus stop {stop_with_platform_id}: {e}, skipping"
+                if stop_with_platform_id not in self.platforms_to_create:
+                    self.parents_to_create[str(stop_id)] = None
+                    self._add_platform(stop_with_platform_id, stop_id, name, "BUS")
+                    self.remapper.remap_platform(
+                        r.db, str(stop_id), "BUS", stop_with_platform_id
                     )
                 continue
 
@@ -59,19 +93,15 @@ class LoadPlatformData(impuls.Task):
                 continue
 
             stop_with_platform_id = f"{stop_id}_{platform_number}_{track}"
-            platforms_for_station = platforms.get(slug(str(name)), [])
-            if len(platforms_for_station) == 0:
+            station = slug(str(name))
+            if not platforms.has_station(station):
                 self.logger.warning(f"Station not found {name}")
                 continue
-            platforms_for_platform_number = [
-                p for p in platforms_for_station if p.get("platform") == platform_number
-            ]
+            platforms_for_platform_number = platforms.find(station, platform_number)
             if len(platforms_for_platform_number) == 1:
                 platform = platforms_for_platform_number[0]
             elif len(platforms_for_platform_number) > 1:
-                platforms_for_track = [
-                    p for p in platforms_for_platform_number if p.get("track") == track
-                ]
+                platforms_for_track = platforms.find_with_track(station, platform_number, track)
                 if len(platforms_for_track) == 1:
                     platform = platforms_for_track[0]
                 elif len(platforms_for_track) > 1:
@@ -90,7 +120,7 @@ class LoadPlatformData(impuls.Task):
                 )
                 continue
 
-            parent_stop = self._ensure_parent_station(r, str(stop_id))
+            self.parents_to_create[str(stop_id)] = None
 
             if platform.get("exact_location") == False:
                 self.logger.debug(
@@ -101,78 +131,86 @@ class LoadPlatformData(impuls.Task):
                 self.logger.error(
                     f"Platform {name} track {track} has no location, falling back to parent stop"
                 )
-                location = [parent_stop.lon, parent_stop.lat]
-
-            r.db.create(
-                impuls.model.Stop(
-                    id=stop_with_platform_id,
-                    name=str(name),
-                    parent_station=parent_stop.id,
-                    location_type=impuls.model.Stop.LocationType.STOP,
-                    platform_code=f"{platform_number}/{track}",
-                    lon=location[0],
-                    lat=location[1],
-                )
+                location = [None, None]
+
+            self._add_platform(
+                stop_with_platform_id,
+                stop_id,
+                name,
+                f"{platform_number}/{track}",
+                lon=location[0],
+                lat=location[1],
             )
-            r.db.raw_execute(
-                """
-                UPDATE stop_times
-                SET stop_id = ?
-                WHERE stop_id = ? AND platform = ? AND json_extract(extra_fields_json, '$.track') = ?
-                """,
-                (stop_with_platform_id, stop_id, platform_number, track),
+            self.remapper.remap_platform(
+                r.db, str(stop_id), str(platform_number), stop_with_platform_id, str(track)
             )
 
-    def _ensure_parent_station(
-        self, r: impuls.TaskRuntime, stop_id: str
-    ) -> impuls.model.Stop:
-        parent_id = f"{stop_id}_parent"
-        if parent_id not in self.parents_created.keys():
-            no_platform_stop = r.db.retrieve_must(impuls.model.Stop, stop_id)
-            parent_stop = impuls.model.Stop(
-                id=parent_id,
-                name=no_platform_stop.name,
-                location_type=impuls.model.Stop.LocationType.STATION,
-                lon=no_platform_stop.lon,
-                lat=no_platform_stop.lat,
-            )
-            r.db.create(parent_stop)
-
-            self.parents_created[parent_id] = parent_stop
-            no_platform_stop.parent_station = parent_id
-            r.db.update(no_platform_stop)
-
-        return self.parents_created[parent_id]
+    def _add_platform(
+        self,
+        stop_with_platform_id: str,
+        stop_id: str,
+        name: str,
+        platform_code: str,
+        lon: float | None = None,
+        lat: float | None = None,
+    ) -> None:
+        self.platforms_to_create[stop_with_platform_id] = (
+            stop_with_platform_id,
+            str(name),
+            platform_code,
+            lat,
+            lon,
+            stop_id,
+        )
+
+    def insert_stops(self, db: impuls.DBConnection) -> None:
+        """Creates all collected parent stations and platforms. Parent stations take
+        the name and location of their stop, platforms without a location are placed
+        at their parent station."""
+        db.raw_execute_many(
+            """
+            INSERT INTO stops (stop_id, name, lat, lon, location_type)
+            SELECT stop_id || '_parent', name, lat, lon, 1 FROM stops WHERE stop_id = ?
+            """,
+            ((i,) for i in self.parents_to_create),
+        )
+        db.raw_execute_many(
+            "UPDATE stops SET parent_station = stop_id || '_parent' WHERE stop_id = ?",
+            ((i,) for i in self.parents_to_create),
+        )
+        db.raw_execute_many(
+            """
+            INSERT INTO stops (stop_id, name, platform_code, lat, lon, parent_station)
+            SELECT ?, ?, ?, coalesce(?, lat), coalesce(?, lon), stop_id || '_parent'
+            FROM stops WHERE stop_id = ?
+            """,
+            self.platforms_to_create.values(),
+        )
 
 
 class FixTransferPlatforms(impuls.Task):
     def execute(self, r: impuls.TaskRuntime):
-        transfers = r.db.retrieve_all(impuls.model.Transfer)
+        # Transfers go from the last stop of from_trip to the first stop of to_trip.
+        # Both are looked up through the (trip_id, stop_sequence) primary key of stop_times.
+        start = perf_counter()
         with r.db.transaction():
-            for transfer in transfers:
-                from_trip_stop = r.db.raw_execute(
-                    """
-                    SELECT stop_id
-                    FROM stop_times
-                    WHERE trip_id = (?)
-                    ORDER BY stop_sequence DESC
-                    LIMIT 1
-                    """,
-                    (transfer.from_trip_id, ),
-                ).all()[0][0]
-                to_trip_stop = r.db.raw_execute(
-                    """
-                    SELECT stop_id
-                    FROM stop_times
-                    WHERE trip_id = (?)
-                    ORDER BY stop_sequence ASC
-                    LIMIT 1
-                    """,
-                    (transfer.to_trip_id,),
-                ).all()[0][0]
-                transfer.to_stop_id = str(to_trip_stop)
-                transfer.from_stop_id = str(from_trip_stop)
-                r.db.update(transfer)
+            updated = r.db.raw_execute(
+                """
+                UPDATE transfers SET
+                    from_stop_id = (
+                        SELECT stop_id FROM stop_times
+                        WHERE stop_times.trip_id = transfers.from_trip_id
+                        ORDER BY stop_sequence DESC LIMIT 1
+                    ),
+                    to_stop_id = (
+                        SELECT stop_id FROM stop_times
+                        WHERE stop_times.trip_id = transfers.to_trip_id
+                        ORDER BY stop_sequence ASC LIMIT 1
+                    )
+                WHERE from_trip_id IS NOT NULL AND to_trip_id IS NOT NULL
+                """
+            ).rowcount
+        self.logger.info(f"Fixed stops of {updated} transfers in {perf_counter() - start:.2f} s")
 
 
 import re
@@ -193,6 +231,7 @@ TRANSLATION_TABLE = str.maketrans(
 )
 
 
+@lru_cache(maxsize=None)
 def slug(s: str) -> str:
     text = s.translate(TRANSLATION_TABLE)
     return re.sub(r"[ -]+", "-", re.sub(r"[^\x00-\x7F]+", "", text)).lower()
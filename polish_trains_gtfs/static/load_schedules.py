@@ -1,10 +1,15 @@
 # SPDX-FileCopyrightText: 2025-2026 Mikołaj Kuranowski
 # SPDX-License-Identifier: MIT
 
-from collections.abc import Iterable
-from datetime import datetime, timezone
+import logging
+import multiprocessing
+from collections import deque
+from collections.abc import Iterable, Iterator
+from datetime import date, datetime, timezone
+from multiprocessing.pool import AsyncResult
 from operator import itemgetter
-from typing import IO, cast
+from time import perf_counter
+from typing import IO, Any, NamedTuple, Self, cast
 from zoneinfo import ZoneInfo
 
 from impuls import DBConnection, Task, TaskRuntime
@@ -12,7 +17,9 @@ from impuls.model import Attribution, Date, FeedInfo
 from impuls.tools.strings import find_non_conflicting_id
 
 from .. import json
-from ..calendar import CalendarGenerator
+from ..batch import DEFAULT_BATCH_SIZE, BatchWriter
+from ..calendar import CalendarGenerator, DateSet, to_date_set
+from . import stop_time_extras
 
 AGENCY_ID_NORMALIZER = {
     "KMŁ": "KML",
@@ -26,36 +33,148 @@ DAY = 24 * HOUR
 
 TZ = ZoneInfo("Europe/Warsaw")
 
+STREAMED_PATHS = ("ts", "pr", "dc.cr.*", "dc.cc.*", "dc.st.*", "rt.item")
+
+DEFAULT_UPDATE_TIMESTAMP = datetime.min.replace(tzinfo=timezone.utc)
+DEFAULT_FEED_DATES = (Date(1, 1, 1), Date(1, 1, 1))
+
+ROUTES_PER_TASK = 256
+
+LogMessage = tuple[int, str, tuple[Any, ...]]
+"""LogMessage is a (level, msg, args) tuple. The first argument of msg is always the trip_id,
+which is only known after the route is applied, and thus not included in args."""
+
+
+class ConvertedStopTime(NamedTuple):
+    stop_id: int
+    arrival_time: int | None  # None if the train has no times at this stop
+    departure_time: int | None
+    platform: str
+    extras: tuple[str | int, ...]  # values for stop_time_extras.COLUMNS
+
+
+class ConvertedRoute(NamedTuple):
+    carrier_code: str
+    operating_days: DateSet
+    schedule_id: str
+    order_id: str
+    route_code: str
+    display_number: str
+    extra_fields_json: str
+    stop_times: list[ConvertedStopTime]
+    messages: list[LogMessage]
+
 
 class LoadSchedules(Task):
-    def __init__(self, r: str = "schedules.json") -> None:
+    def __init__(
+        self,
+        r: str = "schedules.json",
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        jobs: int = 1,
+    ) -> None:
         super().__init__()
         self.r = r
+        self.jobs = jobs
+
+        self.trips = BatchWriter(
+            "INSERT INTO trips (trip_id, route_id, calendar_id, short_name, extra_fields_json) "
+            "VALUES (?, ?, ?, ?, ?)",
+            batch_size,
+        )
+        self.stop_times = BatchWriter(
+            "INSERT INTO stop_times (trip_id, stop_sequence, stop_id, arrival_time, "
+            "departure_time, platform) VALUES (?, ?, ?, ?, ?, ?)",
+            batch_size,
+            before_flush=self.trips,
+        )
+        self.stop_time_extras = BatchWriter(
+            stop_time_extras.INSERT_SQL,
+            batch_size,
+            before_flush=self.stop_times,
+        )
 
         self.calendars = CalendarGenerator("PLK_")
         self.agency_names = dict[str, str]()
         self.route_names = dict[str, str]()
         self.stop_names = dict[int, str]()
         self.used_trip_ids = set[str]()
+        self.inserted_agency_ids = set[str]()
+        self.inserted_route_ids = set[str]()
+        self.inserted_stop_ids = set[int]()
+        self.update_timestamp = DEFAULT_UPDATE_TIMESTAMP
+        self.feed_dates = DEFAULT_FEED_DATES
 
     def clear(self) -> None:
+        self.trips.clear()
+        self.stop_times.clear()
+        self.stop_time_extras.clear()
         self.calendars.clear()
         self.agency_names.clear()
         self.route_names.clear()
         self.stop_names.clear()
         self.used_trip_ids.clear()
+        self.inserted_agency_ids.clear()
+        self.inserted_route_ids.clear()
+        self.inserted_stop_ids.clear()
+        self.update_timestamp = DEFAULT_UPDATE_TIMESTAMP
+        self.feed_dates = DEFAULT_FEED_DATES
 
     def execute(self, r: TaskRuntime) -> None:
         self.clear()
+        start = perf_counter()
+
+        with r.resources[self.r].open_binary() as f, r.db.transaction():
+            stop_time_extras.create_table(r.db)
+            self.create_attributions(r.db)
+            self.load(r.db, f)
+            self.stop_time_extras.flush(r.db)
+            self.load_feed_info(r.db)
+            self.fill_missing_names(r.db)
+
+        elapsed = perf_counter() - start
+        rows = self.trips.written + self.stop_times.written
+        self.logger.info(
+            "Loaded %d trips and %d stop times in %.1f s (%.0f rows/s)",
+            self.trips.written,
+            self.stop_times.written,
+            elapsed,
+            rows / elapsed if elapsed > 0 else 0.0,
+        )
 
-        with r.resources[self.r].open_binary() as f:
-            self.load_agencies(f)
-            self.load_routes(f)
-            self.load_stops(f)
-            with r.db.transaction():
-                self.create_attributions(r.db)
-                self.load_feed_info(r.db, f)
-                self.load_schedules(r.db, f)
+    def load(self, db: DBConnection, f: IO[bytes]) -> None:
+        # All sections of the file are read in a single pass, in whatever order they come in.
+        # Routes are inserted as soon as they are converted, even if the dictionaries
+        # are not yet known - see fill_missing_names.
+        with RouteConverter(self.jobs) as converter:
+            for path, key, value in json.stream(f, STREAMED_PATHS):
+                self.load_value(db, converter, path, key, value)
+            for route in converter.drain():
+                self.apply_route(db, route)
+
+    def load_value(
+        self,
+        db: DBConnection,
+        converter: "RouteConverter",
+        path: str,
+        key: str | None,
+        value: Any,
+    ) -> None:
+        match path:
+            case "rt.item":
+                for route in converter.submit(value):
+                    self.apply_route(db, route)
+            case "dc.st.*":
+                self.stop_names[value["id"]] = value.get("nm", "")
+            case "dc.cr.*":
+                self.agency_names[cast(str, key).strip()] = value
+            case "dc.cc.*":
+                self.route_names[cast(str, key)] = value
+            case "ts":
+                self.update_timestamp = parse_update_timestamp(value)
+            case "pr":
+                self.feed_dates = parse_feed_dates(value)
+            case _:
+                raise RuntimeError(f"unexpected json path: {path}")
 
     def create_attributions(self, db: DBConnection) -> None:
         db.create_many(
@@ -77,12 +196,12 @@ class LoadSchedules(Task):
             ),
         )
 
-    def load_feed_info(self, db: DBConnection, f: IO[bytes]) -> None:
-        timestamp = self.load_update_timestamp(f).astimezone(TZ)
+    def load_feed_info(self, db: DBConnection) -> None:
+        timestamp = self.update_timestamp.astimezone(TZ)
 
         # Shift start_date by one, as the very first day will be missing night trains
         # starting two days ago. This means, that only start_date+1 has full schedules available.
-        start_date, end_date = self.load_feed_dates(f)
+        start_date, end_date = self.feed_dates
         start_date = start_date.add_days(1)
 
         db.create(
@@ -96,210 +215,84 @@ class LoadSchedules(Task):
             )
         )
 
-    @staticmethod
-    def load_update_timestamp(f: IO[bytes]) -> datetime:
-        if ts := json.first(f, "ts"):
-            return datetime.fromisoformat(ts)
-        return datetime.min.replace(tzinfo=timezone.utc)
-
-    @staticmethod
-    def load_feed_dates(f: IO[bytes]) -> tuple[Date, Date]:
-        if pr := json.first(f, "pr"):
-            start = Date.from_ymd_str(pr["f"][:10])
-            end = Date.from_ymd_str(pr["t"][:10])
-        else:
-            start = Date(1, 1, 1)
-            end = Date(1, 1, 1)
-        return start, end
-
-    def load_stops(self, f: IO[bytes]) -> None:
-        for _, stop in json.object_iter(f, "dc.st"):
-            self.stop_names[stop["id"]] = stop.get("nm", "")
-
-    def load_agencies(self, f: IO[bytes]) -> None:
-        for id, name in json.object_iter(f, "dc.cr"):
-            self.agency_names[id.strip()] = name
-
-    def load_routes(self, f: IO[bytes]) -> None:
-        for code, name in json.object_iter(f, "dc.cc"):
-            self.route_names[code] = name
-
-    def load_schedules(self, db: DBConnection, f: IO[bytes]) -> None:
-        for route in json.list_iter(f, "rt.item"):
-            self.process_route(db, route)
-
-    def process_route(self, db: DBConnection, r: json.Object) -> None:
-        agency_id = self.get_agency_id(db, r["cc"])
-        calendar_id = self.calendars.upsert(db, (Date.from_ymd_str(i[:10]) for i in r["od"]))
-        schedule_id = str(r["sid"])
-        order_id = str(r["oid"])
-        trip_id = self.get_trip_id(agency_id, schedule_id, order_id)
-
-        route_code = self.resolve_route_code(r)
-        route_id = self.get_route_id(db, agency_id, route_code)
-
-        plk_number = self.resolve_plk_number(r)
-        display_number = get_fallback(r, "idn", "ian", default=plk_number)
-        plk_name = get_fallback(r, "nm", default="")
-
-        extra_fields = json.dumps(
-            {
-                "plk_category_code": route_code,
-                "plk_train_number": plk_number,
-                "plk_train_name": plk_name,
-            }
+    def fill_missing_names(self, db: DBConnection) -> None:
+        # Dictionaries may come after the routes which reference them,
+        # in which case the agencies, routes and stops were inserted without names.
+        db.raw_execute_many(
+            "UPDATE agencies SET name = ? WHERE agency_id = ? AND name = ''",
+            (
+                (name, AGENCY_ID_NORMALIZER.get(code, code))
+                for code, name in self.agency_names.items()
+            ),
         )
-
-        db.raw_execute(
-            "INSERT INTO trips (trip_id, route_id, calendar_id, short_name, extra_fields_json) "
-            "VALUES (?, ?, ?, ?, ?)",
-            (trip_id, route_id, calendar_id, display_number, extra_fields),
+        db.raw_execute_many(
+            "UPDATE routes SET long_name = ? WHERE short_name = ? AND long_name = ''",
+            ((name, code) for code, name in self.route_names.items()),
+        )
+        db.raw_execute_many(
+            "UPDATE stops SET name = ? WHERE stop_id = ? AND name = ''",
+            ((name, id) for id, name in self.stop_names.items() if name),
         )
 
-        route_stations = cast(list[json.Object], r["st"])
-        route_stations.sort(key=itemgetter("ord"))
-        for i, route_station in enumerate(route_stations):
-            self.process_route_stop(db, trip_id, i, route_station)
+    def apply_route(self, db: DBConnection, r: ConvertedRoute) -> None:
+        agency_id = self.get_agency_id(db, r.carrier_code)
+        calendar_id = self.calendars.upsert_set(db, r.operating_days)
+        trip_id = self.get_trip_id(agency_id, r.schedule_id, r.order_id)
+        route_id = self.get_route_id(db, agency_id, r.route_code)
 
-    def process_route_stop(
-        self,
-        db: DBConnection,
-        trip_id: str,
-        sequence: int,
-        s: json.Object,
-    ) -> None:
-        stop_id = self.get_stop_id(db, s["id"])
-        plk_sequence = cast(int, s["ord"])
-
-        arrival_time = s.get("atm")
-        arrival_day = s.get("ady") or 0
-        departure_time = s.get("dtm")
-        departure_day = s.get("ddy") or 0
-
-        if arrival_time and departure_time:
-            pass  # separate arrival and departure times
-        elif arrival_time:
-            departure_time = arrival_time
-            departure_day = arrival_day
-        elif departure_time:
-            arrival_time = departure_time
-            arrival_day = departure_day
-        else:
-            self.logger.warning(
-                "Trip %s has no time at stop %d (plk_seq %d)",
-                trip_id,
-                stop_id,
-                plk_sequence,
-            )
-            return
+        for level, msg, args in r.messages:
+            self.logger.log(level, msg, trip_id, *args)
 
-        arrival = parse_time(arrival_time, arrival_day)
-        departure = parse_time(departure_time, departure_day)
-
-        arr_platform = s.get("apl", "")
-        dep_platform = s.get("dpl", "")
-        arr_track = s.get("atr", "")
-        dep_track = s.get("dtr", "")
-
-        extra_fields = json.dumps(
-            {
-                "track": dep_track or arr_track,
-                "plk_category_code": get_fallback(s, "dcc", "acc", default=""),
-                "plk_sequence": str(plk_sequence),
-                "arrival_cc": s.get("acc", ""),
-                "departure_cc": s.get("dcc", ""),
-                "arrival_platform": s.get("apl", ""),
-                "departure_platform": s.get("dpl", ""),
-                "arrival_track": s.get("atr", ""),
-                "departure_track": s.get("dtr", ""),
-            }
-        )
-
-        aplatform = s.get("apl")
-        dplatform = s.get("dpl")
+        self.trips.add(db, (trip_id, route_id, calendar_id, r.display_number, r.extra_fields_json))
 
-        if aplatform != dplatform and None not in [aplatform, dplatform] and "BUS" not in [aplatform, dplatform]:
-            self.logger.info(f"Mismatch platform on {trip_id}: {aplatform} != {dplatform}")
+        for sequence, st in enumerate(r.stop_times):
+            stop_id = self.get_stop_id(db, st.stop_id)
+            if st.arrival_time is None:
+                continue
 
-        db.raw_execute(
-            "INSERT INTO stop_times (trip_id, stop_sequence, stop_id, arrival_time, "
-            "departure_time, platform, extra_fields_json) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (
-                trip_id,
-                sequence,
-                stop_id,
-                arrival,
-                departure,
-                dep_platform or arr_platform,
-                extra_fields,
-            ),
-        )
+            self.stop_times.add(
+                db,
+                (trip_id, sequence, stop_id, st.arrival_time, st.departure_time, st.platform),
+            )
+            self.stop_time_extras.add(db, (trip_id, sequence, *st.extras))
 
     def get_agency_id(self, db: DBConnection, carrier_code: str) -> str:
-        agency_id = carrier_code.strip()
-        agency_id = AGENCY_ID_NORMALIZER.get(agency_id, agency_id)
+        agency_id = normalize_agency_id(carrier_code)
+        if agency_id in self.inserted_agency_ids:
+            return agency_id
+
         db.raw_execute(
             "INSERT OR IGNORE INTO agencies (agency_id, name, url, timezone, lang) "
             "VALUES (?, ?, 'https://example.com/', 'Europe/Warsaw', 'pl')",
             (agency_id, self.agency_names.get(carrier_code, "")),
         )
+        self.inserted_agency_ids.add(agency_id)
         return agency_id
 
     def get_route_id(self, db: DBConnection, agency_id: str, route_code: str) -> str:
         route_id = f"{agency_id}_{route_code}"
+        if route_id in self.inserted_route_ids:
+            return route_id
+
         db.raw_execute(
             "INSERT OR IGNORE INTO routes (route_id, agency_id, short_name, long_name, type) "
             "VALUES (?, ?, ?, ?, 2)",
             (route_id, agency_id, route_code, self.route_names.get(route_code, "")),
         )
+        self.inserted_route_ids.add(route_id)
         return route_id
 
     def get_stop_id(self, db: DBConnection, stop_id: int) -> int:
+        if stop_id in self.inserted_stop_ids:
+            return stop_id
+
         db.raw_execute(
             "INSERT OR IGNORE INTO stops (stop_id, name, lat, lon) VALUES (?, ?, 0, 0)",
             (stop_id, self.stop_names.get(stop_id, "")),
         )
+        self.inserted_stop_ids.add(stop_id)
         return stop_id
 
-    def resolve_plk_number(self, route: json.Object) -> str:
-        # Collect all unique numbers from the route stops. Note that the order matters.
-        international_number = get_fallback(route, "idn", "ian", default="")
-        seen_numbers = set[str]()
-        numbers = list[str]()
-        for s in route["st"]:
-            a = get_fallback(s, "dtn", "atn", default="").lstrip("0")
-            is_invalid = "brak" in a or "/" in a
-            is_international = a == international_number or len(a) <= 3
-            if a and not is_invalid and not is_international and a not in seen_numbers:
-                seen_numbers.add(a)
-                numbers.append(a)
-
-        # XXX: Hotfix for longer, undetected international numbers
-        # In particular: [1014, 41022, 41023] and [14022, 14023, 1014]
-        if any(len(i) == 4 for i in numbers) and any(len(i) == 5 for i in numbers):
-            numbers = [i for i in numbers if len(i) == 5]
-
-        # Resolve all used numbers into a human-readable string
-        match numbers:
-            case [a]:
-                return a
-            case [a, b] if can_numbers_be_combined(a, b):
-                return f"{a}/{b[-1]}"
-            case _:
-                if numbers:
-                    self.logger.warning("Don't know how to combine train numbers %r", numbers)
-                fallback = route.get("nn") or international_number
-                if not fallback:
-                    raise ValueError("train with absolutely no numbers")
-                return fallback
-
-    def resolve_route_code(self, route: json.Object) -> str:
-        categories = {c for s in route["st"] if (c := get_fallback(s, "dcc", "acc", default=""))}
-        if categories:
-            return "/".join(sorted(categories))
-        else:
-            return route["ccs"]
-
     def get_trip_id(self, agency_id: str, schedule_id: str, order_id: str) -> str:
         base = "_".join(("PLK", agency_id, schedule_id, order_id))
         id = find_non_conflicting_id(self.used_trip_ids, base, "_")
@@ -309,6 +302,222 @@ class LoadSchedules(Task):
         return id
 
 
+class RouteConverter:
+    """RouteConverter turns routes from the schedules into :py:class:`ConvertedRoute` objects.
+
+    With more than one job, routes are converted in batches by a pool of worker processes.
+    Results are always returned in submission order, so that trip_ids are assigned
+    exactly the same as in a single-process run.
+    """
+
+    def __init__(self, jobs: int = 1, routes_per_task: int = ROUTES_PER_TASK) -> None:
+        self.pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        self.max_pending = 2 * jobs
+        self.routes_per_task = routes_per_task
+        self.batch = list[json.Object]()
+        self.pending = deque[AsyncResult[list[ConvertedRoute]]]()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def submit(self, route: json.Object) -> Iterator[ConvertedRoute]:
+        """Submits a route for conversion, returning an iterator over
+        routes (submitted earlier) whose conversion has finished."""
+        if not self.pool:
+            yield convert_route(route)
+            return
+
+        self.batch.append(route)
+        if len(self.batch) >= self.routes_per_task:
+            self.submit_batch()
+            while len(self.pending) > self.max_pending:
+                yield from self.pending.popleft().get()
+
+    def drain(self) -> Iterator[ConvertedRoute]:
+        """Returns an iterator over all submitted routes, which haven't been returned yet."""
+        if self.batch:
+            self.submit_batch()
+        while self.pending:
+            yield from self.pending.popleft().get()
+
+    def submit_batch(self) -> None:
+        assert self.pool
+        self.pending.append(self.pool.apply_async(convert_routes, (self.batch,)))
+        self.batch = []
+
+
+def convert_routes(routes: list[json.Object]) -> list[ConvertedRoute]:
+    return [convert_route(r) for r in routes]
+
+
+def convert_route(r: json.Object) -> ConvertedRoute:
+    messages = list[LogMessage]()
+    route_code = resolve_route_code(r)
+    plk_number = resolve_plk_number(r, messages)
+    display_number = get_fallback(r, "idn", "ian", default=plk_number)
+    plk_name = get_fallback(r, "nm", default="")
+
+    extra_fields = json.dumps(
+        {
+            "plk_category_code": route_code,
+            "plk_train_number": plk_number,
+            "plk_train_name": plk_name,
+        }
+    )
+
+    route_stations = cast(list[json.Object], r["st"])
+    route_stations.sort(key=itemgetter("ord"))
+
+    return ConvertedRoute(
+        carrier_code=r["cc"],
+        operating_days=to_date_set(date.fromisoformat(i[:10]) for i in r["od"]),
+        schedule_id=str(r["sid"]),
+        order_id=str(r["oid"]),
+        route_code=route_code,
+        display_number=display_number,
+        extra_fields_json=extra_fields,
+        stop_times=[convert_route_stop(s, messages) for s in route_stations],
+        messages=messages,
+    )
+
+
+def convert_route_stop(s: json.Object, messages: list[LogMessage]) -> ConvertedStopTime:
+    stop_id = cast(int, s["id"])
+    plk_sequence = cast(int, s["ord"])
+
+    arrival_time = s.get("atm")
+    arrival_day = s.get("ady") or 0
+    departure_time = s.get("dtm")
+    departure_day = s.get("ddy") or 0
+
+    if arrival_time and departure_time:
+        pass  # separate arrival and departure times
+    elif arrival_time:
+        departure_time = arrival_time
+        departure_day = arrival_day
+    elif departure_time:
+        arrival_time = departure_time
+        arrival_day = departure_day
+    else:
+        messages.append(
+            (
+                logging.WARNING,
+                "Trip %s has no time at stop %d (plk_seq %d)",
+                (stop_id, plk_sequence),
+            )
+        )
+        return ConvertedStopTime(stop_id, None, None, "", ())
+
+    arrival = parse_time(arrival_time, arrival_day)
+    departure = parse_time(departure_time, departure_day)
+
+    arr_platform = s.get("apl", "")
+    dep_platform = s.get("dpl", "")
+    arr_track = s.get("atr", "")
+    dep_track = s.get("dtr", "")
+
+    extras = (
+        dep_track or arr_track,
+        get_fallback(s, "dcc", "acc", default=""),
+        plk_sequence,
+        s.get("acc", ""),
+        s.get("dcc", ""),
+        arr_platform,
+        dep_platform,
+        arr_track,
+        dep_track,
+    )
+
+    aplatform = s.get("apl")
+    dplatform = s.get("dpl")
+
+    if aplatform != dplatform and None not in [aplatform, dplatform] and "BUS" not in [aplatform, dplatform]:
+        messages.append(
+            (logging.INFO, "Mismatch platform on %s: %s != %s", (aplatform, dplatform))
+        )
+
+    return ConvertedStopTime(
+        stop_id,
+        arrival,
+        departure,
+        dep_platform or arr_platform,
+        extras,
+    )
+
+
+def resolve_plk_number(route: json.Object, messages: list[LogMessage]) -> str:
+    # Collect all unique numbers from the route stops. Note that the order matters.
+    international_number = get_fallback(route, "idn", "ian", default="")
+    seen_numbers = set[str]()
+    numbers = list[str]()
+    for s in route["st"]:
+        a = get_fallback(s, "dtn", "atn", default="").lstrip("0")
+        is_invalid = "brak" in a or "/" in a
+        is_international = a == international_number or len(a) <= 3
+        if a and not is_invalid and not is_international and a not in seen_numbers:
+            seen_numbers.add(a)
+            numbers.append(a)
+
+    # XXX: Hotfix for longer, undetected international numbers
+    # In particular: [1014, 41022, 41023] and [14022, 14023, 1014]
+    if any(len(i) == 4 for i in numbers) and any(len(i) == 5 for i in numbers):
+        numbers = [i for i in numbers if len(i) == 5]
+
+    # Resolve all used numbers into a human-readable string
+    match numbers:
+        case [a]:
+            return a
+        case [a, b] if can_numbers_be_combined(a, b):
+            return f"{a}/{b[-1]}"
+        case _:
+            if numbers:
+                messages.append(
+                    (
+                        logging.WARNING,
+                        "Trip %s: don't know how to combine train numbers %r",
+                        (numbers,),
+                    )
+                )
+            fallback = route.get("nn") or international_number
+            if not fallback:
+                raise ValueError("train with absolutely no numbers")
+            return fallback
+
+
+def resolve_route_code(route: json.Object) -> str:
+    categories = {c for s in route["st"] if (c := get_fallback(s, "dcc", "acc", default=""))}
+    if categories:
+        return "/".join(sorted(categories))
+    else:
+        return route["ccs"]
+
+
+def normalize_agency_id(carrier_code: str) -> str:
+    agency_id = carrier_code.strip()
+    return AGENCY_ID_NORMALIZER.get(agency_id, agency_id)
+
+
+def parse_update_timestamp(ts: str | None) -> datetime:
+    if ts:
+        return datetime.fromisoformat(ts)
+    return DEFAULT_UPDATE_TIMESTAMP
+
+
+def parse_feed_dates(pr: json.Object | None) -> tuple[Date, Date]:
+    if pr:
+        return Date.from_ymd_str(pr["f"][:10]), Date.from_ymd_str(pr["t"][:10])
+    return DEFAULT_FEED_DATES
+
+
 def parse_time(x: str, day_offset: int = 0) -> int:
     parts = x.split(":")
     if len(parts) == 2:
@@ -1,76 +1,36 @@
 # SPDX-FileCopyrightText: 2025-2026 Mikołaj Kuranowski
 # SPDX-License-Identifier: MIT
 
-
-from dataclasses import dataclass
-from pathlib import Path
+from time import perf_counter
 from typing import cast
-from xml.sax import ContentHandler as XmlSaxContentHandler
-from xml.sax import parse as xml_sax_parse
-from xml.sax.xmlreader import AttributesImpl as XmlSaxAttributes
 
 import impuls
 
 from .. import json
-
-
-@dataclass
-class Station:
-    id: str = ""
-    name: str = ""
-    lat: float = 0.0
-    lon: float = 0.0
-    extra_id: str = ""
-    country: str = ""
-
-    def __bool__(self) -> bool:
-        return bool(self.id and self.name and self.lat and self.lon)
-
-
-class PLRailMapLoader(XmlSaxContentHandler):
-    def __init__(self) -> None:
-        super().__init__()
-        self.stations = list[Station]()
-        self.current_station = Station()
-
-    def startElement(self, name: str, attrs: XmlSaxAttributes) -> None:
-        if name == "node":
-            self.current_station = Station(lat=float(attrs["lat"]), lon=float(attrs["lon"]))
-        elif name == "tag":
-            if attrs["k"] == "ref":
-                self.current_station.id = attrs["v"]
-            elif attrs["k"] == "ref:2":
-                self.current_station.extra_id = attrs["v"]
-            elif attrs["k"] == "name":
-                self.current_station.name = attrs["v"]
-            elif attrs["k"] == "country":
-                self.current_station.country = attrs["v"]
-
-    def endElement(self, name: str) -> None:
-        if name == "node" and self.current_station:
-            self.stations.append(self.current_station)
-
-    @classmethod
-    def load_from_file(cls, path: Path) -> list[Station]:
-        handler = cls()
-        xml_sax_parse(path, handler)
-        return handler.stations
+from .plrailmap import Station, load_plrailmap
+from .stop_remapper import StopRemapper
 
 
 class LoadStops(impuls.Task):
     def __init__(self) -> None:
         super().__init__()
         self.to_update = dict[str, str]()
+        self.merged = set[str]()
+        self.remapper = StopRemapper()
 
     def execute(self, r: impuls.TaskRuntime) -> None:
         self.to_update = {
             cast(str, i[0]): cast(str, i[1])
             for i in r.db.raw_execute("SELECT stop_id, name FROM stops")
         }
-        stations = PLRailMapLoader.load_from_file(r.resources["pl_rail_map.osm"].stored_at)
+        stations = load_plrailmap(r.resources["pl_rail_map.osm"].stored_at).stations
+        start = perf_counter()
         with r.db.transaction():
+            self.remapper.begin(r.db)
             for station in stations:
                 self._apply(station, r.db)
+            self._apply_merges(r.db)
+        self.logger.info("Updated stops in %.2f s", perf_counter() - start)
         self._ensure_everything_curated()
 
     def _apply(self, station: Station, db: impuls.DBConnection) -> None:
@@ -85,12 +45,14 @@ class LoadStops(impuls.Task):
                 (station.name, station.lat, station.lon, extra_fields, station.id),
             )
             if station.extra_id in self.to_update:
-                db.raw_execute(
-                    "UPDATE stop_times SET stop_id = ? WHERE stop_id = ?",
-                    (station.id, station.extra_id),
-                )
-                db.raw_execute("DELETE FROM stops WHERE stop_id = ?", (station.extra_id,))
+                self.remapper.remap_stop(db, station.extra_id, station.id)
+                self.merged.add(station.extra_id)
         elif station.extra_id in self.to_update:
+            if station.id in self.merged:
+                # Stop is renamed to an id of a merged stop, which must be removed first
+                self._apply_merges(db)
+                self.remapper.begin(db)
+
             db.raw_execute(
                 "UPDATE stops SET stop_id = ?, name = ?, lat = ?, lon = ?, extra_fields_json = ? "
                 "WHERE stop_id = ?",
@@ -107,6 +69,12 @@ class LoadStops(impuls.Task):
         self.to_update.pop(station.id, None)
         self.to_update.pop(station.extra_id, None)
 
+    def _apply_merges(self, db: impuls.DBConnection) -> None:
+        remapped = self.remapper.apply(db)
+        db.raw_execute_many("DELETE FROM stops WHERE stop_id = ?", ((i,) for i in self.merged))
+        self.logger.debug("Merged %d stops, moving %d stop_times", len(self.merged), remapped)
+        self.merged.clear()
+
     def _ensure_everything_curated(self) -> None:
         if self.to_update:
             raise impuls.errors.MultipleDataErrors(
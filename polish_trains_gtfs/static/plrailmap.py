@@ -0,0 +1,177 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import logging
+import os
+import pickle
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from xml.sax import ContentHandler as XmlSaxContentHandler
+from xml.sax import parse as xml_sax_parse
+from xml.sax.xmlreader import AttributesImpl as XmlSaxAttributes
+
+from impuls.tools.types import StrPath
+
+CACHE_VERSION = 1
+"""Version of the pickled :py:class:`PLRailMap` - bump when the parsed objects change."""
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Station:
+    id: str = ""
+    name: str = ""
+    lat: float = 0.0
+    lon: float = 0.0
+    extra_id: str = ""
+    country: str = ""
+
+    def __bool__(self) -> bool:
+        return bool(self.id and self.name and self.lat and self.lon)
+
+
+@dataclass
+class BusStop:
+    station_id: str = ""
+    lat: float = 0.0
+    lon: float = 0.0
+    direction_hints: list[str] = field(default_factory=list[str])
+
+    @property
+    def gtfs_id(self) -> str:
+        if self.direction_hints == [] or self.direction_hints == ["*"]:
+            return f"{self.station_id}_BUS"
+        return f"{self.station_id}_BUS_{self.direction_hints[0]}"
+
+    def __bool__(self) -> bool:
+        return self.station_id != "" and self.lat != 0.0 and self.lon != 0.0
+
+
+@dataclass
+class PLRailMap:
+    """PLRailMap contains all objects used by the pipeline from the PLRailMap OSM file."""
+
+    stations: list[Station] = field(default_factory=list[Station])
+    bus_stops: dict[str, list[BusStop]] = field(default_factory=dict[str, list[BusStop]])
+
+
+class PLRailMapHandler(XmlSaxContentHandler):
+    """PLRailMapHandler collects stations and bus stops from PLRailMap in a single pass.
+    Only tags of nodes are considered.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.result = PLRailMap()
+        self.in_node = False
+        self.lat = 0.0
+        self.lon = 0.0
+        self.tags = dict[str, str]()
+
+    def startElement(self, name: str, attrs: XmlSaxAttributes) -> None:
+        if name == "node":
+            self.in_node = True
+            self.lat = float(attrs["lat"])
+            self.lon = float(attrs["lon"])
+            self.tags.clear()
+        elif name == "tag" and self.in_node:
+            self.tags[attrs["k"]] = attrs["v"]
+
+    def endElement(self, name: str) -> None:
+        if name != "node":
+            return
+
+        self.in_node = False
+
+        station = Station(
+            id=self.tags.get("ref", ""),
+            name=self.tags.get("name", ""),
+            lat=self.lat,
+            lon=self.lon,
+            extra_id=self.tags.get("ref:2", ""),
+            country=self.tags.get("country", ""),
+        )
+        if station:
+            self.result.stations.append(station)
+
+        if self.tags.get("highway") == "bus_stop":
+            direction = self.tags.get("direction")
+            stop = BusStop(
+                station_id=self.tags.get("ref:station", ""),
+                lat=self.lat,
+                lon=self.lon,
+                direction_hints=direction.split(";") if direction else [],
+            )
+            if stop:
+                self.result.bus_stops.setdefault(stop.station_id, []).append(stop)
+
+    @classmethod
+    def load_from_file(cls, path: StrPath) -> PLRailMap:
+        handler = cls()
+        xml_sax_parse(path, handler)
+        return handler.result
+
+
+_memo: tuple[str, PLRailMap] | None = None
+
+
+def load_plrailmap(path: Path) -> PLRailMap:
+    """Loads stations and bus stops from the PLRailMap file at the provided path.
+
+    The parsed objects are pickled next to the file (as `<path>.index.pickle`)
+    and reused as long as the SHA-256 of the file doesn't change. Within a single process,
+    the parsed objects are also kept in memory and shared by all callers,
+    who must not modify them.
+    """
+    global _memo
+
+    digest = file_digest(path)
+    if _memo is not None and _memo[0] == digest:
+        return _memo[1]
+
+    cache_path = path.with_name(f"{path.name}.index.pickle")
+    parsed = load_cached(cache_path, digest)
+    if parsed is None:
+        start = perf_counter()
+        parsed = PLRailMapHandler.load_from_file(path)
+        logger.info(
+            "Parsed %d stations and %d bus stops from %s in %.2f s",
+            len(parsed.stations),
+            sum(len(i) for i in parsed.bus_stops.values()),
+            path.name,
+            perf_counter() - start,
+        )
+        save_cached(cache_path, digest, parsed)
+
+    _memo = digest, parsed
+    return parsed
+
+
+def load_cached(cache_path: Path, digest: str) -> PLRailMap | None:
+    try:
+        with cache_path.open("rb") as f:
+            version, cached_digest, parsed = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Ignoring invalid cache %s: %s", cache_path, e)
+        return None
+
+    if version != CACHE_VERSION or cached_digest != digest:
+        return None
+    return parsed
+
+
+def save_cached(cache_path: Path, digest: str, parsed: PLRailMap) -> None:
+    tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        pickle.dump((CACHE_VERSION, digest, parsed), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def file_digest(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
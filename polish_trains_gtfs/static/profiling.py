@@ -0,0 +1,138 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import os
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Any, cast
+
+from impuls import DBConnection, Task, TaskRuntime
+from impuls.tools.machine_load import memory_usage_kb
+
+from .. import json
+
+MAIN_TABLES = (
+    "agencies",
+    "routes",
+    "stops",
+    "calendars",
+    "calendar_exceptions",
+    "trips",
+    "stop_times",
+    "shapes",
+    "shape_points",
+    "transfers",
+)
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """Snapshot holds counters of the process and of the database at a single moment."""
+
+    wall_time: float
+    cpu_time: float
+    peak_rss_kb: int
+    pages_read: int | None
+    pages_written: int | None
+    rows: dict[str, int]
+
+    @classmethod
+    def take(cls, db: DBConnection) -> "Snapshot":
+        # NOTE: os.times includes CPU time of finished child processes,
+        #       used by LoadSchedules with --jobs.
+        times = os.times()
+        page_size = cast(int, db.raw_execute("PRAGMA page_size").one_must("page_size")[0])
+        io = read_io_counters()
+        return cls(
+            wall_time=perf_counter(),
+            cpu_time=times.user + times.system + times.children_user + times.children_system,
+            peak_rss_kb=memory_usage_kb(),
+            pages_read=io[0] // page_size if io else None,
+            pages_written=io[1] // page_size if io else None,
+            rows={
+                table: cast(int, db.raw_execute(f"SELECT COUNT(*) FROM {table}").one_must("")[0])
+                for table in MAIN_TABLES
+            },
+        )
+
+
+def read_io_counters() -> tuple[int, int] | None:
+    """Returns the number of bytes read and written by the current process through
+    read/write system calls, or None if not available (on systems other than Linux).
+
+    Python's sqlite3 module doesn't expose sqlite3_db_status, so SQLite page reads and writes
+    are estimated from those counters - SQLite reads and writes whole pages, but other
+    files (like resources) are counted as well.
+    """
+    try:
+        with open("/proc/self/io", "r", encoding="ascii") as f:
+            counters = dict(line.split(":", maxsplit=1) for line in f)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class ProfileReport:
+    """ProfileReport collects resource usage of tasks and writes it to a JSON file,
+    re-written after every task so that the report of a failed pipeline is also available.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.tasks = list[dict[str, Any]]()
+
+    def wrap(self, tasks: Iterable[Task]) -> list[Task]:
+        return [ProfiledTask(task, self) for task in tasks]
+
+    def add(self, name: str, before: Snapshot, after: Snapshot, ok: bool) -> None:
+        self.tasks.append(
+            {
+                "name": name,
+                "ok": ok,
+                "wall_time_s": round(after.wall_time - before.wall_time, 3),
+                "cpu_time_s": round(after.cpu_time - before.cpu_time, 3),
+                "peak_rss_kb": after.peak_rss_kb,
+                "peak_rss_delta_kb": after.peak_rss_kb - before.peak_rss_kb,
+                "pages_read": difference(before.pages_read, after.pages_read),
+                "pages_written": difference(before.pages_written, after.pages_written),
+                "rows_before": before.rows,
+                "rows_after": after.rows,
+            }
+        )
+        self.write()
+
+    def write(self) -> None:
+        report = {
+            "tasks": self.tasks,
+            "total": {
+                "wall_time_s": round(sum(t["wall_time_s"] for t in self.tasks), 3),
+                "cpu_time_s": round(sum(t["cpu_time_s"] for t in self.tasks), 3),
+                "peak_rss_kb": max((t["peak_rss_kb"] for t in self.tasks), default=0),
+            },
+        }
+        self.path.write_text(json.dumps(report, readable=True), encoding="utf-8")
+
+
+class ProfiledTask(Task):
+    """ProfiledTask executes the wrapped task, recording its resource usage
+    in a :py:class:`ProfileReport`."""
+
+    def __init__(self, task: Task, report: ProfileReport) -> None:
+        super().__init__(task.name)
+        self.task = task
+        self.report = report
+
+    def execute(self, r: TaskRuntime) -> None:
+        ok = False
+        before = Snapshot.take(r.db)
+        try:
+            self.task.execute(r)
+            ok = True
+        finally:
+            self.report.add(self.name, before, Snapshot.take(r.db), ok)
+
+
+def difference(before: int | None, after: int | None) -> int | None:
+    return after - before if before is not None and after is not None else None
@@ -0,0 +1,540 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import bz2
+import gzip
+import logging
+import math
+import os
+import pickle
+from array import array
+from collections.abc import Iterator, Sequence
+from dataclasses import dataclass, field
+from heapq import heappop, heappush
+from itertools import islice, pairwise
+from pathlib import Path
+from time import perf_counter
+from typing import IO
+from xml.sax import ContentHandler as XmlSaxContentHandler
+from xml.sax import parse as xml_sax_parse
+from xml.sax.xmlreader import AttributesImpl as XmlSaxAttributes
+
+from impuls.tools.geo import earth_distance_m, initial_bearing
+
+from .plrailmap import file_digest
+
+CACHE_VERSION = 2
+"""Version of the pickled :py:class:`RailGraph` - bump when the preprocessing changes."""
+
+RAILWAY_TYPES = {"rail", "light_rail", "narrow_gauge"}
+"""Values of the railway=* tag of ways which are considered as tracks."""
+
+LANDMARK_COUNT = 8
+ACTIVE_LANDMARK_COUNT = 3
+
+GRID_CELL_SIZE = 0.01
+"""Size (in degrees) of cells of the grid used to snap points to the graph."""
+
+MAX_SNAP_DISTANCE_M = 1000.0
+MAX_SNAP_CANDIDATES = 32
+MAX_SNAP_ALTERNATIVES = 3
+"""Number of nearby tracks tried for a point, if there's no reasonable path to the closest one."""
+
+MAX_TURN_ANGLE = 90.0
+"""Maximum change of direction (in degrees) between consecutive track segments. Prevents
+routes from reversing through switches, e.g. going from one diverging track into the other."""
+
+MAX_DETOUR_FACTOR = 3.0
+MAX_DETOUR_M = 20_000.0
+"""Paths longer than MAX_DETOUR_FACTOR times the straight-line distance plus MAX_DETOUR_M
+are not searched for. Without that limit, legs without a path respecting turn restrictions
+would explore the whole connected component before falling back to an unrestricted search,
+and points snapped to a wrong track would be routed through huge detours."""
+
+INF = math.inf
+
+Shape = list[tuple[float, float]]
+GridCell = tuple[int, int]
+
+logger = logging.getLogger(__name__)
+
+
+class NoRouteError(ValueError):
+    pass
+
+
+@dataclass
+class RailGraph:
+    """RailGraph is an undirected graph of railway tracks, stored in the compressed sparse row
+    format: edges leaving node `v` are at indices `offsets[v]` to `offsets[v+1]` of `targets`,
+    `lengths` (in meters) and `bearings` (in degrees, from `v` towards the target).
+
+    Apart from the graph itself, RailGraph contains all data prepared for the routing:
+    connected components of nodes, distances from landmarks (for the ALT heuristic)
+    and a grid index of nodes (for snapping points to the graph). All of it is kept
+    in arrays, as lists of Python floats would take several times more memory.
+    """
+
+    lats: array[float] = field(default_factory=lambda: array("d"))
+    lons: array[float] = field(default_factory=lambda: array("d"))
+    offsets: array[int] = field(default_factory=lambda: array("i", [0]))
+    targets: array[int] = field(default_factory=lambda: array("i"))
+    lengths: array[float] = field(default_factory=lambda: array("d"))
+    bearings: array[float] = field(default_factory=lambda: array("d"))
+    components: array[int] = field(default_factory=lambda: array("i"))
+    landmark_distances: list[array[float]] = field(default_factory=list[array[float]])
+    grid: dict[GridCell, array[int]] = field(default_factory=dict[GridCell, array[int]])
+
+    def __len__(self) -> int:
+        return len(self.lats)
+
+    @classmethod
+    def build(
+        cls,
+        nodes: Sequence[tuple[float, float]],
+        ways: Sequence[Sequence[int]],
+    ) -> "RailGraph":
+        """Builds and prepares the graph from nodes (as lat-lon pairs) and ways (as sequences
+        of node indices)."""
+        neighbors: list[dict[int, float]] = [{} for _ in nodes]
+        for way in ways:
+            for a, b in pairwise(way):
+                if a != b:
+                    length = earth_distance_m(*nodes[a], *nodes[b])
+                    neighbors[a][b] = length
+                    neighbors[b][a] = length
+
+        g = cls()
+        for v, (lat, lon) in enumerate(nodes):
+            g.lats.append(lat)
+            g.lons.append(lon)
+            for u, length in neighbors[v].items():
+                g.targets.append(u)
+                g.lengths.append(length)
+                g.bearings.append(initial_bearing(lat, lon, *nodes[u]))
+            g.offsets.append(len(g.targets))
+
+        g.find_components()
+        g.select_landmarks()
+        g.build_grid()
+        return g
+
+    def find_components(self) -> None:
+        self.components = array("i", [-1]) * len(self)
+        component = 0
+        for start in range(len(self)):
+            if self.components[start] != -1:
+                continue
+            self.components[start] = component
+            stack = [start]
+            while stack:
+                v = stack.pop()
+                for i in range(self.offsets[v], self.offsets[v + 1]):
+                    u = self.targets[i]
+                    if self.components[u] == -1:
+                        self.components[u] = component
+                        stack.append(u)
+            component += 1
+
+    def select_landmarks(self, count: int = LANDMARK_COUNT) -> None:
+        """Selects landmarks in the largest component with the farthest-point heuristic
+        and computes distances from every landmark to every node."""
+        self.landmark_distances = []
+        if not len(self):
+            return
+
+        sizes = dict[int, int]()
+        for c in self.components:
+            sizes[c] = sizes.get(c, 0) + 1
+        largest = max(sizes, key=sizes.__getitem__)
+        seed = self.components.index(largest)
+
+        min_distances = self.dijkstra(seed)
+        for _ in range(count):
+            landmark = max(
+                (v for v, d in enumerate(min_distances) if d < INF),
+                key=min_distances.__getitem__,
+            )
+            distances = self.dijkstra(landmark)
+            self.landmark_distances.append(distances)
+            min_distances = array("d", map(min, min_distances, distances))
+
+    def dijkstra(self, source: int) -> array[float]:
+        distances = array("d", [INF]) * len(self)
+        distances[source] = 0.0
+        queue = [(0.0, source)]
+        while queue:
+            d, v = heappop(queue)
+            if d > distances[v]:
+                continue
+            for i in range(self.offsets[v], self.offsets[v + 1]):
+                u = self.targets[i]
+                nd = d + self.lengths[i]
+                if nd < distances[u]:
+                    distances[u] = nd
+                    heappush(queue, (nd, u))
+        return distances
+
+    def nodes_within(self, source: int, max_distance: float) -> set[int]:
+        """Returns all nodes reachable from the source within the provided distance."""
+        distances = {source: 0.0}
+        queue = [(0.0, source)]
+        while queue:
+            d, v = heappop(queue)
+            if d > distances[v]:
+                continue
+            for i in range(self.offsets[v], self.offsets[v + 1]):
+                u = self.targets[i]
+                nd = d + self.lengths[i]
+                if nd <= max_distance and nd < distances.get(u, INF):
+                    distances[u] = nd
+                    heappush(queue, (nd, u))
+        return set(distances)
+
+    def build_grid(self) -> None:
+        self.grid = {}
+        for v, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            self.grid.setdefault(grid_cell(lat, lon), array("i")).append(v)
+
+    def snap_candidates(self, lat: float, lon: float) -> list[tuple[float, int]]:
+        """Returns up to MAX_SNAP_CANDIDATES nodes within MAX_SNAP_DISTANCE_M from
+        the provided point, as (distance, node) pairs, closest first."""
+        # A degree of latitude is ~111 km, a degree of longitude in Poland is at least ~64 km
+        rings = math.ceil(MAX_SNAP_DISTANCE_M / (64_000 * GRID_CELL_SIZE))
+        cell_lat, cell_lon = grid_cell(lat, lon)
+        candidates = list[tuple[float, int]]()
+        for d_lat in range(-rings, rings + 1):
+            for d_lon in range(-rings, rings + 1):
+                for v in self.grid.get((cell_lat + d_lat, cell_lon + d_lon), ()):
+                    distance = earth_distance_m(lat, lon, self.lats[v], self.lons[v])
+                    if distance <= MAX_SNAP_DISTANCE_M:
+                        candidates.append((distance, v))
+        candidates.sort()
+        return candidates[:MAX_SNAP_CANDIDATES]
+
+    def edge_between(self, a: int, b: int) -> int:
+        for i in range(self.offsets[a], self.offsets[a + 1]):
+            if self.targets[i] == b:
+                return i
+        raise KeyError((a, b))
+
+    def shortest_path(
+        self,
+        source: int,
+        target: int,
+        max_turn_angle: float = MAX_TURN_ANGLE,
+        incoming_edge: int | None = None,
+    ) -> list[int]:
+        """Finds the shortest path between two nodes with A* and the ALT heuristic.
+        As turns are restricted, the search is done over directed edges instead of nodes.
+        If `incoming_edge` is provided, the turn from it into the first edge
+        is restricted as well.
+
+        Raises :py:exc:`NoRouteError` if there's no such path, or if it's much longer
+        than the straight-line distance between the nodes (see MAX_DETOUR_FACTOR).
+
+        >>> g = RailGraph.build(
+        ...     [(52.0, 21.0), (52.0, 21.01), (52.0, 21.02), (52.002, 21.02)],
+        ...     [[0, 1, 2], [1, 3]],
+        ... )
+        >>> g.shortest_path(0, 3)
+        [0, 1, 3]
+        >>> g.shortest_path(2, 3)
+        Traceback (most recent call last):
+        ...
+        polish_trains_gtfs.static.rail_router.NoRouteError: no path between nodes 2 and 3
+        >>> g.shortest_path(2, 3, max_turn_angle=180.0)
+        [2, 1, 3]
+        >>> g.shortest_path(1, 3, incoming_edge=g.edge_between(2, 1))
+        Traceback (most recent call last):
+        ...
+        polish_trains_gtfs.static.rail_router.NoRouteError: no path between nodes 1 and 3
+        """
+        if source == target:
+            return [source]
+
+        offsets, targets = self.offsets, self.targets
+        lengths, bearings = self.lengths, self.bearings
+        # Only the landmarks giving the best estimate at the source are used,
+        # as evaluating all of them for every node takes more than it saves.
+        landmarks = sorted(
+            ((d, d[target]) for d in self.landmark_distances if d[target] < INF),
+            key=lambda i: abs(i[1] - i[0][source]),
+            reverse=True,
+        )[:ACTIVE_LANDMARK_COUNT]
+
+        def heuristic(v: int) -> float:
+            h = 0.0
+            for d, d_target in landmarks:
+                h = max(h, abs(d_target - d[v]))
+            return h
+
+        def turn_allowed(i: int, j: int) -> bool:
+            return abs((bearings[j] - bearings[i] + 180.0) % 360.0 - 180.0) <= max_turn_angle
+
+        lats, lons = self.lats, self.lons
+        distance = earth_distance_m(lats[source], lons[source], lats[target], lons[target])
+        max_length = MAX_DETOUR_FACTOR * distance + MAX_DETOUR_M
+
+        best = dict[int, float]()
+        previous = dict[int, int]()
+        queue = list[tuple[float, float, int]]()
+        for i in range(offsets[source], offsets[source + 1]):
+            if incoming_edge is None or turn_allowed(incoming_edge, i):
+                best[i] = lengths[i]
+                previous[i] = -1
+                heappush(queue, (lengths[i] + heuristic(targets[i]), lengths[i], i))
+
+        closed = set[int]()
+        while queue:
+            f, d, i = heappop(queue)
+            if f > max_length:
+                break
+            if i in closed:
+                continue
+            closed.add(i)
+
+            v = targets[i]
+            if v == target:
+                return self._reconstruct_path(source, i, previous)
+
+            for j in range(offsets[v], offsets[v + 1]):
+                if not turn_allowed(i, j):
+                    continue
+                nd = d + lengths[j]
+                if nd < best.get(j, INF):
+                    best[j] = nd
+                    previous[j] = i
+                    heappush(queue, (nd + heuristic(targets[j]), nd, j))
+
+        raise NoRouteError(f"no path between nodes {source} and {target}")
+
+    def _reconstruct_path(self, source: int, last_edge: int, previous: dict[int, int]) -> list[int]:
+        path = list[int]()
+        i = last_edge
+        while i != -1:
+            path.append(self.targets[i])
+            i = previous[i]
+        path.append(source)
+        path.reverse()
+        return path
+
+
+class RailRouter:
+    """RailRouter routes trains through a :py:class:`RailGraph` built from an OpenStreetMap
+    extract with railway tracks, fully offline.
+
+    Every point is snapped to the closest node of the graph, all in the same connected
+    component, and legs between consecutive nodes are routed with
+    :py:meth:`RailGraph.shortest_path`. If there's no reasonable path to a point,
+    nodes on other tracks near that point are tried. Every point is snapped only once,
+    and the next leg always starts where the previous one ended.
+
+    Turn restrictions carry over between legs, so a train only reverses at a point
+    if there's no other path to the next one. If no path respecting the turn restrictions
+    exists at all, the leg is routed without them.
+    """
+
+    def __init__(self, graph: RailGraph, digest: str = "") -> None:
+        self.graph = graph
+        self.digest = digest
+
+    @classmethod
+    def load(cls, path: Path) -> "RailRouter":
+        """Loads the graph from an OSM XML file (optionally gzip or bzip2 compressed).
+
+        The prepared graph is pickled next to the file (as `<path>.router.pickle`) and reused
+        as long as the SHA-256 of the file doesn't change.
+        """
+        digest = file_digest(path)
+        cache_path = path.with_name(f"{path.name}.router.pickle")
+        graph = load_cached(cache_path, digest)
+        if graph is None:
+            start = perf_counter()
+            graph = RailGraphHandler.load_from_file(path)
+            logger.info(
+                "Prepared rail graph with %d nodes and %d edges from %s in %.2f s",
+                len(graph),
+                len(graph.targets) // 2,
+                path.name,
+                perf_counter() - start,
+            )
+            save_cached(cache_path, digest, graph)
+        return cls(graph, digest)
+
+    def route(self, points: Sequence[tuple[float, float]]) -> Shape:
+        if len(points) < 2:
+            raise NoRouteError("at least 2 points are required")
+
+        candidates = self.snap_points(points)
+        path = list[int]()
+        error = NoRouteError("no candidates")
+        for source in islice(self.distinct_tracks(candidates[0]), MAX_SNAP_ALTERNATIVES):
+            try:
+                path = self.route_to_any(source, None, candidates[1])
+                break
+            except NoRouteError as e:
+                error = e
+        else:
+            raise error
+
+        for target_candidates in candidates[2:]:
+            incoming_edge = self.graph.edge_between(path[-2], path[-1]) if len(path) > 1 else None
+            path.extend(self.route_to_any(path[-1], incoming_edge, target_candidates)[1:])
+        return [(self.graph.lats[v], self.graph.lons[v]) for v in path]
+
+    def route_to_any(
+        self,
+        source: int,
+        incoming_edge: int | None,
+        target_candidates: list[int],
+    ) -> list[int]:
+        """Routes to the closest candidate node of the next point, trying candidates
+        on other nearby tracks if there's no reasonable path to it."""
+        error = NoRouteError("no candidates")
+        for target in islice(self.distinct_tracks(target_candidates), MAX_SNAP_ALTERNATIVES):
+            try:
+                return self.route_leg(source, target, incoming_edge)
+            except NoRouteError as e:
+                error = e
+        raise error
+
+    def route_leg(self, source: int, target: int, incoming_edge: int | None) -> list[int]:
+        if incoming_edge is not None:
+            try:
+                return self.graph.shortest_path(source, target, incoming_edge=incoming_edge)
+            except NoRouteError:
+                pass  # the train has to reverse at the source
+
+        try:
+            return self.graph.shortest_path(source, target)
+        except NoRouteError:
+            return self.graph.shortest_path(source, target, max_turn_angle=180.0)
+
+    def distinct_tracks(self, candidates: list[int]) -> Iterator[int]:
+        """Yields candidate nodes, skipping nodes close (along the tracks) to already
+        yielded ones - those are on the same track and would be as good."""
+        excluded = set[int]()
+        for v in candidates:
+            if v not in excluded:
+                yield v
+                excluded.update(self.graph.nodes_within(v, 2 * MAX_SNAP_DISTANCE_M))
+
+    def snap_points(self, points: Sequence[tuple[float, float]]) -> list[list[int]]:
+        """Returns candidate nodes (closest first) for every point, all in a single
+        connected component - the one with the smallest total snapping distance."""
+        candidates_by_component = list[dict[int, list[tuple[float, int]]]]()
+        for point in points:
+            candidates = dict[int, list[tuple[float, int]]]()
+            for distance, v in self.graph.snap_candidates(*point):
+                candidates.setdefault(self.graph.components[v], []).append((distance, v))
+            candidates_by_component.append(candidates)
+
+        common = set(candidates_by_component[0]).intersection(*candidates_by_component[1:])
+        if not common:
+            raise NoRouteError(f"no connected tracks near all of {len(points)} points")
+
+        component = min(common, key=lambda c: sum(i[c][0][0] for i in candidates_by_component))
+        return [[v for _, v in i[component]] for i in candidates_by_component]
+
+
+class RailGraphHandler(XmlSaxContentHandler):
+    """RailGraphHandler collects railway ways and their nodes from an OSM XML file.
+
+    The file is read twice: first collecting railway ways, then the coordinates of
+    their nodes only. This keeps memory usage independent of other objects in the file;
+    yet parsing a whole country extract still takes a long time, so pre-filtering it
+    (e.g. with `osmium tags-filter poland.osm.pbf w/railway -o rail.osm`) is recommended.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.reading_nodes = False
+        self.in_way = False
+        self.way_nodes = list[int]()
+        self.tags = dict[str, str]()
+        self.node_indices = dict[int, int]()
+        self.ways = list[list[int]]()
+        self.coords = list[tuple[float, float] | None]()
+
+    def startElement(self, name: str, attrs: XmlSaxAttributes) -> None:
+        if self.reading_nodes:
+            if name == "node" and (idx := self.node_indices.get(int(attrs["id"]))) is not None:
+                self.coords[idx] = float(attrs["lat"]), float(attrs["lon"])
+        elif name == "way":
+            self.in_way = True
+            self.way_nodes.clear()
+            self.tags.clear()
+        elif name == "nd" and self.in_way:
+            self.way_nodes.append(int(attrs["ref"]))
+        elif name == "tag" and self.in_way:
+            self.tags[attrs["k"]] = attrs["v"]
+
+    def endElement(self, name: str) -> None:
+        if name != "way" or self.reading_nodes:
+            return
+        self.in_way = False
+        if self.tags.get("railway") not in RAILWAY_TYPES or self.tags.get("area") == "yes":
+            return
+        self.ways.append(
+            [self.node_indices.setdefault(i, len(self.node_indices)) for i in self.way_nodes]
+        )
+
+    def start_reading_nodes(self) -> None:
+        self.reading_nodes = True
+        self.coords = [None] * len(self.node_indices)
+
+    def graph(self) -> RailGraph:
+        # Drop nodes outside of the extract
+        new_indices = [-1] * len(self.coords)
+        nodes = list[tuple[float, float]]()
+        for idx, coords in enumerate(self.coords):
+            if coords is not None:
+                new_indices[idx] = len(nodes)
+                nodes.append(coords)
+        ways = [[new_indices[i] for i in way if new_indices[i] != -1] for way in self.ways]
+        return RailGraph.build(nodes, ways)
+
+    @classmethod
+    def load_from_file(cls, path: Path) -> RailGraph:
+        handler = cls()
+        with open_extract(path) as f:
+            xml_sax_parse(f, handler)
+        handler.start_reading_nodes()
+        with open_extract(path) as f:
+            xml_sax_parse(f, handler)
+        return handler.graph()
+
+
+def open_extract(path: Path) -> IO[bytes]:
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    elif path.suffix == ".bz2":
+        return bz2.open(path, "rb")
+    return path.open("rb")
+
+
+def grid_cell(lat: float, lon: float) -> GridCell:
+    return math.floor(lat / GRID_CELL_SIZE), math.floor(lon / GRID_CELL_SIZE)
+
+
+def load_cached(cache_path: Path, digest: str) -> RailGraph | None:
+    try:
+        with cache_path.open("rb") as f:
+            version, cached_digest, graph = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Ignoring invalid cache %s: %s", cache_path, e)
+        return None
+
+    if version != CACHE_VERSION or cached_digest != digest:
+        return None
+    return graph
+
+
+def save_cached(cache_path: Path, digest: str, graph: RailGraph) -> None:
+    tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        pickle.dump((CACHE_VERSION, digest, graph), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import sqlite3
+import time
+from array import array
+from collections.abc import Iterable, Mapping
+from datetime import timedelta
+from pathlib import Path
+
+DEFAULT_MAX_AGE = timedelta(days=30)
+DEFAULT_MAX_ENTRIES = 100_000
+
+CACHE_FILE_NAME = "shapes_cache.db"
+
+Shape = list[tuple[float, float]]
+
+
+class ShapeCache:
+    """ShapeCache persists routed shapes across pipeline runs in an SQLite database,
+    keyed by the routing backend and the hash of the routed stop points.
+
+    As the coordinates of stops are part of the hash, moving a stop (e.g. in PLRailMap)
+    makes the shapes through it miss the cache. Such stale entries are dropped by
+    :py:meth:`evict`, which removes entries routed more than `max_age` ago and
+    the least recently used entries over `max_entries`. :py:meth:`clear` drops all entries.
+
+    Points are stored as packed doubles, so cached shapes are exactly the same
+    as routed ones.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_age: timedelta = DEFAULT_MAX_AGE,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS shapes (
+                backend TEXT NOT NULL,
+                shape_hash TEXT NOT NULL,
+                points BLOB NOT NULL,
+                routed_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (backend, shape_hash)
+            ) WITHOUT ROWID
+            """
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_shapes_used_at ON shapes (used_at)")
+        self.db.commit()
+
+    def get_many(self, backend: str, shape_hashes: Iterable[str]) -> dict[str, Shape]:
+        """Returns all cached and not expired shapes out of the requested ones,
+        marking them as used and counting hits and misses."""
+        now = time.time()
+        min_routed_at = now - self.max_age.total_seconds()
+        found = dict[str, Shape]()
+        requested = 0
+        for shape_hash in shape_hashes:
+            requested += 1
+            row = self.db.execute(
+                "SELECT points FROM shapes "
+                "WHERE backend = ? AND shape_hash = ? AND routed_at >= ?",
+                (backend, shape_hash, min_routed_at),
+            ).fetchone()
+            if row is not None:
+                found[shape_hash] = unpack_points(row[0])
+
+        with self.db:
+            self.db.executemany(
+                "UPDATE shapes SET used_at = ? WHERE backend = ? AND shape_hash = ?",
+                ((now, backend, shape_hash) for shape_hash in found),
+            )
+
+        self.hits += len(found)
+        self.misses += requested - len(found)
+        return found
+
+    def put_many(self, backend: str, shapes: Mapping[str, Shape]) -> None:
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO shapes (backend, shape_hash, points, routed_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (backend, shape_hash, pack_points(shape), now, now)
+                    for shape_hash, shape in shapes.items()
+                ),
+            )
+
+    def evict(self) -> int:
+        """Removes expired and least recently used entries, returning the number
+        of removed entries."""
+        with self.db:
+            removed = self.db.execute(
+                "DELETE FROM shapes WHERE routed_at < ?",
+                (time.time() - self.max_age.total_seconds(),),
+            ).rowcount
+            removed += self.db.execute(
+                "DELETE FROM shapes WHERE (backend, shape_hash) IN ("
+                "  SELECT backend, shape_hash FROM shapes "
+                "  ORDER BY used_at DESC LIMIT -1 OFFSET ?"
+                ")",
+                (self.max_entries,),
+            ).rowcount
+        return removed
+
+    def clear(self) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM shapes")
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def pack_points(shape: Shape) -> bytes:
+    return array("d", (coord for point in shape for coord in point)).tobytes()
+
+
+def unpack_points(data: bytes) -> Shape:
+    """
+    >>> unpack_points(pack_points([(52.1, 21.0), (52.2, 21.05)]))
+    [(52.1, 21.0), (52.2, 21.05)]
+    """
+    coords = array("d")
+    coords.frombytes(data)
+    return list(zip(coords[::2], coords[1::2]))
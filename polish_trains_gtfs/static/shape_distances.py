@@ -0,0 +1,106 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+from collections.abc import Iterator
+from itertools import groupby, repeat
+from operator import itemgetter
+from time import perf_counter
+
+import numpy as np
+from impuls import DBConnection, Task, TaskRuntime
+
+from .shape_geometry import FloatArray, cumulative_distances, project_onto_shape
+
+StopPositions = tuple[tuple[float, float], ...]
+
+
+class AddShapeDistances(Task):
+    """AddShapeDistances sets shape_dist_traveled (in meters) of all shape points,
+    and of all stop_times of trips with shapes.
+
+    Stops are placed on shapes with :py:func:`project_onto_shape`. Trips sharing a shape
+    share their sequence of stops as well, so the projection is computed only once
+    for every distinct shape and sequence of stop positions.
+    """
+
+    def execute(self, r: TaskRuntime) -> None:
+        start = perf_counter()
+        with r.db.transaction():
+            shape_sequences, shapes = self.load_shapes(r.db)
+            distances = {shape_id: cumulative_distances(s) for shape_id, s in shapes.items()}
+            r.db.raw_execute_many(
+                "UPDATE shape_points SET shape_dist_traveled = ? "
+                "WHERE shape_id = ? AND sequence = ?",
+                (
+                    update
+                    for shape_id, shape_distances in distances.items()
+                    for update in zip(
+                        shape_distances.round(1).tolist(),
+                        repeat(shape_id),
+                        shape_sequences[shape_id],
+                    )
+                ),
+            )
+
+            trips = 0
+            projections = dict[tuple[str, StopPositions], list[float]]()
+            updates = list[tuple[float, str, int]]()
+            for trip_id, shape_id, sequences, stops in self.load_trip_stops(r.db):
+                key = (shape_id, stops)
+                if (projection := projections.get(key)) is None:
+                    projection = project_onto_shape(
+                        shapes[shape_id],
+                        distances[shape_id],
+                        np.array(stops, dtype=np.float64),
+                    ).round(1).tolist()
+                    projections[key] = projection
+                updates.extend(zip(projection, repeat(trip_id), sequences))
+                trips += 1
+
+            r.db.raw_execute_many(
+                "UPDATE stop_times SET shape_dist_traveled = ? "
+                "WHERE trip_id = ? AND stop_sequence = ?",
+                updates,
+            )
+
+        self.logger.info(
+            "Computed distances along %d shapes for %d trips (%d distinct projections) in %.2f s",
+            len(shapes),
+            trips,
+            len(projections),
+            perf_counter() - start,
+        )
+
+    @staticmethod
+    def load_shapes(db: DBConnection) -> tuple[dict[str, list[int]], dict[str, FloatArray]]:
+        q = db.raw_execute(
+            "SELECT shape_id, sequence, lat, lon FROM shape_points ORDER BY shape_id, sequence"
+        )
+        sequences = dict[str, list[int]]()
+        shapes = dict[str, FloatArray]()
+        for shape_id, rows in groupby(q, itemgetter(0)):
+            rows = list(rows)
+            sequences[str(shape_id)] = [int(row[1]) for row in rows]  # type: ignore
+            shapes[str(shape_id)] = np.array([row[2:] for row in rows], dtype=np.float64)
+        return sequences, shapes
+
+    @staticmethod
+    def load_trip_stops(db: DBConnection) -> Iterator[tuple[str, str, list[int], StopPositions]]:
+        q = db.raw_execute(
+            """
+            SELECT trips.trip_id, trips.shape_id, stop_times.stop_sequence, stops.lat, stops.lon
+            FROM trips
+            JOIN stop_times ON stop_times.trip_id = trips.trip_id
+            JOIN stops ON stops.stop_id = stop_times.stop_id
+            WHERE trips.shape_id IS NOT NULL
+            ORDER BY trips.trip_id, stop_times.stop_sequence
+            """
+        )
+        for (trip_id, shape_id), rows in groupby(q, itemgetter(0, 1)):
+            rows = list(rows)
+            yield (
+                str(trip_id),
+                str(shape_id),
+                [int(row[2]) for row in rows],  # type: ignore
+                tuple((float(row[3]), float(row[4])) for row in rows),  # type: ignore
+            )
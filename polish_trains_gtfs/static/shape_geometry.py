@@ -0,0 +1,177 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import numpy as np
+import numpy.typing as npt
+from impuls.tools.geo import EARTH_RADIUS_M
+
+from .shape_cache import Shape
+
+FloatArray = npt.NDArray[np.float64]
+
+
+def simplify_shape(shape: Shape, tolerance_m: float) -> Shape:
+    """Simplifies a shape with the Douglas-Peucker algorithm: every removed point is
+    at most `tolerance_m` meters away from the simplified line. Kept points are returned
+    unchanged.
+
+    Instead of recursing into every part of the shape separately, all parts are processed
+    at once with NumPy: every iteration computes distances of all undecided points to their
+    current parts (on an equirectangular projection around the shape), and either keeps
+    the farthest point of a part or drops all its points.
+
+    >>> simplify_shape([(52.0, 21.0), (52.0, 21.001), (52.0, 21.002), (52.001, 21.002)], 1.0)
+    [(52.0, 21.0), (52.0, 21.002), (52.001, 21.002)]
+    >>> simplify_shape([(52.0, 21.0), (52.00001, 21.001), (52.0, 21.002)], 1.0)
+    [(52.0, 21.0), (52.00001, 21.001), (52.0, 21.002)]
+    >>> simplify_shape([(52.0, 21.0), (52.00001, 21.001), (52.0, 21.002)], 2.0)
+    [(52.0, 21.0), (52.0, 21.002)]
+    """
+    if tolerance_m <= 0.0 or len(shape) < 3:
+        return shape
+
+    x, y = _project(np.array(shape, dtype=np.float64))
+    keep = np.zeros(len(shape), dtype=np.bool_)
+    keep[0] = keep[-1] = True
+    undecided = ~keep
+
+    while undecided.any():
+        kept = np.flatnonzero(keep)
+        points = np.flatnonzero(undecided)
+        part = np.searchsorted(kept, points, side="right") - 1
+        start = kept[part]
+        end = kept[part + 1]
+        distances = _distances_to_segments(x[points], y[points], x[start], y[start], x[end], y[end])
+
+        # Points are sorted, so points of every part are consecutive
+        part_offsets = np.flatnonzero(np.diff(part, prepend=-1))
+        part_lengths = np.diff(part_offsets, append=len(points))
+        max_distances = np.maximum.reduceat(distances, part_offsets)
+        is_farthest = distances == np.repeat(max_distances, part_lengths)
+        _, first_farthest = np.unique(part[is_farthest], return_index=True)
+        farthest = points[np.flatnonzero(is_farthest)[first_farthest]]
+
+        split = max_distances > tolerance_m
+        keep[farthest[split]] = True
+        undecided[farthest[split]] = False
+        undecided[points[~np.repeat(split, part_lengths)]] = False
+
+    return [shape[i] for i in np.flatnonzero(keep)]
+
+
+def cumulative_distances(points: FloatArray) -> FloatArray:
+    """Returns haversine distances (in meters) along a line of (lat, lon) points,
+    from its first point to every point.
+
+    >>> cumulative_distances(np.array([(52.0, 21.0), (52.0, 21.01), (52.01, 21.01)])).round(1)
+    array([   0. ,  684.6, 1796.5])
+    """
+    lat = np.radians(points[:, 0])
+    lon = np.radians(points[:, 1])
+    sin_dlat_half = np.sin(np.diff(lat) * 0.5)
+    sin_dlon_half = np.sin(np.diff(lon) * 0.5)
+    h = sin_dlat_half * sin_dlat_half + np.cos(lat[:-1]) * np.cos(lat[1:]) * (
+        sin_dlon_half * sin_dlon_half
+    )
+    return np.concatenate(([0.0], np.cumsum(2.0 * EARTH_RADIUS_M * np.arcsin(np.sqrt(h)))))
+
+
+def project_onto_shape(shape: FloatArray, distances: FloatArray, stops: FloatArray) -> FloatArray:
+    """Projects consecutive stops onto a shape, returning their distances along the shape.
+    `shape` and `stops` are arrays of (lat, lon) pairs, `distances` are
+    the :py:func:`cumulative_distances` of the shape.
+
+    Distances of all stops to all segments of the shape are computed at once.
+    Every stop is then assigned to a segment, so that the distances along the shape
+    never go back and the total distance from the stops to the shape is minimal -
+    so that stops on shapes passing by the same place twice are placed at the right pass.
+
+    >>> shape = np.array([(52.0, 21.0), (52.0, 21.01), (52.0, 21.0)])
+    >>> distances = cumulative_distances(shape)
+    >>> stops = np.array([(52.0, 21.0), (52.0001, 21.005), (52.0, 21.01), (52.0, 21.0)])
+    >>> project_onto_shape(shape, distances, stops).round(1)
+    array([   0. ,  342.3,  684.6, 1369.2])
+    """
+    if len(shape) < 2:
+        return np.zeros(len(stops))
+
+    x, y = _project(np.vstack((shape, stops)))
+    n = len(shape)
+    segment_distances, positions = _closest_on_segments(
+        x[n:, np.newaxis],
+        y[n:, np.newaxis],
+        x[: n - 1],
+        y[: n - 1],
+        x[1:n],
+        y[1:n],
+    )
+
+    # along[i, j] is the distance along the shape of the point on segment j closest to stop i
+    along = distances[:-1] + positions * np.diff(distances)
+
+    # cost[i, j] is the smallest total distance of stops up to i from the shape,
+    # with stop i on segment j. The previous stop must be on an earlier segment,
+    # or on the same segment, but not further along it.
+    cost = np.empty_like(segment_distances)
+    cost[0] = segment_distances[0]
+    for i in range(1, len(stops)):
+        before = np.concatenate(([np.inf], np.minimum.accumulate(cost[i - 1])[:-1]))
+        same = np.where(along[i - 1] <= along[i], cost[i - 1], np.inf)
+        cost[i] = segment_distances[i] + np.minimum(before, same)
+
+    segments = np.empty(len(stops), dtype=np.intp)
+    segments[-1] = _last_argmin(cost[-1])
+    for i in range(len(stops) - 1, 0, -1):
+        j = segments[i]
+        previous = _last_argmin(cost[i - 1, :j]) if j > 0 else j
+        if along[i - 1, j] <= along[i, j] and cost[i - 1, j] <= cost[i - 1, previous]:
+            previous = j
+        segments[i - 1] = previous
+
+    return along[np.arange(len(stops)), segments]
+
+
+def _last_argmin(a: FloatArray) -> int:
+    # Ties happen at the ends of consecutive segments, or if the shape goes through
+    # the same place twice - in both cases, the later segment is preferred.
+    return len(a) - 1 - int(np.argmin(a[::-1]))
+
+
+def _project(coords: FloatArray) -> tuple[FloatArray, FloatArray]:
+    """Projects (lat, lon) pairs onto a plane in meters, with the equirectangular projection
+    centered at the mean latitude - accurate enough for shapes spanning a few hundred km."""
+    lat = np.radians(coords[:, 0])
+    lon = np.radians(coords[:, 1])
+    x = lon * np.cos(lat.mean()) * EARTH_RADIUS_M
+    y = lat * EARTH_RADIUS_M
+    return x, y
+
+
+def _distances_to_segments(
+    px: FloatArray,
+    py: FloatArray,
+    x1: FloatArray,
+    y1: FloatArray,
+    x2: FloatArray,
+    y2: FloatArray,
+) -> FloatArray:
+    return _closest_on_segments(px, py, x1, y1, x2, y2)[0]
+
+
+def _closest_on_segments(
+    px: FloatArray,
+    py: FloatArray,
+    x1: FloatArray,
+    y1: FloatArray,
+    x2: FloatArray,
+    y2: FloatArray,
+) -> tuple[FloatArray, FloatArray]:
+    """Returns distances from points to the closest points on segments, and the positions
+    of those closest points on the segments (from 0 at the start to 1 at the end).
+    Arguments are broadcast together."""
+    dx = x2 - x1
+    dy = y2 - y1
+    length_sq = dx * dx + dy * dy
+    dot = (px - x1) * dx + (py - y1) * dy
+    t = np.clip(np.divide(dot, length_sq, out=np.zeros_like(dot), where=length_sq > 0), 0, 1)
+    return np.hypot(px - (x1 + t * dx), py - (y1 + t * dy)), t
@@ -1,76 +1,276 @@
-from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby, pairwise
+from operator import itemgetter
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Tuple
 import impuls
 import requests
 import polyline
 import hashlib
 import os
 
+from ..http_session import pooled_session
+from .rail_router import RailRouter
+from .shape_cache import CACHE_FILE_NAME, Shape, ShapeCache
+from .shape_geometry import simplify_shape
+
 osrm_addr = os.environ.get("OSRM_ADDR")
+rail_extract = os.environ.get("OSM_RAIL_EXTRACT")
+
+# A local OSRM instance can handle many parallel requests,
+# the public OpenRailRouting instance shouldn't be overwhelmed,
+# and the offline router is bound by the CPU (and the GIL).
+DEFAULT_OSRM_CONCURRENCY = 8
+DEFAULT_OPENRAILROUTING_CONCURRENCY = 2
+DEFAULT_RAIL_ROUTER_CONCURRENCY = 1
+
+# (connect, read) timeouts of routing requests, in seconds. A request which times out
+# fails like any other, leaving the shape unrouted - instead of blocking a worker forever.
+ROUTING_TIMEOUT = (10.0, 60.0)
 
 
 class AddShapes(impuls.Task):
+    """AddShapes generates shapes for train trips by routing through their stops,
+    with OSRM (if the OSRM_ADDR environment variable is set), with the offline
+    :py:class:`RailRouter` (if the OSM_RAIL_EXTRACT environment variable points to
+    an OSM file with railway tracks) or with OpenRailRouting.
+
+    Every unique sequence of stops is routed with a single request. If `route_segments`
+    is True, every unique pair of consecutive stops is routed only once instead, and shapes
+    of trips are assembled from the routes between their consecutive stops. As most patterns
+    share most of their segments, this requires far fewer requests - but as segments are
+    routed independently, shapes may turn around at stops, where whole sequences wouldn't.
+
+    Requests are made concurrently by up to `concurrency` threads, sharing a single
+    connection pool. Shape ids are assigned in the order of trips, as if the sequences were
+    routed one by one.
+
+    Unless `use_cache` is False, routes are kept across runs in a :py:class:`ShapeCache`
+    in the workspace directory, and only routes missing from the cache are requested.
+    `clear_cache` drops all cached routes before routing.
+
+    If `simplify_tolerance` (in meters) is positive, shapes are simplified with
+    :py:func:`simplify_shape` before being inserted. Cached shapes are never simplified.
+    """
+
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        use_cache: bool = True,
+        clear_cache: bool = False,
+        route_segments: bool = False,
+        simplify_tolerance: float = 0.0,
+    ) -> None:
+        super().__init__()
+        self.simplify_tolerance = simplify_tolerance
+        self.use_cache = use_cache
+        self.clear_cache = clear_cache
+        self.route_segments = route_segments
+        if concurrency is None:
+            concurrency = _default_concurrency()
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be positive, got {concurrency}")
+        self.concurrency = concurrency
+        self.session = pooled_session(concurrency)
+        self.rail_router: Optional[RailRouter] = None
+
     def execute(self, r: impuls.TaskRuntime):
-        shape_hash_to_id: Dict[str, str] = {}
-        max_id = 0
-        wrong: List[str] = []
+        if not osrm_addr and rail_extract:
+            self.rail_router = RailRouter.load(Path(rail_extract))
+
+        point_lists_by_trip = self.get_point_lists_by_trip(r.db)
+        point_lists_by_hash: Dict[str, List[str]] = {}
+        trip_ids_by_hash: Dict[str, List[str]] = {}
+        for trip_id, point_list in point_lists_by_trip:
+            shape_hash = _hash_stop_points(point_list)
+            point_lists_by_hash.setdefault(shape_hash, point_list)
+            trip_ids_by_hash.setdefault(shape_hash, []).append(trip_id)
+
+        if self.route_segments:
+            shapes = self.route_by_segments(r, point_lists_by_hash)
+        else:
+            labels = {h: f"trip {trip_ids[0]}" for h, trip_ids in trip_ids_by_hash.items()}
+            shapes = self.route_all_with_cache(r, point_lists_by_hash, labels)
+
+        if self.simplify_tolerance > 0.0:
+            shapes = self.simplify_shapes(shapes)
+
+        # Number shapes in the order of their first trip
         with r.db.transaction():
-            trips = list(
-                filter(
-                    lambda trip: "BUS" not in trip.route_id and "IC" not in trip.route_id,
-                    list(r.db.retrieve_all(impuls.model.Trip)),
-                )
+            shape_id_by_hash: Dict[str, str] = {}
+            for shape_hash in point_lists_by_hash:
+                if shapes.get(shape_hash) is not None:
+                    shape_id_by_hash[shape_hash] = str(len(shape_id_by_hash) + 1)
+            self.insert_shapes(r.db, shapes, shape_id_by_hash)
+            r.db.raw_execute_many(
+                "UPDATE trips SET shape_id = ? WHERE trip_id = ?",
+                (
+                    (shape_id, trip_id)
+                    for shape_hash, shape_id in shape_id_by_hash.items()
+                    for trip_id in trip_ids_by_hash[shape_hash]
+                ),
             )
-            for i, trip in enumerate(trips):
-                if i % 100 == 0:
-                    self.logger.info(
-                        f"Processing shapes for trip {i}/{len(trips)}. Created {len(shape_hash_to_id.keys())} shapes"
-                    )
-                stop_points = list(
-                    r.db.raw_execute(
-                        """
-                        SELECT lat, lon
-                        FROM stop_times JOIN stops on stops.stop_id == stop_times.stop_id
-                        WHERE stop_times.trip_id = ?
-                        """,
-                        (trip.id,),
-                    )
-                )
-                point_list = [f"{lat},{lon}" for lat, lon in stop_points]
-                shape_hash = _hash_stop_points(point_list)
 
-                if shape_hash not in shape_hash_to_id.keys() and shape_hash not in wrong:
-                    try:
-                        shape = (
-                            _get_shape_from_osrm(point_list)
-                            if osrm_addr
-                            else _get_shape_from_openrailwayrouting(point_list)
-                        )
+    def get_point_lists_by_trip(self, db: impuls.DBConnection) -> Iterable[Tuple[str, List[str]]]:
+        q = db.raw_execute(
+            """
+            SELECT trips.trip_id, stops.lat, stops.lon
+            FROM trips
+            JOIN stop_times ON stop_times.trip_id = trips.trip_id
+            JOIN stops ON stops.stop_id = stop_times.stop_id
+            WHERE instr(trips.route_id, 'BUS') = 0 AND instr(trips.route_id, 'IC') = 0
+            ORDER BY trips.rowid, stop_times.stop_sequence
+            """
+        )
+        for trip_id, rows in groupby(q, itemgetter(0)):
+            yield str(trip_id), [f"{lat},{lon}" for _, lat, lon in rows]
+
+    def route_by_segments(
+        self,
+        r: impuls.TaskRuntime,
+        point_lists_by_hash: Dict[str, List[str]],
+    ) -> Dict[str, Optional[Shape]]:
+        segments: Dict[str, List[str]] = {}
+        for point_list in point_lists_by_hash.values():
+            for segment in pairwise(point_list):
+                segments.setdefault(_hash_stop_points(list(segment)), list(segment))
+        self.logger.info(
+            f"Routing {len(segments)} unique segments instead of "
+            f"{len(point_lists_by_hash)} unique shapes"
+        )
+
+        labels = {h: f"segment {';'.join(segment)}" for h, segment in segments.items()}
+        segment_shapes = self.route_all_with_cache(r, segments, labels)
+        return {
+            shape_hash: _join_segments(point_list, segment_shapes)
+            for shape_hash, point_list in point_lists_by_hash.items()
+        }
+
+    def route_all_with_cache(
+        self,
+        r: impuls.TaskRuntime,
+        point_lists_by_hash: Dict[str, List[str]],
+        labels: Dict[str, str],
+    ) -> Dict[str, Optional[Shape]]:
+        if not self.use_cache:
+            return self.route_all(point_lists_by_hash, labels)
 
-                        max_id += 1
-                        shape_id = str(max_id)
-                        shape_hash_to_id[shape_hash] = shape_id
-                        r.db.raw_execute("INSERT INTO shapes (shape_id) VALUES (?)", (shape_id,))
-                        for i, (lat, lon) in enumerate(shape):
-                            r.db.create(
-                                impuls.model.ShapePoint(
-                                    shape_id=shape_id,
-                                    lat=lat,
-                                    lon=lon,
-                                    sequence=i,
-                                )
-                            )
-
-                        trip.shape_id = shape_id
-                        r.db.update(trip)
+        cache = ShapeCache(r.options.workspace_directory / CACHE_FILE_NAME)
+        try:
+            if self.clear_cache:
+                cache.clear()
+            backend = self.backend_id()
+            shapes: Dict[str, Optional[Shape]] = {}
+            shapes.update(cache.get_many(backend, point_lists_by_hash))
+            self.logger.info(f"Shape cache: {cache.hits} hits, {cache.misses} misses")
+
+            routed = self.route_all(
+                {h: p for h, p in point_lists_by_hash.items() if h not in shapes},
+                labels,
+            )
+            cache.put_many(backend, {h: s for h, s in routed.items() if s is not None})
+            shapes.update(routed)
+
+            evicted = cache.evict()
+            if evicted:
+                self.logger.info(f"Evicted {evicted} shapes from the cache")
+        finally:
+            cache.close()
+        return shapes
+
+    def route_all(
+        self,
+        point_lists_by_hash: Dict[str, List[str]],
+        labels: Dict[str, str],
+    ) -> Dict[str, Optional[Shape]]:
+        """Routes all unique point lists concurrently. Point lists which couldn't be routed
+        are mapped to None."""
+        shapes: Dict[str, Optional[Shape]] = {}
+        total = len(point_lists_by_hash)
+        self.logger.info(f"Requesting {total} routes with {self.concurrency} workers")
+
+        start = perf_counter()
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="add-shapes") as pool:
+            futures = {
+                pool.submit(self.route, point_list): shape_hash
+                for shape_hash, point_list in point_lists_by_hash.items()
+            }
+            try:
+                for future in as_completed(futures):
+                    shape_hash = futures[future]
+                    try:
+                        shapes[shape_hash] = future.result()
                     except Exception as e:
-                        wrong.append(shape_hash)
+                        shapes[shape_hash] = None
                         self.logger.warning(
-                            f"Error while getting shape for {trip.id}, exception: {e}"
+                            f"Error while getting shape for {labels[shape_hash]}, exception: {e}"
                         )
-                elif shape_hash not in wrong:
-                    shape_id = shape_hash_to_id[shape_hash]
-                    trip.shape_id = shape_id
-                    r.db.update(trip)
+                    if len(shapes) % 100 == 0:
+                        self.logger.info(f"Routed {len(shapes)}/{total} shapes")
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        self.logger.info(
+            f"Routed {total} shapes in {perf_counter() - start:.2f} s "
+            f"({sum(i is None for i in shapes.values())} failed)"
+        )
+        return shapes
+
+    def route(self, point_list: List[str]) -> Shape:
+        if osrm_addr:
+            return _get_shape_from_osrm(point_list, self.session)
+        if self.rail_router:
+            return self.rail_router.route([_parse_point(i) for i in point_list])
+        return _get_shape_from_openrailwayrouting(point_list, self.session)
+
+    def backend_id(self) -> str:
+        """Returns the identity of the routing backend, used to tell apart cached shapes."""
+        if osrm_addr:
+            return f"osrm:{osrm_addr}"
+        if self.rail_router:
+            return f"rail-router:{self.rail_router.digest}"
+        return "openrailrouting:all_tracks"
+
+    def simplify_shapes(self, shapes: Dict[str, Optional[Shape]]) -> Dict[str, Optional[Shape]]:
+        start = perf_counter()
+        before = 0
+        after = 0
+        simplified: Dict[str, Optional[Shape]] = {}
+        for shape_hash, shape in shapes.items():
+            if shape is not None:
+                before += len(shape)
+                shape = simplify_shape(shape, self.simplify_tolerance)
+                after += len(shape)
+            simplified[shape_hash] = shape
+
+        self.logger.info(
+            f"Simplified shapes from {before} to {after} points "
+            f"({self.simplify_tolerance} m tolerance) in {perf_counter() - start:.2f} s"
+        )
+        return simplified
+
+    def insert_shapes(
+        self,
+        db: impuls.DBConnection,
+        shapes: Dict[str, Optional[Shape]],
+        shape_id_by_hash: Dict[str, str],
+    ) -> None:
+        db.raw_execute_many(
+            "INSERT INTO shapes (shape_id) VALUES (?)",
+            ((shape_id,) for shape_id in shape_id_by_hash.values()),
+        )
+        db.raw_execute_many(
+            "INSERT INTO shape_points (shape_id, sequence, lat, lon) VALUES (?, ?, ?, ?)",
+            (
+                (shape_id, i, lat, lon)
+                for shape_hash, shape_id in shape_id_by_hash.items()
+                for i, (lat, lon) in enumerate(shapes[shape_hash] or [])
+            ),
+        )
+
 
 class RemoveNonPaxStops(impuls.Task):
     def execute(self, r: impuls.TaskRuntime):
@@ -117,7 +317,42 @@ def _hash_stop_points(points: List[str]) -> str:
     return m.hexdigest()
 
 
-def _get_shape_from_openrailwayrouting(point_list: List[str]) -> List[Tuple[float, float]]:
+def _join_segments(
+    point_list: List[str],
+    segment_shapes: Dict[str, Optional[Shape]],
+) -> Optional[Shape]:
+    """Concatenates routes between consecutive points into a single shape, skipping points
+    repeated at the junctions of segments. Returns None if any segment couldn't be routed,
+    or if there are no segments at all."""
+    shape: Shape = []
+    for segment in pairwise(point_list):
+        segment_shape = segment_shapes.get(_hash_stop_points(list(segment)))
+        if segment_shape is None:
+            return None
+        if shape and segment_shape and shape[-1] == segment_shape[0]:
+            shape.extend(segment_shape[1:])
+        else:
+            shape.extend(segment_shape)
+    return shape or None
+
+
+def _default_concurrency() -> int:
+    if osrm_addr:
+        return DEFAULT_OSRM_CONCURRENCY
+    if rail_extract:
+        return DEFAULT_RAIL_ROUTER_CONCURRENCY
+    return DEFAULT_OPENRAILROUTING_CONCURRENCY
+
+
+def _parse_point(point: str) -> Tuple[float, float]:
+    lat, lon = point.split(",")
+    return float(lat), float(lon)
+
+
+def _get_shape_from_openrailwayrouting(
+    point_list: List[str],
+    session: Optional[requests.Session] = None,
+) -> List[Tuple[float, float]]:
     params = {
         "point": point_list,
         "type": "json",
@@ -126,19 +361,30 @@ def _get_shape_from_openrailwayrouting(point_list: List[str]) -> List[Tuple[floa
         "elevation": "false",
         "profile": "all_tracks",
     }
-    response = requests.get("https://routing.openrailrouting.org/route", params=params)
+    response = (session or requests).get(
+        "https://routing.openrailrouting.org/route",
+        params=params,
+        timeout=ROUTING_TIMEOUT,
+    )
     response.raise_for_status()
 
     data = response.json()["paths"][0]["points"]
     return polyline.decode(data)
 
 
-def _get_shape_from_osrm(point_list: List[str]) -> List[Tuple[float, float]]:
+def _get_shape_from_osrm(
+    point_list: List[str],
+    session: Optional[requests.Session] = None,
+) -> List[Tuple[float, float]]:
     base_url = f"{osrm_addr}/route/v1/train"
     coordinates = ";".join([reverse(x) for x in point_list])
 
     params = {"overview": "full", "geometries": "polyline6"}
-    response = requests.get(f"{base_url}/{coordinates}", params=params)
+    response = (session or requests).get(
+        f"{base_url}/{coordinates}",
+        params=params,
+        timeout=ROUTING_TIMEOUT,
+    )
     response.raise_for_status()
 
     data = response.json()["routes"][0]["geometry"]
@@ -1,81 +1,139 @@
 # SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
 # SPDX-License-Identifier: MIT
 
+from time import perf_counter
 from typing import cast
 
 from impuls import DBConnection, Task, TaskRuntime
-from impuls.model import Date
 
 SECOND = 1
 MINUTE = 60 * SECOND
 HOUR = 60 * MINUTE
 DAY = 24 * HOUR
 
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+# Moving all dates by day_offset also moves every weekday by day_offset;
+# e.g. Mondays become Sundays with day_offset=-1.
+SHIFTED_WEEKDAYS = ", ".join(
+    f"CASE ((({i} - s.day_offset) % 7) + 7) % 7 "
+    + " ".join(f"WHEN {j} THEN c.{weekday}" for j, weekday in enumerate(WEEKDAYS))
+    + " END"
+    for i in range(7)
+)
+
+ANY_WEEKDAY = " OR ".join(f"c.{weekday}" for weekday in WEEKDAYS)
+
 
 class ShiftNegativeTimes(Task):
-    def execute(self, r: TaskRuntime) -> None:
-        to_shift = self.find_trips_to_shift(r.db)
-        if not to_shift:
-            return
+    """ShiftNegativeTimes moves trips starting at negative times to the previous days,
+    by shifting their calendars and stop_times. Shifted calendars are shared between trips
+    with the same calendar and day offset, and are identified by `{calendar_id}{day_offset:+}D`.
+
+    All changes are done with a few set-based statements, using temporary tables:
+    trip_shifts with every trip to shift, and calendar_shifts with every
+    distinct (calendar, day offset) pair.
+    """
 
-        self.logger.info("Shifting %d trips starting with negative times", len(to_shift))
+    def execute(self, r: TaskRuntime) -> None:
+        start = perf_counter()
+        calendars = 0
         with r.db.transaction():
-            for trip_id, day_offset in to_shift:
-                self.shift_trip(r.db, trip_id, day_offset)
-
-    def find_trips_to_shift(self, db: DBConnection) -> list[tuple[str, int]]:
-        return [
-            (cast(str, i[0]), cast(int, i[1]))
-            for i in db.raw_execute(
-                "SELECT trip_id, CAST(floor(CAST(arrival_time AS REAL) / ?) AS INTEGER) "
-                "FROM stop_times "
-                "WHERE stop_sequence = 0 AND arrival_time < 0",
-                (DAY,),
+            trips = self.find_trips_to_shift(r.db)
+            if trips:
+                calendars = self.create_shifted_calendars(r.db)
+                self.shift_trips(r.db)
+            self.drop_temporary_tables(r.db)
+
+        if trips:
+            self.logger.info(
+                "Shifted %d trips starting with negative times, creating %d calendars in %.2f s",
+                trips,
+                calendars,
+                perf_counter() - start,
             )
-        ]
-
-    def shift_trip(self, db: DBConnection, trip_id: str, day_offset: int) -> None:
-        old_calendar_id = cast(
-            str,
-            db.raw_execute(
-                "SELECT calendar_id FROM trips WHERE trip_id = ?",
-                (trip_id,),
-            ).one_must("missing trip")[0],
-        )
-        new_calendar_id = self.get_shifted_calendar_id(db, old_calendar_id, day_offset)
+
+    def find_trips_to_shift(self, db: DBConnection) -> int:
         db.raw_execute(
-            "UPDATE trips SET calendar_id = ? WHERE trip_id = ?",
-            (new_calendar_id, trip_id),
+            "CREATE TEMPORARY TABLE trip_shifts ("
+            "  trip_id TEXT PRIMARY KEY,"
+            "  calendar_id TEXT NOT NULL,"
+            "  day_offset INTEGER NOT NULL"
+            ") STRICT, WITHOUT ROWID"
         )
+        return db.raw_execute(
+            "INSERT INTO temp.trip_shifts (trip_id, calendar_id, day_offset) "
+            "SELECT trip_id, trips.calendar_id, "
+            "  CAST(floor(CAST(arrival_time AS REAL) / ?) AS INTEGER) "
+            "FROM stop_times JOIN trips USING (trip_id) "
+            "WHERE stop_sequence = 0 AND arrival_time < 0",
+            (DAY,),
+        ).rowcount
 
-        time_offset = DAY * -day_offset
+    def create_shifted_calendars(self, db: DBConnection) -> int:
         db.raw_execute(
-            "UPDATE stop_times SET arrival_time = arrival_time + ?, "
-            "departure_time = departure_time + ? WHERE trip_id = ?",
-            (time_offset, time_offset, trip_id),
+            "CREATE TEMPORARY TABLE calendar_shifts ("
+            "  calendar_id TEXT NOT NULL,"
+            "  day_offset INTEGER NOT NULL,"
+            "  new_calendar_id TEXT NOT NULL,"
+            "  is_new INTEGER NOT NULL,"
+            "  PRIMARY KEY (calendar_id, day_offset)"
+            ") STRICT, WITHOUT ROWID"
+        )
+        db.raw_execute(
+            "INSERT INTO temp.calendar_shifts (calendar_id, day_offset, new_calendar_id, is_new) "
+            "SELECT calendar_id, day_offset, new_calendar_id, NOT EXISTS ("
+            "  SELECT 1 FROM calendars WHERE calendars.calendar_id = new_calendar_id"
+            ") FROM ("
+            "  SELECT DISTINCT calendar_id, day_offset, "
+            "    calendar_id || printf('%+dD', day_offset) AS new_calendar_id "
+            "  FROM temp.trip_shifts"
+            ")"
         )
 
-    def get_shifted_calendar_id(self, db: DBConnection, old: str, day_offset: int) -> str:
-        new = f"{old}{day_offset:+}D"
-
-        # Check if the shifted calendar already exists
-        if db.raw_execute("SELECT 1 FROM calendars WHERE calendar_id = ?", (new,)).one():
-            return new
+        created = db.raw_execute(
+            f"""
+            INSERT INTO calendars (calendar_id, monday, tuesday, wednesday, thursday, friday,
+                saturday, sunday, start_date, end_date)
+            SELECT
+                s.new_calendar_id,
+                {SHIFTED_WEEKDAYS},
+                iif({ANY_WEEKDAY}, date(c.start_date, printf('%+d days', s.day_offset)),
+                    c.start_date),
+                iif({ANY_WEEKDAY}, date(c.end_date, printf('%+d days', s.day_offset)),
+                    c.end_date)
+            FROM temp.calendar_shifts AS s
+            JOIN calendars AS c ON c.calendar_id = s.calendar_id
+            WHERE s.is_new
+            """
+        ).rowcount
 
-        # Get the shifted dates
-        new_dates = [
-            Date.from_ymd_str(cast(str, i[0])).add_days(day_offset)
-            for i in db.raw_execute(
-                "SELECT date FROM calendar_exceptions WHERE calendar_id = ?",
-                (old,),
-            )
-        ]
+        db.raw_execute(
+            "INSERT INTO calendar_exceptions (calendar_id, date, exception_type) "
+            "SELECT s.new_calendar_id, date(e.date, printf('%+d days', s.day_offset)), "
+            "  e.exception_type "
+            "FROM temp.calendar_shifts AS s "
+            "JOIN calendar_exceptions AS e ON e.calendar_id = s.calendar_id "
+            "WHERE s.is_new"
+        )
+        return cast(int, created)
 
-        # Insert the shifted calendar
-        db.raw_execute("INSERT INTO calendars (calendar_id) VALUES (?)", (new,))
-        db.raw_execute_many(
-            "INSERT INTO calendar_exceptions (calendar_id, date, exception_type) VALUES (?, ?, 1)",
-            ((new, d.isoformat()) for d in new_dates),
+    def shift_trips(self, db: DBConnection) -> None:
+        db.raw_execute(
+            "UPDATE trips SET calendar_id = s.new_calendar_id "
+            "FROM temp.trip_shifts AS t "
+            "JOIN temp.calendar_shifts AS s "
+            "  ON s.calendar_id = t.calendar_id AND s.day_offset = t.day_offset "
+            "WHERE trips.trip_id = t.trip_id"
+        )
+        db.raw_execute(
+            "UPDATE stop_times SET arrival_time = arrival_time - t.day_offset * ?, "
+            "  departure_time = departure_time - t.day_offset * ? "
+            "FROM temp.trip_shifts AS t "
+            "WHERE stop_times.trip_id = t.trip_id",
+            (DAY, DAY),
         )
 
-        return new
+    def drop_temporary_tables(self, db: DBConnection) -> None:
+        db.raw_execute("DROP TABLE IF EXISTS temp.trip_shifts")
+        db.raw_execute("DROP TABLE IF EXISTS temp.calendar_shifts")
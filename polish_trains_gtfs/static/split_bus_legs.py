@@ -11,6 +11,8 @@ from impuls.model import Route, StopTime
 from impuls.tasks import SplitTripLegs
 from impuls.tools.color import text_color_for
 
+from . import stop_time_extras
+
 
 class BusRouteCuration(TypedDict):
     agency: NotRequired[str]
@@ -31,7 +33,17 @@ class SplitBusLegs(SplitTripLegs):
 
     def execute(self, r: TaskRuntime) -> None:
         self.curated_routes = r.resources[self.r].yaml()["routes"]
+
+        # SplitTripLegs re-creates stop_times of split trips from StopTime objects,
+        # which only carry extra_fields_json. Only trips with bus legs can be split.
+        with r.db.transaction():
+            stop_time_extras.fold(
+                r.db,
+                "stop_times.trip_id IN (SELECT trip_id FROM stop_times WHERE platform = 'BUS')",
+            )
         super().execute(r)
+        with r.db.transaction():
+            stop_time_extras.unfold(r.db)
     
     def arrival_only(self, stop_time: StopTime, previous_data: Any):
         st = super().arrival_only(stop_time, previous_data)
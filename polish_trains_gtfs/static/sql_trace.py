@@ -0,0 +1,220 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+import logging
+import re
+import sqlite3
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any
+
+from impuls import DBConnection, Task, TaskRuntime
+
+PROGRESS_STEPS = 100
+"""Number of SQLite virtual machine instructions between calls to the progress handler."""
+
+LITERAL_PATTERN = re.compile(
+    r"[xX]'[0-9a-fA-F]*'|'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"
+)
+PARAMETER_LIST_PATTERN = re.compile(r"\?(?:\s*,\s*\?)+")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+logger = logging.getLogger("SQLTracer")
+
+
+def normalize_sql(sql: str) -> str:
+    """Replaces literals in an SQL statement by placeholders and collapses whitespace,
+    so that executions of the same statement with different parameters can be aggregated.
+
+    >>> normalize_sql("UPDATE stops SET name = 'Foo''s'\\n  WHERE id IN (1, 2, -3.5) AND x2 = ?")
+    'UPDATE stops SET name = ? WHERE id IN (?, ...) AND x2 = ?'
+    """
+    sql = LITERAL_PATTERN.sub("?", sql)
+    sql = PARAMETER_LIST_PATTERN.sub("?, ...", sql)
+    return WHITESPACE_PATTERN.sub(" ", sql).strip()
+
+
+@dataclass
+class StatementStats:
+    sample: str
+    count: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    steps: int = 0
+    full_scans: list[str] = field(default_factory=list[str])
+
+
+class SQLTracer:
+    """SQLTracer aggregates SQL statements executed by tasks, with the sqlite3 trace callback
+    and progress handler.
+
+    The trace callback is called whenever a statement starts executing, with the SQL text
+    with all parameters bound. The progress handler is called every :py:const:`PROGRESS_STEPS`
+    virtual machine instructions, and the duration of a statement is measured from its start
+    until the last progress handler call before the next statement. For queries with results
+    iterated over in Python, this includes the time spent processing rows between fetches.
+    Statements shorter than :py:const:`PROGRESS_STEPS` instructions are counted with zero
+    duration - those are only visible through their execution and step counts.
+
+    Triggers (including foreign key actions) call the trace callback again, with the text
+    of the statement which fired them. To tell those calls apart from new statements
+    (which may have the same text), the connection is wrapped in a
+    :py:class:`TracedConnection`, which marks every statement started from Python.
+
+    Statements are aggregated by their owning task and normalized text (see
+    :py:func:`normalize_sql`). At the end of every task, full table and index scans
+    of the statements are found with EXPLAIN QUERY PLAN.
+    """
+
+    def __init__(self, top: int) -> None:
+        self.top = top
+        self.stats = defaultdict[tuple[str, str], StatementStats](lambda: StatementStats(""))
+        self.task = ""
+        self.expecting_statement = False
+        self.current: StatementStats | None = None
+        self.start = 0.0
+        self.last_progress = 0.0
+        self.progress_calls = 0
+
+    def wrap(self, tasks: Iterable[Task]) -> list[Task]:
+        return [TracedTask(task, self) for task in tasks]
+
+    def attach(self, db: DBConnection, task: str) -> None:
+        self.task = task
+        # NOTE: DBConnection doesn't expose the underlying sqlite3.Connection
+        con: sqlite3.Connection = db._con  # type: ignore
+        con.set_trace_callback(self.on_statement)
+        con.set_progress_handler(self.on_progress, PROGRESS_STEPS)
+        db._con = TracedConnection(con, self)  # type: ignore
+
+    def detach(self, db: DBConnection) -> None:
+        self.finish_statement()
+        con: sqlite3.Connection | TracedConnection = db._con  # type: ignore
+        if isinstance(con, TracedConnection):
+            con = con.con
+            db._con = con  # type: ignore
+        con.set_trace_callback(None)
+        con.set_progress_handler(None, PROGRESS_STEPS)
+        self.find_full_scans(con)
+
+    def expect_statement(self) -> None:
+        self.expecting_statement = True
+
+    def on_statement(self, sql: str) -> None:
+        if not self.expecting_statement and self.current is not None:
+            return  # statement of a trigger of the current statement
+        self.expecting_statement = False
+
+        self.finish_statement()
+        now = perf_counter()
+        self.current = self.stats[self.task, normalize_sql(sql)]
+        self.current.sample = self.current.sample or sql
+        self.start = now
+        self.last_progress = now
+        self.progress_calls = 0
+
+    def on_progress(self) -> int:
+        self.last_progress = perf_counter()
+        self.progress_calls += 1
+        return 0  # continue executing the statement
+
+    def finish_statement(self) -> None:
+        if self.current is None:
+            return
+        elapsed = self.last_progress - self.start
+        self.current.count += 1
+        self.current.total_time += elapsed
+        self.current.max_time = max(self.current.max_time, elapsed)
+        self.current.steps += self.progress_calls * PROGRESS_STEPS
+        self.current = None
+
+    def find_full_scans(self, con: sqlite3.Connection) -> None:
+        for (task, _), stats in self.stats.items():
+            if task != self.task or not is_explainable(stats.sample):
+                continue
+            try:
+                plan = con.execute(f"EXPLAIN QUERY PLAN {stats.sample}").fetchall()
+            except sqlite3.Error:
+                # Statements may refer to tables which no longer exist
+                continue
+            stats.full_scans = [str(row[3]) for row in plan if str(row[3]).startswith("SCAN ")]
+
+    def log_report(self) -> None:
+        by_task = defaultdict[str, float](float)
+        for (task, _), stats in self.stats.items():
+            by_task[task] += stats.total_time
+
+        logger.info("SQL time by task:")
+        for task, total_time in sorted(by_task.items(), key=lambda i: i[1], reverse=True):
+            logger.info("%9.3f s  %s", total_time, task)
+
+        top = sorted(self.stats.items(), key=lambda i: i[1].total_time, reverse=True)[: self.top]
+        logger.info("Top %d SQL statements by total time:", len(top))
+        for (task, sql), stats in top:
+            logger.info(
+                "%9.3f s  max %.3f s  %8dx  %10d steps  [%s] %s%s",
+                stats.total_time,
+                stats.max_time,
+                stats.count,
+                stats.steps,
+                task,
+                sql if len(sql) <= 200 else f"{sql[:200]}...",
+                f"  ({', '.join(stats.full_scans)})" if stats.full_scans else "",
+            )
+
+
+class TracedConnection:
+    """TracedConnection forwards everything to a sqlite3.Connection, notifying
+    the :py:class:`SQLTracer` right before statements are started - for executemany,
+    before every set of parameters."""
+
+    def __init__(self, con: sqlite3.Connection, tracer: SQLTracer) -> None:
+        self.con = con
+        self.tracer = tracer
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.con, name)
+
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        self.tracer.expect_statement()
+        return self.con.execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Iterable[Any]) -> sqlite3.Cursor:
+        return self.con.executemany(sql, self.expecting_each(parameters))
+
+    def commit(self) -> None:
+        self.tracer.expect_statement()
+        self.con.commit()
+
+    def rollback(self) -> None:
+        self.tracer.expect_statement()
+        self.con.rollback()
+
+    def expecting_each(self, parameters: Iterable[Any]) -> Iterator[Any]:
+        for p in parameters:
+            self.tracer.expect_statement()
+            yield p
+
+
+class TracedTask(Task):
+    """TracedTask executes the wrapped task, with its SQL statements traced
+    by a :py:class:`SQLTracer`."""
+
+    def __init__(self, task: Task, tracer: SQLTracer) -> None:
+        super().__init__(task.name)
+        self.task = task
+        self.tracer = tracer
+
+    def execute(self, r: TaskRuntime) -> None:
+        self.tracer.attach(r.db, self.name)
+        try:
+            self.task.execute(r)
+        finally:
+            self.tracer.detach(r.db)
+
+
+def is_explainable(sql: str) -> bool:
+    keyword = sql.lstrip().split(maxsplit=1)[0].upper() if sql.strip() else ""
+    return keyword in {"SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE"}
@@ -0,0 +1,166 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+from impuls import DBConnection
+
+from ..batch import DEFAULT_BATCH_SIZE, BatchWriter
+
+
+class StopRemapper:
+    """StopRemapper collects changes of stop_id of stop_times in temporary tables and applies
+    all of them at once with a few set-based UPDATE statements, instead of running one UPDATE
+    (and thus possibly one scan of stop_times) per change. Transfers referencing remapped
+    stop_times (through their trip and stop) are updated accordingly.
+
+    Changes can be requested for every stop_time at a stop (:py:meth:`remap_stop`),
+    for stop_times with a specific platform and track (:py:meth:`remap_platform`),
+    or for a single stop_time (:py:meth:`remap_stop_time`). If a stop_time matches multiple
+    changes, the most specific one is used (stop_time, then platform and track, then platform,
+    then stop). Among equally specific changes, the first requested one wins.
+
+    Usage::
+
+        remapper = StopRemapper()
+        remapper.begin(db)
+        remapper.remap_stop(db, "old", "new")
+        remapped_count = remapper.apply(db)
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.rules = BatchWriter(
+            "INSERT INTO temp.stop_remap_rules (stop_id, platform, track, new_stop_id) "
+            "VALUES (?, ?, ?, ?)",
+            batch_size,
+        )
+        self.stop_times = BatchWriter(
+            "INSERT OR IGNORE INTO temp.stop_time_remap (trip_id, stop_sequence, new_stop_id) "
+            "VALUES (?, ?, ?)",
+            batch_size,
+        )
+
+    def begin(self, db: DBConnection) -> None:
+        """Prepares empty temporary tables for collecting the changes."""
+        self.rules.clear()
+        self.stop_times.clear()
+        self.drop_tables(db)
+        db.raw_execute(
+            """
+            CREATE TEMPORARY TABLE stop_remap_rules (
+                rule_id INTEGER PRIMARY KEY,
+                stop_id TEXT NOT NULL,
+                platform TEXT DEFAULT NULL,
+                track TEXT DEFAULT NULL,
+                new_stop_id TEXT NOT NULL
+            ) STRICT
+            """
+        )
+        db.raw_execute(
+            "CREATE INDEX temp.idx_stop_remap_rules "
+            "ON stop_remap_rules (stop_id, platform, track, rule_id)"
+        )
+        db.raw_execute(
+            """
+            CREATE TEMPORARY TABLE stop_time_remap (
+                trip_id TEXT NOT NULL,
+                stop_sequence INTEGER NOT NULL,
+                new_stop_id TEXT NOT NULL,
+                PRIMARY KEY (trip_id, stop_sequence)
+            ) STRICT, WITHOUT ROWID
+            """
+        )
+
+    def remap_stop(self, db: DBConnection, stop_id: str, new_stop_id: str) -> None:
+        """Requests all stop_times at `stop_id` to be moved to `new_stop_id`."""
+        self.rules.add(db, (stop_id, None, None, new_stop_id))
+
+    def remap_platform(
+        self,
+        db: DBConnection,
+        stop_id: str,
+        platform: str,
+        new_stop_id: str,
+        track: str | None = None,
+    ) -> None:
+        """Requests all stop_times at `stop_id` with the provided `platform`
+        (and, if not None, with the provided track in stop_time_extras)
+        to be moved to `new_stop_id`.
+        """
+        self.rules.add(db, (stop_id, platform, track, new_stop_id))
+
+    def remap_stop_time(
+        self,
+        db: DBConnection,
+        trip_id: str,
+        stop_sequence: int,
+        new_stop_id: str,
+    ) -> None:
+        """Requests a single stop_time to be moved to `new_stop_id`."""
+        self.stop_times.add(db, (trip_id, stop_sequence, new_stop_id))
+
+    def apply(self, db: DBConnection) -> int:
+        """Applies all requested changes to stop_times and transfers and drops the temporary
+        tables. Returns the number of remapped stop_times.
+        """
+        self.stop_times.flush(db)
+        self.rules.flush(db)
+
+        if self.rules.written:
+            db.raw_execute(
+                f"""
+                INSERT OR IGNORE INTO temp.stop_time_remap (trip_id, stop_sequence, new_stop_id)
+                SELECT trip_id, stop_sequence, new_stop_id FROM (
+                    SELECT st.trip_id, st.stop_sequence, coalesce(
+                        ({self._matching_rule("r.platform = st.platform AND r.track = e.track")}),
+                        ({self._matching_rule("r.platform = st.platform AND r.track IS NULL")}),
+                        ({self._matching_rule("r.platform IS NULL AND r.track IS NULL")})
+                    ) AS new_stop_id
+                    FROM stop_times AS st
+                    LEFT JOIN stop_time_extras AS e
+                        ON e.trip_id = st.trip_id AND e.stop_sequence = st.stop_sequence
+                    WHERE st.stop_id IN (SELECT stop_id FROM temp.stop_remap_rules)
+                )
+                WHERE new_stop_id IS NOT NULL
+                """
+            )
+
+        # Transfers are matched by the trip and the stop before the change. Should a trip visit
+        # a stop multiple times, the change of its earliest visit is used.
+        for side in ("from", "to"):
+            db.raw_execute(
+                f"""
+                UPDATE transfers SET {side}_stop_id = m.new_stop_id
+                FROM (
+                    SELECT m.trip_id, st.stop_id, m.new_stop_id, min(m.stop_sequence)
+                    FROM temp.stop_time_remap AS m
+                    JOIN stop_times AS st
+                        ON st.trip_id = m.trip_id AND st.stop_sequence = m.stop_sequence
+                    GROUP BY m.trip_id, st.stop_id
+                ) AS m
+                WHERE transfers.{side}_trip_id = m.trip_id AND transfers.{side}_stop_id = m.stop_id
+                """
+            )
+
+        count = db.raw_execute(
+            """
+            UPDATE stop_times SET stop_id = m.new_stop_id
+            FROM temp.stop_time_remap AS m
+            WHERE stop_times.trip_id = m.trip_id
+              AND stop_times.stop_sequence = m.stop_sequence
+              AND stop_times.stop_id != m.new_stop_id
+            """
+        ).rowcount
+
+        self.drop_tables(db)
+        return count
+
+    @staticmethod
+    def _matching_rule(condition: str) -> str:
+        return (
+            "SELECT r.new_stop_id FROM temp.stop_remap_rules AS r "
+            f"WHERE r.stop_id = st.stop_id AND {condition} ORDER BY r.rule_id LIMIT 1"
+        )
+
+    @staticmethod
+    def drop_tables(db: DBConnection) -> None:
+        db.raw_execute("DROP TABLE IF EXISTS temp.stop_remap_rules")
+        db.raw_execute("DROP TABLE IF EXISTS temp.stop_time_remap")
@@ -0,0 +1,125 @@
+# SPDX-FileCopyrightText: 2026 Mikołaj Kuranowski
+# SPDX-License-Identifier: MIT
+
+from typing import LiteralString
+
+from impuls import DBConnection, Task, TaskRuntime
+from impuls.tools.types import SQLNativeType
+
+COLUMNS = (
+    "track",
+    "plk_category_code",
+    "plk_sequence",
+    "arrival_cc",
+    "departure_cc",
+    "arrival_platform",
+    "departure_platform",
+    "arrival_track",
+    "departure_track",
+)
+
+INSERT_SQL = (
+    "INSERT INTO stop_time_extras (trip_id, stop_sequence, track, plk_category_code, "
+    "plk_sequence, arrival_cc, departure_cc, arrival_platform, departure_platform, "
+    "arrival_track, departure_track) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def create_table(db: DBConnection) -> None:
+    """Creates the stop_time_extras table, which keeps PLK-specific attributes of stop_times
+    in typed columns. The table is keyed by the primary key of stop_times and follows it with
+    ON DELETE/UPDATE CASCADE, so that tasks modifying stop_times don't need to be aware of it.
+    """
+    db.raw_execute(
+        """
+        CREATE TABLE IF NOT EXISTS stop_time_extras (
+            trip_id TEXT NOT NULL,
+            stop_sequence INTEGER NOT NULL,
+            track TEXT NOT NULL DEFAULT '',
+            plk_category_code TEXT NOT NULL DEFAULT '',
+            plk_sequence INTEGER DEFAULT NULL,
+            arrival_cc TEXT NOT NULL DEFAULT '',
+            departure_cc TEXT NOT NULL DEFAULT '',
+            arrival_platform TEXT NOT NULL DEFAULT '',
+            departure_platform TEXT NOT NULL DEFAULT '',
+            arrival_track TEXT NOT NULL DEFAULT '',
+            departure_track TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (trip_id, stop_sequence),
+            FOREIGN KEY (trip_id, stop_sequence) REFERENCES stop_times (trip_id, stop_sequence)
+                ON DELETE CASCADE ON UPDATE CASCADE
+        ) STRICT, WITHOUT ROWID
+        """
+    )
+    db.raw_execute(
+        "CREATE INDEX IF NOT EXISTS idx_stop_time_extras_bus "
+        "ON stop_time_extras (trip_id, stop_sequence) WHERE plk_category_code = 'BUS'"
+    )
+
+
+def fold(
+    db: DBConnection,
+    where: LiteralString = "1",
+    args: tuple[SQLNativeType, ...] = (),
+) -> None:
+    """Copies extras of stop_times matching the `where` condition into their extra_fields_json,
+    so that they are visible to code operating on :py:class:`impuls.model.StopTime` objects.
+    """
+    db.raw_execute(
+        f"""
+        UPDATE stop_times SET extra_fields_json = json_object(
+            'track', e.track,
+            'plk_category_code', e.plk_category_code,
+            'plk_sequence', coalesce(CAST(e.plk_sequence AS TEXT), ''),
+            'arrival_cc', e.arrival_cc,
+            'departure_cc', e.departure_cc,
+            'arrival_platform', e.arrival_platform,
+            'departure_platform', e.departure_platform,
+            'arrival_track', e.arrival_track,
+            'departure_track', e.departure_track
+        )
+        FROM stop_time_extras AS e
+        WHERE e.trip_id = stop_times.trip_id
+          AND e.stop_sequence = stop_times.stop_sequence
+          AND ({where})
+        """,
+        args,
+    )
+
+
+def unfold(db: DBConnection) -> None:
+    """Moves all extras from extra_fields_json of stop_times back into stop_time_extras.
+    Reverses :py:func:`fold`."""
+    db.raw_execute(
+        """
+        INSERT OR REPLACE INTO stop_time_extras (trip_id, stop_sequence, track,
+            plk_category_code, plk_sequence, arrival_cc, departure_cc, arrival_platform,
+            departure_platform, arrival_track, departure_track)
+        SELECT
+            trip_id,
+            stop_sequence,
+            coalesce(json_extract(extra_fields_json, '$.track'), ''),
+            coalesce(json_extract(extra_fields_json, '$.plk_category_code'), ''),
+            CAST(nullif(json_extract(extra_fields_json, '$.plk_sequence'), '') AS INTEGER),
+            coalesce(json_extract(extra_fields_json, '$.arrival_cc'), ''),
+            coalesce(json_extract(extra_fields_json, '$.departure_cc'), ''),
+            coalesce(json_extract(extra_fields_json, '$.arrival_platform'), ''),
+            coalesce(json_extract(extra_fields_json, '$.departure_platform'), ''),
+            coalesce(json_extract(extra_fields_json, '$.arrival_track'), ''),
+            coalesce(json_extract(extra_fields_json, '$.departure_track'), '')
+        FROM stop_times
+        WHERE extra_fields_json IS NOT NULL
+        """
+    )
+    db.raw_execute(
+        "UPDATE stop_times SET extra_fields_json = NULL WHERE extra_fields_json IS NOT NULL"
+    )
+
+
+class FoldStopTimeExtras(Task):
+    """FoldStopTimeExtras copies all stop_time_extras into extra_fields_json of stop_times,
+    for the extra fields to be picked up by SaveGTFS. Should run right before saving the feed.
+    """
+
+    def execute(self, r: TaskRuntime) -> None:
+        with r.db.transaction():
+            fold(r.db)